@@ -0,0 +1,93 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+#
+
+"""
+Measures the throughput of the eater writing events to a file, compared with
+writing and flushing the file for every event.
+
+Usage: python benchmarks/eater.py [events] [compression]
+"""
+
+# Standard imports
+import sys
+from time import time
+from shutil import rmtree
+from os.path import abspath, dirname, join
+from tempfile import mkdtemp
+# External imports
+# Custom imports
+sys.path.insert(0, abspath(join(dirname(__file__), "..")))
+from honeysap.core.event import Event  # noqa: E402
+from honeysap.core.session import Session  # noqa: E402
+from honeysap.core.eater import HoneySAPEater  # noqa: E402
+from honeysap.core.config import Configuration  # noqa: E402
+
+
+def build_events(count):
+    session = Session(None, "saprouter", "10.0.0.1", 3200, "10.0.0.2", 3299)
+    events = []
+    for i in range(count):
+        event = Event("Received packet", request=b"\x00" * 64, data={"packet": i})
+        event.session = session
+        events.append(repr(event))
+    return events
+
+
+def unbuffered(filename, events):
+    """Writes and flushes every event, as the eater used to"""
+    with open(filename, "a") as fd:
+        for event in events:
+            fd.write(str(event))
+            fd.write("\n")
+            fd.flush()
+
+
+def buffered(filename, events, compression):
+    eater = HoneySAPEater()
+    eater.config = Configuration({"eater_output": ["file"],
+                                  "eater_filename": filename,
+                                  "eater_compression": compression})
+    eater.setup_output()
+    for event in events:
+        eater.output(event)
+    for output in eater.outputs:
+        output.close()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    compression = sys.argv[2] if len(sys.argv) > 2 else None
+    events = build_events(count)
+    directory = mkdtemp("eater")
+    try:
+        start = time()
+        unbuffered(join(directory, "unbuffered.log"), events)
+        elapsed = time() - start
+        print("Flushing every event: %.2fs, %d events/s" % (elapsed, count / elapsed))
+
+        start = time()
+        buffered(join(directory, "buffered.log"), events, compression)
+        elapsed = time() - start
+        print("Buffered writer (%s): %.2fs, %d events/s" % (compression or "uncompressed",
+                                                            elapsed, count / elapsed))
+    finally:
+        rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+#
+
+"""
+Measures the throughput of importing a LogFeed file into a SQLite database
+with the bulk importer, compared with inserting and committing each event.
+
+Usage: python benchmarks/importer.py [events] [workers]
+"""
+
+# Standard imports
+import sys
+from time import time
+from shutil import rmtree
+from os.path import abspath, dirname, join, getsize
+from tempfile import mkdtemp
+# External imports
+from sqlalchemy import create_engine
+# Custom imports
+sys.path.insert(0, abspath(join(dirname(__file__), "..")))
+from honeysap.core.event import Event  # noqa: E402
+from honeysap.core.session import Session  # noqa: E402
+from honeysap.feeds.dbfeed import Base, DBEvent  # noqa: E402
+from honeysap.core.importer import LogImporter, parse_line  # noqa: E402
+
+
+def write_log(filename, count):
+    """Writes a log file in the LogFeed format"""
+    session = Session(None, "saprouter", "10.0.0.1", 3200, "10.0.0.2", 3299)
+    with open(filename, "w") as fd:
+        for i in range(count):
+            event = Event("Received packet", request=b"\x00" * 64, data={"packet": i})
+            event.session = session
+            fd.write("honeysap.events.logfeed - 2026-10-17 20:42:26,345 - EVENT    - %r\n" % event)
+
+
+def commit_each(filename, db_filename, count):
+    """Inserts and commits each event"""
+    engine = create_engine("sqlite:///%s" % db_filename)
+    Base.metadata.create_all(engine)
+    with open(filename, "rb") as fd:
+        for __, line in zip(range(count), fd):
+            with engine.begin() as connection:
+                session, timestamp, event = parse_line(line)
+                connection.execute(DBEvent.__table__.insert(), [{"session": session, "timestamp": timestamp, "event": event}])
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    directory = mkdtemp("importer")
+    try:
+        filename = join(directory, "honeysap.log")
+        write_log(filename, count)
+        size = getsize(filename) / 1048576.0
+
+        sample = min(count, 2000)
+        start = time()
+        commit_each(filename, join(directory, "each.sqlite"), sample)
+        elapsed = time() - start
+        print("Commit per event: %d events/s" % (sample / elapsed))
+
+        for workers in sorted(set([1, workers])):
+            importer = LogImporter("sqlite:///%s" % join(directory, "bulk%d.sqlite" % workers),
+                                   workers=workers, split_size=int(size * 1048576 / workers) + 1,
+                                   checkpoint_directory=join(directory, "checkpoint%d" % workers))
+            start = time()
+            importer.run([filename])
+            elapsed = time() - start
+            print("Bulk import with %d workers: %.1f MB in %.2fs, %d events/s, %.1f MB/s" %
+                  (workers, size, elapsed, count / elapsed, size / elapsed))
+    finally:
+        rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
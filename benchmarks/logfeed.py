@@ -0,0 +1,103 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+#
+
+"""
+Measures the throughput of the log feed writing events as JSON lines and in
+the legacy format, compared with logging each event through a
+logging.FileHandler as the feed used to.
+
+Usage: python benchmarks/logfeed.py [events] [compression]
+"""
+
+# Standard imports
+import sys
+import logging
+from time import time
+from shutil import rmtree
+from os.path import abspath, dirname, join
+from tempfile import mkdtemp
+# External imports
+# Custom imports
+sys.path.insert(0, abspath(join(dirname(__file__), "..")))
+from honeysap.core.event import Event  # noqa: E402
+from honeysap.core.session import Session  # noqa: E402
+from honeysap.core.config import Configuration  # noqa: E402
+from honeysap.core.logger import default_formatter  # noqa: E402
+from honeysap.feeds.logfeed import LogFeed  # noqa: E402
+
+
+def build_events(count):
+    session = Session(None, "saprouter", "10.0.0.1", 3200, "10.0.0.2", 3299)
+    events = []
+    for i in range(count):
+        event = Event("Received packet", request=b"\x00" * 64, data={"packet": i})
+        event.session = session
+        # Serialize the events beforehand, as the feeds share the cached
+        # representation
+        repr(event)
+        events.append(event)
+    return events
+
+
+def file_handler(filename, events):
+    """Logs every event through a logging.FileHandler"""
+    logging.addLevelName(9, "EVENT")
+    handler = logging.FileHandler(filename)
+    handler.setFormatter(default_formatter)
+    logger = logging.getLogger("honeysap.events.benchmark")
+    logger.setLevel(9)
+    logger.propagate = False
+    logger.addHandler(handler)
+    for event in events:
+        logger.log(9, repr(event))
+    logger.removeHandler(handler)
+    handler.close()
+
+
+def log_feed(filename, events, log_format, compression):
+    feed = LogFeed(Configuration({"log_filename": filename,
+                                  "log_format": log_format,
+                                  "log_compression": compression}))
+    for event in events:
+        feed.log(event)
+    feed.stop()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    compression = sys.argv[2] if len(sys.argv) > 2 else None
+    events = build_events(count)
+    directory = mkdtemp("logfeed")
+    try:
+        start = time()
+        file_handler(join(directory, "handler.log"), events)
+        elapsed = time() - start
+        print("logging.FileHandler: %.2fs, %d events/s" % (elapsed, count / elapsed))
+
+        for log_format in ("json", "legacy"):
+            start = time()
+            log_feed(join(directory, "%s.log" % log_format), events, log_format, compression)
+            elapsed = time() - start
+            print("LogFeed %s (%s): %.2fs, %d events/s" % (log_format, compression or "uncompressed",
+                                                           elapsed, count / elapsed))
+    finally:
+        rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+#
+
+"""
+Measures the memory used by attack sessions and events.
+
+Usage: python benchmarks/memory.py [sessions|events] [count]
+"""
+
+# Standard imports
+import gc
+import sys
+import resource
+from os.path import abspath, dirname, join
+# External imports
+from gevent.queue import Queue
+# Custom imports
+sys.path.insert(0, abspath(join(dirname(__file__), "..")))
+from honeysap.core.event import Event  # noqa: E402
+from honeysap.core.session import Session  # noqa: E402
+
+
+def max_rss():
+    """Returns the maximum resident set size of the process in bytes"""
+    gc.collect()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def sessions(count):
+    """Creates sessions as the session manager does, including their logger"""
+    queue = Queue()
+    items = []
+    for i in range(count):
+        session = Session(queue, "saprouter", "10.%d.%d.%d" % (i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff),
+                          1024 + i % 60000, "10.0.0.1", 3299)
+        session.logger
+        items.append(session)
+    return items
+
+
+def events(count):
+    """Creates events attached to a single session"""
+    session = Session(Queue(), "saprouter", "10.0.0.2", 1024, "10.0.0.1", 3299)
+    items = []
+    for i in range(count):
+        event = Event("Received packet", request="\x00\x00\x00\x00")
+        event.session = session
+        items.append(event)
+    return items
+
+
+def main():
+    kind = sys.argv[1] if len(sys.argv) > 1 else "sessions"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+
+    before = max_rss()
+    items = {"sessions": sessions, "events": events}[kind](count)
+    after = max_rss()
+
+    print("%d %s: %.1f MB, %.1f bytes per item" % (count, kind,
+                                                   (after - before) / 1048576.0,
+                                                   float(after - before) / len(items)))
+
+
+if __name__ == "__main__":
+    main()
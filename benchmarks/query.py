@@ -0,0 +1,170 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+#
+
+"""
+Measures the latency of common lookups on SQLite databases with the events
+stored as JSON in the events table, scanning and parsing the events, and
+with the normalized schema, using the query API.
+
+Usage: python benchmarks/query.py [events] [sessions]
+"""
+
+# Standard imports
+import sys
+from time import time
+from random import Random
+from shutil import rmtree
+from os.path import abspath, dirname, join
+from tempfile import mkdtemp
+from datetime import datetime, timedelta
+# External imports
+from sqlalchemy import create_engine
+# Custom imports
+sys.path.insert(0, abspath(join(dirname(__file__), "..")))
+from honeysap.core.event import Event, json_loads  # noqa: E402
+from honeysap.core.session import Session  # noqa: E402
+from honeysap.core.query import EventQuery  # noqa: E402
+from honeysap.feeds.dbfeed import (Base, DBEvent, NormalizedBase,  # noqa: E402
+                                   normalize_event, insert_normalized)
+
+services = ["saprouter", "dispatcher", "gateway", "enqueue", "msserver"]
+event_names = ["Received packet", "Route request allowed", "Route request denied",
+               "Login request sent the client", "Information request"]
+
+
+def generate_events(count, session_count):
+    """Generates events spread across sessions from a thousand sources,
+    with a route target on half of them."""
+    random = Random(1)
+    sessions = [Session(None, services[i % len(services)], "10.0.%d.%d" % (i % 1000 // 250, i % 250),
+                        40000 + i % 20000, "127.0.0.1", 3200 + i % len(services))
+                for i in range(session_count)]
+    start = datetime(2026, 1, 1)
+    epoch = datetime(1970, 1, 1)
+    for i in range(count):
+        when = start + timedelta(seconds=i * 0.1)
+        data = {"target": "10.1.%d.%d" % (random.randrange(4), random.randrange(250)), "port": 3200} \
+            if i % 2 else {"packet": i}
+        event = Event(event_names[i % len(event_names)], data=data,
+                      time=(when - epoch).total_seconds())
+        event.session = sessions[random.randrange(session_count)]
+        yield event
+
+
+def load(directory, count, session_count):
+    """Loads the events on both layouts, in chunks of 10000 events"""
+    blob = create_engine("sqlite:///%s" % join(directory, "blob.sqlite"))
+    normalized = create_engine("sqlite:///%s" % join(directory, "normalized.sqlite"))
+    Base.metadata.create_all(blob)
+    NormalizedBase.metadata.create_all(normalized)
+
+    def insert(rows, normalized_rows):
+        with blob.begin() as connection:
+            connection.execute(DBEvent.__table__.insert(), rows)
+        with normalized.begin() as connection:
+            insert_normalized(connection, normalized_rows)
+
+    rows, normalized_rows = [], []
+    for event in generate_events(count, session_count):
+        rows.append({"session": str(event.session.uuid), "timestamp": event.timestamp,
+                     "event": repr(event)})
+        normalized_rows.append(normalize_event(event))
+        if len(rows) == 10000:
+            insert(rows, normalized_rows)
+            rows, normalized_rows = [], []
+    if rows:
+        insert(rows, normalized_rows)
+    return blob, normalized
+
+
+def scan(engine, condition=None, parameters=None):
+    """Scans the events table, prefiltering in SQL if a condition is given,
+    and yields the events parsed."""
+    statement = "SELECT event FROM events"
+    if condition:
+        statement += " WHERE " + condition
+    with engine.connect() as connection:
+        for event, in connection.exec_driver_sql(statement, parameters or ()):
+            yield json_loads(event)
+
+
+def blob_events_by_source(engine, source_ip, limit=100):
+    events = [event for event in scan(engine, "event LIKE ?", ('%%"source_ip": "%s"%%' % source_ip,))
+              if event["source_ip"] == source_ip]
+    return sorted(events, key=lambda event: event["timestamp"])[:limit]
+
+
+def blob_session(engine, uuid):
+    return [event for event in scan(engine, "session = ?", (uuid,))]
+
+
+def blob_events_by_service(engine, service, name, limit=100):
+    events = [event for event in scan(engine, "event LIKE ?", ('%%"event": "%s"%%' % name,))
+              if event["service"] == service and event["event"] == name]
+    return sorted(events, key=lambda event: event["timestamp"])[:limit]
+
+
+def blob_top_targets(engine, limit=20):
+    counts = {}
+    for event in scan(engine):
+        data = event.get("data")
+        if isinstance(data, dict) and "target" in data:
+            target = "%s:%s" % (data["target"], data["port"])
+            counts[target] = counts.get(target, 0) + 1
+    return sorted(counts.items(), key=lambda item: -item[1])[:limit]
+
+
+def measure(name, function, *args):
+    start = time()
+    result = function(*args)
+    elapsed = time() - start
+    print("%-42s %10.4fs %8d results" % (name, elapsed, len(result) if result else 0))
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    session_count = int(sys.argv[2]) if len(sys.argv) > 2 else count // 100
+    directory = mkdtemp("honeysapbench")
+    try:
+        start = time()
+        blob, normalized = load(directory, count, session_count)
+        print("Loaded %d events in %d sessions in %.1fs" % (count, session_count, time() - start))
+        with blob.connect() as connection:
+            uuid = connection.exec_driver_sql("SELECT session FROM events LIMIT 1").scalar()
+
+        query = EventQuery(normalized)
+        lookups = [("events by source", blob_events_by_source, (blob, "10.0.1.7"),
+                    query.events_by_source, ("10.0.1.7",)),
+                   ("session", blob_session, (blob, uuid),
+                    lambda uuid: query.session(uuid)["events"], (uuid,)),
+                   ("events by service and type", blob_events_by_service,
+                    (blob, "saprouter", "Route request allowed"),
+                    query.events_by_service, ("saprouter", "Route request allowed")),
+                   ("top route targets", blob_top_targets, (blob,),
+                    query.top_targets, ())]
+        for name, blob_lookup, blob_args, lookup, args in lookups:
+            blob_time = measure("blob: " + name, blob_lookup, *blob_args)
+            normalized_time = measure("normalized: " + name, lookup, *args)
+            print("%-42s %10.1fx" % ("speedup", blob_time / normalized_time))
+    finally:
+        rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+#
+
+"""
+Measures the build time, memory and lookup latency of route tables.
+
+Usage: python benchmarks/routetable.py [entries] [lookups]
+"""
+
+# Standard imports
+import gc
+import sys
+import random
+import resource
+from time import time
+from os.path import abspath, dirname, join
+# External imports
+
+# Custom imports
+sys.path.insert(0, abspath(join(dirname(__file__), "..")))
+from honeysap.services.saprouter.routetable import RouteTable  # noqa: E402
+
+
+def max_rss():
+    """Returns the maximum resident set size of the process in bytes"""
+    gc.collect()
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def random_table(entries):
+    """Builds a route table with random networks, hosts and port ranges"""
+    table = ["allow,ni,10.0.0.0/16,3200-3299,"]
+    for __ in range(entries - 1):
+        action = random.choice(["allow", "deny"])
+        prefix = random.choice([16, 20, 24, 28, 32])
+        network = "10.%d.%d.%d/%d" % (random.randint(0, 255), random.randint(0, 255),
+                                      random.randint(0, 255), prefix)
+        if prefix == 32:
+            network = random.choice([network, "host%d.corp.local" % random.randint(0, 1000)])
+        port = random.randint(3200, 3299)
+        table.append("%s,any,%s,%d-%d," % (action, network, port, port + random.randint(0, 99)))
+    return table
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    random.seed(0)
+    table = random_table(entries)
+    targets = [("10.%d.%d.%d" % (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)),
+                random.randint(3200, 3399)) for __ in range(lookups)]
+
+    before = max_rss()
+    start = time()
+    routetable = RouteTable(table)
+    build_time = time() - start
+    memory = max_rss() - before
+
+    start = time()
+    for host, port in targets:
+        routetable.lookup_target(host, port)
+    lookup_time = time() - start
+
+    print("%d entries: build %.3f s, %.1f MB, lookup %.2f us" % (entries, build_time,
+                                                                 memory / 1048576.0,
+                                                                 lookup_time * 1e6 / lookups))
+
+
+if __name__ == "__main__":
+    main()
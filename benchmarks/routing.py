@@ -0,0 +1,101 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+#
+
+"""
+Measures the overhead of routing events to feeds with the dispatch table,
+compared with evaluating the rules of each feed for every event.
+
+Usage: python benchmarks/routing.py [feeds] [events]
+"""
+
+# Standard imports
+import sys
+import random
+from time import time
+from os.path import abspath, dirname, join
+# External imports
+from gevent.queue import Queue
+# Custom imports
+sys.path.insert(0, abspath(join(dirname(__file__), "..")))
+from honeysap.core.event import Event  # noqa: E402
+from honeysap.core.session import Session  # noqa: E402
+from honeysap.core.routing import EventRouter, RouteRule  # noqa: E402
+
+
+feed_routes = [None,
+               [{"event": "Received packet"}],
+               [{"event": "Route request*"}],
+               [{"service": "dispatcher", "event": "Login request sent the client", "data": "inputs"}],
+               [{"event": "Information request*"}, {"event": "Returned information request"}],
+               [{"service": "saprouter", "source": "10.0.0.0/8"}],
+               [{"service": ["dispatcher", "forwarder"]}],
+               [{"event": ["Returned error", "Session closed"]}],
+               [{"source": ["192.168.0.0/16", "172.16.0.0/12"]}],
+               [{"event": "*request*"}]]
+
+event_names = {"saprouter": ["Received packet", "Returned error", "Route request allowed",
+                             "Information request valid password", "Returned information request",
+                             "Session closed"],
+               "dispatcher": ["Received packet", "Login request sent the client",
+                              "Error message sent to the client", "Session closed"],
+               "forwarder": ["Connected to target", "Forwarding packet", "Forwarding finished"]}
+
+
+def naive_route(targets, event):
+    """Evaluates the rules of each target for the event"""
+    service = event.session.service
+    return [target for target, rules in targets
+            if rules is None or any(rule.match_key(service, event.event) and rule.match_event(event)
+                                    for rule in rules)]
+
+
+def main():
+    feeds = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    random.seed(0)
+    router = EventRouter()
+    targets = []
+    for i in range(feeds):
+        routes = feed_routes[i % len(feed_routes)]
+        router.add("feed%d" % i, routes)
+        targets.append(("feed%d" % i, [RouteRule(rule) for rule in routes] if routes is not None else None))
+
+    sessions = [Session(Queue(), service, "%d.%d.0.1" % (random.choice([10, 172, 192, 8]), i), 1024,
+                        "10.0.0.1", 3299)
+                for i, service in enumerate(sorted(event_names) * 10)]
+    events = []
+    for __ in range(count):
+        session = random.choice(sessions)
+        events.append(Event(random.choice(event_names[session.service]), data={"inputs": []},
+                            session=session))
+
+    for name, route in (("dispatch table", router.route),
+                        ("per feed rules", lambda event: naive_route(targets, event))):
+        start = time()
+        routed = 0
+        for event in events:
+            routed += len(route(event))
+        elapsed = time() - start
+        print("%s: %d feeds, %d events, %.2f us/event, %.1f feeds/event" % (name, feeds, count,
+                                                                          elapsed * 1e6 / count,
+                                                                          float(routed) / count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+#
+
+"""
+Measures the throughput of events sent by a number of sensors to an eater
+through the socket feed, each sensor running in its own process.
+
+Usage: python benchmarks/socketfeed.py [sensors] [events]
+"""
+
+# Standard imports
+import os
+import sys
+from time import time
+from shutil import rmtree
+from os.path import abspath, dirname, join
+from tempfile import mkdtemp
+# External imports
+from gevent import spawn, sleep
+from gevent.queue import Queue
+# Custom imports
+sys.path.insert(0, abspath(join(dirname(__file__), "..")))
+from honeysap.core.event import Event  # noqa: E402
+from honeysap.core.session import Session  # noqa: E402
+from honeysap.core.config import Configuration  # noqa: E402
+from honeysap.feeds.socketfeed import SocketFeed  # noqa: E402
+
+
+def sensor(config, count):
+    """Sends events through the feed and waits until they're acknowledged"""
+    feed = SocketFeed(config)
+    session = Session(None, "saprouter", "10.0.0.1", 3200, "10.0.0.2", 3299)
+    for i in range(count):
+        event = Event("Received packet", request=b"\x00" * 64,
+                      data={"packet": i})
+        event.session = session
+        feed.log(event)
+        if i % 1000 == 0:
+            sleep(0)
+    while feed.stats()["acked"] < count:
+        sleep(0.01)
+    feed.stop()
+
+
+def main():
+    sensors = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    directory = mkdtemp("socketfeed")
+    config = Configuration({"feed_address": "unix:" + join(directory, "feed.sock")})
+    try:
+        # Sensors are forked before starting the eater, and connect to it
+        # once it's listening
+        start = time()
+        pids = []
+        for __ in range(sensors):
+            pid = os.fork()
+            if pid == 0:
+                sensor(config, count)
+                os._exit(0)
+            pids.append(pid)
+
+        queue = Queue()
+        eater = SocketFeed(config)
+        spawn(eater.consume, queue)
+
+        received = 0
+        while received < sensors * count:
+            queue.get()
+            received += 1
+        elapsed = time() - start
+        for pid in pids:
+            os.waitpid(pid, 0)
+        eater.stop()
+        print("%d sensors, %d events: %.2fs, %d events/s" %
+              (sensors, received, elapsed, received / elapsed))
+    finally:
+        rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+#
+
+"""
+Measures the throughput of appending events to the spool and replaying
+them, both as raw records and rebuilding the events.
+
+Usage: python benchmarks/spool.py [events] [fsync policy] [directory]
+"""
+
+# Standard imports
+import sys
+from time import time
+from shutil import rmtree
+from tempfile import mkdtemp
+from os.path import abspath, dirname, join
+# External imports
+from gevent.queue import Queue
+# Custom imports
+sys.path.insert(0, abspath(join(dirname(__file__), "..")))
+from honeysap.core.spool import Spool  # noqa: E402
+from honeysap.core.event import Event  # noqa: E402
+from honeysap.core.session import Session, load_event  # noqa: E402
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    fsync = sys.argv[2] if len(sys.argv) > 2 else Spool.FSYNC_INTERVAL
+    directory = mkdtemp("spool", dir=sys.argv[3] if len(sys.argv) > 3 else None)
+
+    session = Session(Queue(), "saprouter", "10.0.0.2", 1024, "10.0.0.1", 3299)
+    records = []
+    for i in range(count):
+        event = Event("Received packet", data={"route": "10.0.0.%d:3200" % (i % 256)},
+                      request="\x00\x00\x00\x40" + "A" * 64, session=session)
+        records.append(repr(event))
+    size = sum(len(record) for record in records)
+
+    try:
+        spool = Spool(directory, fsync=fsync)
+        reader = spool.reader("feed")
+
+        # Flush every 100 events as the feed manager does under load
+        start = time()
+        for i, record in enumerate(records):
+            spool.append(record)
+            if i % 100 == 99:
+                spool.flush()
+        spool.flush()
+        elapsed = time() - start
+        print("append: %d events (%.1f MB) in %.3f s, %d events/s" % (count, size / 1048576.0,
+                                                                       elapsed, count / elapsed))
+
+        start = time()
+        read = 0
+        while True:
+            batch = reader.read()
+            if not batch:
+                break
+            read += len(batch)
+            reader.ack(batch[-1][1])
+        elapsed = time() - start
+        print("replay: %d records in %.3f s, %d events/s" % (read, elapsed, read / elapsed))
+
+        reader.rewind()
+        reader.ack(0)
+        reader.rewind()
+        start = time()
+        while True:
+            batch = reader.read()
+            if not batch:
+                break
+            for record, offset in batch:
+                load_event(record)
+            reader.ack(batch[-1][1])
+        elapsed = time() - start
+        print("replay and rebuild events: %d events in %.3f s, %d events/s" % (read, elapsed, read / elapsed))
+        spool.close()
+    finally:
+        rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+#
+
+"""
+Measures the ingest rate of the SQLite feed, compared with the database feed
+over SQLite committing each event.
+
+Usage: python benchmarks/sqlitefeed.py [events]
+"""
+
+# Standard imports
+import sys
+from time import time
+from shutil import rmtree
+from os.path import abspath, dirname, join
+from tempfile import mkdtemp
+# External imports
+# Custom imports
+sys.path.insert(0, abspath(join(dirname(__file__), "..")))
+from honeysap.core.event import Event  # noqa: E402
+from honeysap.core.session import Session  # noqa: E402
+from honeysap.core.config import Configuration  # noqa: E402
+from honeysap.feeds.dbfeed import DBFeed  # noqa: E402
+from honeysap.feeds.sqlitefeed import SQLiteFeed  # noqa: E402
+
+
+def build_events(count):
+    session = Session(None, "saprouter", "10.0.0.1", 3200, "10.0.0.2", 3299)
+    events = []
+    for i in range(count):
+        event = Event("Received packet", request=b"\x00" * 64, data={"packet": i})
+        event.session = session
+        events.append(event)
+    return events
+
+
+def ingest(feed, events):
+    start = time()
+    for event in events:
+        feed.log(event)
+    feed.stop()
+    return time() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    events = build_events(count)
+    directory = mkdtemp("sqlitefeed")
+    try:
+        # Committing each event is too slow for the whole set of events
+        sample = events[:min(count, 2000)]
+        # Queue all the events, so none is written to the fallback file
+        feed = DBFeed(Configuration({"db_engine": "sqlite:///%s" % join(directory, "dbfeed.sqlite"),
+                                     "db_queue_size": len(sample),
+                                     "db_timeout": 60,
+                                     "db_fallback_filename": join(directory, "fallback.log")}))
+        elapsed = ingest(feed, sample)
+        print("DBFeed committing every event: %.2fs, %d events/s (%d shed)" %
+              (elapsed, len(sample) / elapsed, feed.stats()["rows_shed"]))
+
+        feed = SQLiteFeed(Configuration({"sqlite_directory": join(directory, "sqlitefeed")}))
+        elapsed = ingest(feed, events)
+        print("SQLiteFeed: %.2fs, %d events/s" % (elapsed, count / elapsed))
+    finally:
+        rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
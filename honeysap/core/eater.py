@@ -20,9 +20,17 @@ import sys
 import logging
 from optparse import OptionGroup
 # External imports
+from six import text_type
 from gevent.monkey import patch_all; patch_all()  # @IgnorePep8
+from gevent import spawn
+from gevent.event import Event
 # Custom imports
 from .feed import FeedManager
+from .writer import RotatingWriter
+from .importer import LogImporter
+from .query import EventQuery, parse_time
+from .sketches import EventSketches
+from .event import json_loads, json_dumps
 from .session import SessionManager
 from .config import ConfigurationParserFromFile
 from .logger import (Loggeable, default_formatter, colored_formatter)
@@ -32,10 +40,86 @@ class HoneySAPEater(Loggeable):
 
     default_config = "honeysapeater.yml"
 
+    #: Queries available with the --query option
+    queries = ["session", "source", "sessions", "service", "targets", "counts"]
+
+    @property
+    def eater_filename(self):
+        return self.config.get("eater_filename", "honeysapeater.log")
+
+    #: Bytes buffered before writing the outputs
+    @property
+    def eater_buffer_size(self):
+        return self.config.get("eater_buffer_size", 1048576)
+
+    #: Seconds between writes of the buffered events
+    @property
+    def eater_flush_interval(self):
+        return self.config.get("eater_flush_interval", 1.0)
+
+    #: Size in bytes after which the output file is rotated (0 to disable)
+    @property
+    def eater_rotate_size(self):
+        return self.config.get("eater_rotate_size", 0)
+
+    #: Seconds after which the output file is rotated (0 to disable)
+    @property
+    def eater_rotate_interval(self):
+        return self.config.get("eater_rotate_interval", 0)
+
+    #: Number of rotated output files kept (0 to keep all)
+    @property
+    def eater_rotate_keep(self):
+        return self.config.get("eater_rotate_keep", 0)
+
+    #: Compression of the output file: gzip, zstd or none
+    @property
+    def eater_compression(self):
+        return self.config.get("eater_compression", None)
+
+    @property
+    def eater_compression_level(self):
+        return self.config.get("eater_compression_level", None)
+
+    #: If streaming sketches of the events should be kept
+    @property
+    def eater_sketches(self):
+        return self.config.get("eater_sketches", False)
+
+    @property
+    def eater_sketches_filename(self):
+        return self.config.get("eater_sketches_filename", "honeysapeater-sketches.json")
+
+    #: Seconds between snapshots of the sketches
+    @property
+    def eater_sketches_interval(self):
+        return self.config.get("eater_sketches_interval", 60)
+
+    #: Length of the sketches windows in seconds
+    @property
+    def eater_sketches_window(self):
+        return self.config.get("eater_sketches_window", 3600)
+
+    #: Number of sketches windows kept
+    @property
+    def eater_sketches_windows(self):
+        return self.config.get("eater_sketches_windows", 24)
+
+    #: Number of top items reported
+    @property
+    def eater_sketches_top(self):
+        return self.config.get("eater_sketches_top", 20)
+
     def main(self, argv=None):
         """Main function to run the program"""
         self.argv = argv
         self.get_configuration()
+        if self.config.import_logs:
+            self.setup_logger()
+            sys.exit(1 if self.import_logs() else 0)
+        if self.config.query:
+            self.setup_logger()
+            sys.exit(self.query_events())
         self.setup()
         self.run()
 
@@ -44,6 +128,7 @@ class HoneySAPEater(Loggeable):
         self.setup_logger()
         self.setup_feeds()
         self.setup_output()
+        self.setup_sketches()
 
     def get_configuration(self):
         """Pase configuration from command line and configuration file """
@@ -61,7 +146,42 @@ class HoneySAPEater(Loggeable):
                                  help="if the console should print logs for all namespaces (root logger) [default: %default]")
         parser.add_option_group(logging_group)
 
-        self.config, __ = parser.parse_args(self.argv)
+        import_group = OptionGroup(parser, "Import",
+                                   "Import the events of LogFeed files, given as arguments, into a database")
+        import_group.add_option("--import", dest="import_logs",
+                                action="store_true", default=False,
+                                help="import LogFeed files instead of consuming feeds [default: %default]")
+        import_group.add_option("--import-db-engine", dest="import_db_engine",
+                                help="database engine URL, or db_engine from the configuration")
+        import_group.add_option("--import-workers", dest="import_workers",
+                                type="int", default=None,
+                                help="number of worker processes [default: number of CPUs]")
+        import_group.add_option("--import-chunk-size", dest="import_chunk_size",
+                                type="int", default=10000,
+                                help="number of events inserted at once [default: %default]")
+        import_group.add_option("--import-checkpoint", dest="import_checkpoint",
+                                default=".honeysapimport",
+                                help="directory for the progress checkpoints [default: %default]")
+        parser.add_option_group(import_group)
+
+        query_group = OptionGroup(parser, "Query",
+                                  "Look up events stored by the DBFeed in the normalized schema")
+        query_group.add_option("--query", dest="query", choices=self.queries,
+                               help="query to run, taking the values to look up as arguments: "
+                                    "session <uuid>, source <ip>, sessions <ip>, "
+                                    "service <service> [event], targets or counts [service]")
+        query_group.add_option("--query-db-engine", dest="query_db_engine",
+                               help="database engine URL, or db_engine from the configuration")
+        query_group.add_option("--query-since", dest="query_since",
+                               help="only events since a time, as YYYY-MM-DD [HH:MM:SS]")
+        query_group.add_option("--query-until", dest="query_until",
+                               help="only events before a time, as YYYY-MM-DD [HH:MM:SS]")
+        query_group.add_option("--query-limit", dest="query_limit",
+                               type="int", default=100,
+                               help="maximum number of results [default: %default]")
+        parser.add_option_group(query_group)
+
+        self.config, self.args = parser.parse_args(self.argv)
 
     def setup_logger(self):
         """Setup logging options, adding the configured handlers (console and
@@ -101,15 +221,97 @@ class HoneySAPEater(Loggeable):
         self.outputs = []
         for eater_type in self.config.get("eater_output", ["stdout"]):
             if eater_type == "stdout":
-                self.outputs.append(sys.stdout)
+                self.outputs.append(RotatingWriter(fd=getattr(sys.stdout, "buffer", sys.stdout),
+                                                   buffer_size=self.eater_buffer_size,
+                                                   flush_interval=self.eater_flush_interval,
+                                                   threaded=False))
             elif eater_type == "file":
-                filename = self.config.get("eater_filename", "honeysapeater.log")
-                with open(filename, "a") as fd:
-                    self.outputs.append(fd)
+                compression = self.eater_compression
+                if compression == "none":
+                    compression = None
+                self.outputs.append(RotatingWriter(self.eater_filename,
+                                                   buffer_size=self.eater_buffer_size,
+                                                   flush_interval=self.eater_flush_interval,
+                                                   rotate_size=self.eater_rotate_size,
+                                                   rotate_interval=self.eater_rotate_interval,
+                                                   rotate_keep=self.eater_rotate_keep,
+                                                   compression=compression,
+                                                   compression_level=self.eater_compression_level))
+
+    def setup_sketches(self):
+        """Setup the streaming sketches of the events, if enabled."""
+        self.sketches = None
+        self.stopped = Event()
+        if self.eater_sketches:
+            self.logger.info("Setting up sketches")
+            self.sketches = EventSketches(window=self.eater_sketches_window,
+                                          windows=self.eater_sketches_windows,
+                                          top=self.eater_sketches_top)
+
+    def write_sketches_periodically(self):
+        """Writes a snapshot of the sketches periodically."""
+        while not self.stopped.wait(self.eater_sketches_interval):
+            try:
+                self.sketches.write_snapshot(self.eater_sketches_filename)
+            except Exception:
+                self.logger.exception("Failed to write sketches snapshot")
+
+    def import_logs(self):
+        """Imports the LogFeed files given as arguments into the database.
+        Returns the number of units that failed."""
+        db_engine = self.config.import_db_engine or self.config.get("db_engine")
+        if not db_engine or not self.args:
+            self.logger.error("A database engine and the files to import are required")
+            return 1
+        importer = LogImporter(db_engine,
+                               workers=self.config.import_workers,
+                               chunk_size=self.config.import_chunk_size,
+                               checkpoint_directory=self.config.import_checkpoint)
+        return importer.run(self.args)
+
+    def query_events(self):
+        """Runs a query on the database and prints the results as JSON
+        lines. Returns the exit status."""
+        db_engine = self.config.query_db_engine or self.config.get("db_engine")
+        if not db_engine:
+            self.logger.error("A database engine is required")
+            return 1
+        args = self.args
+        if self.config.query in ["session", "source", "sessions", "service"] and not args:
+            self.logger.error("The query '%s' requires a value to look up", self.config.query)
+            return 1
+        try:
+            since = parse_time(self.config.query_since)
+            until = parse_time(self.config.query_until)
+        except ValueError as e:
+            self.logger.error("Invalid time: %s", e)
+            return 1
+
+        query = EventQuery(db_engine)
+        limit = self.config.query_limit
+        if self.config.query == "session":
+            session = query.session(args[0], limit=limit)
+            results = [session] if session else []
+        elif self.config.query == "source":
+            results = query.events_by_source(args[0], since, until, limit)
+        elif self.config.query == "sessions":
+            results = query.sessions_by_source(args[0], since, until, limit)
+        elif self.config.query == "service":
+            event = args[1] if len(args) > 1 else None
+            results = query.events_by_service(args[0], event, since, until, limit)
+        elif self.config.query == "targets":
+            results = query.top_targets(since, until, limit)
+        else:
+            results = query.event_counts(args[0] if args else None, since, until)
+        for result in results:
+            sys.stdout.write(json_dumps(result) + "\n")
+        return 0
 
     def run(self):
         """Launch the configured and enabled services"""
 
+        if self.sketches:
+            spawn(self.write_sketches_periodically)
         self.logger.info("Starting consuming feeds")
         try:
             self.feed_manager.consume_events(self.output)
@@ -119,13 +321,20 @@ class HoneySAPEater(Loggeable):
     def stop(self):
         """Stop all running services and feeds"""
         self.feed_manager.stop()
+        self.stopped.set()
         for output in self.outputs:
             output.close()
+        if self.sketches:
+            self.sketches.write_snapshot(self.eater_sketches_filename)
 
     def output(self, event):
         """Output an event according to the outputs defined for the eater. Each
-        output is a file-like object."""
+        output is a buffered writer, flushed periodically."""
+        line = event if isinstance(event, bytes) else str(event)
+        if isinstance(line, text_type):
+            line = line.encode("utf-8")
+        line += b"\n"
         for output in self.outputs:
-            output.write(str(event))
-            output.write("\n")
-            output.flush()
+            output.write(line)
+        if self.sketches:
+            self.sketches.add(json_loads(line))
@@ -16,25 +16,65 @@
 #
 
 # Standard imports
-import json
-from base64 import b64encode
+from time import time as now, mktime
+from base64 import b64encode, b64decode
 from datetime import datetime
 # External imports
 
 # Custom imports
 
+# Optional imports
+try:
+    from orjson import dumps as orjson_dumps, loads as json_loads
+
+    def json_dumps(obj):
+        return orjson_dumps(obj).decode("utf-8")
+except ImportError:
+    try:
+        from ujson import dumps as json_dumps, loads as json_loads
+    except ImportError:
+        from json import dumps as json_dumps, loads as json_loads
+
 
 class Event(object):
-    """An object representing an attack session event"""
+    """An object representing an attack session event. The JSON
+    representation of the event is built on first use and cached until one
+    of the event's fields is assigned again. The time of the event is stored
+    as seconds since the epoch and available as a datetime in `timestamp`.
+    """
+
+    __slots__ = ("event", "data", "request", "response", "payloads",
+                 "session", "time", "_repr")
+
+    serialized_fields = ("event", "data", "request", "response", "payloads",
+                         "session", "time")
 
     def __init__(self, event, data=None, request=None, response=None,
-                 session=None):
-        self.event = event
-        self.data = data
-        self.request = request
-        self.response = response
-        self.session = session
-        self.timestamp = datetime.now()
+                 session=None, time=None):
+        # Set the fields directly, there's no cached representation yet
+        init = object.__setattr__
+        init(self, "_repr", None)
+        init(self, "event", event)
+        init(self, "data", data)
+        init(self, "request", request)
+        init(self, "response", response)
+        init(self, "payloads", None)
+        init(self, "session", session)
+        init(self, "time", now() if time is None else time)
+
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self.time)
+
+    @timestamp.setter
+    def timestamp(self, value):
+        self.time = mktime(value.timetuple()) + value.microsecond / 1e6
+
+    def __setattr__(self, name, value):
+        # Invalidate the cached representation if a field changes
+        if name in self.serialized_fields:
+            object.__setattr__(self, "_repr", None)
+        object.__setattr__(self, name, value)
 
     def __str__(self):
         if self.session is None:
@@ -42,16 +82,51 @@ class Event(object):
         return "<Event '%s' at %s in session '%s'>" % (self.event, self.timestamp, self.session.uuid)
 
     def __repr__(self):
-        if self.session is None:
-            raise Exception("Event not attached to a session")
-        return json.dumps({"session": str(self.session.uuid),
-                           "event": self.event,
-                           "data": self.data if self.data else "",
-                           "request": b64encode(self.request) if self.request else "",
-                           "response": b64encode(self.response) if self.response else "",
-                           "service": self.session.service,
-                           "source_ip": self.session.source_ip,
-                           "source_port": self.session.source_port,
-                           "target_ip": self.session.target_ip,
-                           "target_port": self.session.target_port,
-                           "timestamp": str(self.timestamp)})
+        if self._repr is None:
+            if self.session is None:
+                raise Exception("Event not attached to a session")
+            # Join the session's fields prefix with the event's fields
+            fields = {"event": self.event,
+                      "data": self.data if self.data else "",
+                      "request": b64encode(self.request) if self.request else "",
+                      "response": b64encode(self.response) if self.response else "",
+                      "timestamp": str(self.timestamp)}
+            # The digest and length of the payloads kept in a payload store
+            if self.payloads:
+                fields["payloads"] = self.payloads
+            fields = json_dumps(fields)
+            self._repr = "%s, %s" % (self.session.json_prefix, fields[1:])
+        return self._repr
+
+    @classmethod
+    def from_fields(cls, fields):
+        """Builds an event from the fields of its JSON representation. The
+        event is not attached to a session."""
+        # Parse the timestamp as formatted by str(datetime), faster than
+        # with strptime
+        timestamp = fields["timestamp"]
+        seconds = mktime((int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                          int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+                          0, 0, -1))
+        event = cls(fields["event"],
+                    data=fields["data"] or None,
+                    request=b64decode(fields["request"]) if fields["request"] else None,
+                    response=b64decode(fields["response"]) if fields["response"] else None,
+                    time=seconds + int(timestamp[20:26] or 0) / 1e6)
+        if fields.get("payloads"):
+            object.__setattr__(event, "payloads", fields["payloads"])
+        return event
+
+
+def route_target(service, name, data):
+    """Returns the target of a SAP router route request event as
+    "<host>:<port>", or None for other events. Other events carrying a target
+    host, like the ones of the forwarder, are not route requests."""
+    if service != "saprouter" or not name or not name.startswith("Route request") or \
+       not isinstance(data, dict):
+        return None
+    target = data.get("target_host") or data.get("target")
+    if not target:
+        return None
+    port = data.get("target_port") or data.get("port")
+    return "%s:%s" % (target, port) if port else target
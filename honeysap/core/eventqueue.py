@@ -0,0 +1,101 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+
+# External imports
+from gevent.queue import Empty, Full, Queue
+# Custom imports
+
+
+class EventQueue(Queue):
+    """A queue with an optional maximum size and a policy for handling
+    items put when the queue is full:
+
+    - `block`: blocks the producer until there's room in the queue, or until
+      the timeout expires and the item is dropped.
+    - `drop_oldest`: drops the oldest item in the queue to make room.
+    - `drop_newest`: drops the item being put.
+    - `sample`: keeps one of every `sample_rate` items put while the queue is
+      full, dropping the oldest item in the queue to make room for it, and
+      drops the rest.
+    """
+
+    OVERFLOW_BLOCK = "block"
+    OVERFLOW_DROP_OLDEST = "drop_oldest"
+    OVERFLOW_DROP_NEWEST = "drop_newest"
+    OVERFLOW_SAMPLE = "sample"
+
+    overflow_policies = (OVERFLOW_BLOCK,
+                         OVERFLOW_DROP_OLDEST,
+                         OVERFLOW_DROP_NEWEST,
+                         OVERFLOW_SAMPLE)
+
+    def __init__(self, maxsize=None, overflow=OVERFLOW_BLOCK, timeout=None,
+                 drop_callback=None, sample_rate=10):
+        if overflow not in self.overflow_policies:
+            raise ValueError("Invalid overflow policy '%s'" % overflow)
+        Queue.__init__(self, maxsize)
+        self.overflow = overflow
+        self.timeout = timeout
+        self.drop_callback = drop_callback
+        self.sample_rate = max(1, sample_rate)
+        self.overflowed = 0
+        self.dropped = 0
+
+    def put(self, item, block=True, timeout=None):
+        """Puts an item in the queue applying the overflow policy if the
+        queue is full."""
+        if self.overflow == self.OVERFLOW_BLOCK and block:
+            try:
+                Queue.put(self, item, True, timeout if timeout is not None else self.timeout)
+            except Full:
+                self.drop(item)
+        elif self.overflow == self.OVERFLOW_DROP_OLDEST:
+            while True:
+                try:
+                    Queue.put(self, item, False)
+                    break
+                except Full:
+                    try:
+                        self.drop(Queue.get(self, False))
+                    except Empty:
+                        pass
+        elif self.overflow == self.OVERFLOW_SAMPLE:
+            try:
+                Queue.put(self, item, False)
+            except Full:
+                self.overflowed += 1
+                if self.overflowed % self.sample_rate:
+                    self.drop(item)
+                    return
+                try:
+                    self.drop(Queue.get(self, False))
+                except Empty:
+                    pass
+                Queue.put(self, item, False)
+        else:
+            try:
+                Queue.put(self, item, False)
+            except Full:
+                self.drop(item)
+
+    def drop(self, item):
+        """Accounts for an item dropped from the queue."""
+        self.dropped += 1
+        if self.drop_callback is not None:
+            self.drop_callback(item)
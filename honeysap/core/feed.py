@@ -16,14 +16,22 @@
 #
 
 # Standard imports
-from threading import Event
+from time import time
+from collections import deque, OrderedDict
 from abc import abstractmethod, ABCMeta
 # External imports
-from gevent import spawn
+from gevent import spawn, sleep
+from gevent.event import Event
 from gevent.queue import Empty, Queue
 # Custom imports
+from .spool import Spool
+from .stage import load_stages
+from .routing import EventRouter
+from .payload import PayloadStore, payload_event, build_payload_event
 from .logger import Loggeable
 from .loader import ClassLoader
+from .session import load_event, dump_event
+from .eventqueue import EventQueue
 
 
 class BaseFeed(Loggeable):
@@ -32,6 +40,27 @@ class BaseFeed(Loggeable):
 
     __metaclass__ = ABCMeta
 
+    @property
+    def alias(self):
+        return self.config.get("alias", self.__class__.__name__)
+
+    @property
+    def queue_size(self):
+        return self.config.get("queue_size", 10000)
+
+    @property
+    def queue_overflow(self):
+        return self.config.get("queue_overflow", EventQueue.OVERFLOW_BLOCK)
+
+    #: Seconds to wait for the queued events to be delivered when stopping
+    @property
+    def queue_drain_timeout(self):
+        return self.config.get("queue_drain_timeout", 5.0)
+
+    @property
+    def routes(self):
+        return self.config.get("routes", None)
+
     def __init__(self, config):
         """Initialize the attack session feed with the options provided.
         """
@@ -48,6 +77,16 @@ class BaseFeed(Loggeable):
         """Close the feed"""
         pass
 
+    def stats(self):
+        """Returns a dict with the counters of the feed"""
+        return {}
+
+    def unflushed(self):
+        """Returns the number of logged events the feed still keeps in
+        memory, not yet written, sent or discarded. Events are expected to
+        leave the feed in the order they were logged."""
+        return 0
+
     @abstractmethod
     def log(self, event):
         """Log an event in the attack session feed"""
@@ -59,26 +98,302 @@ class BaseFeed(Loggeable):
         pass
 
 
+class FeedWorker(Loggeable):
+    """Worker delivering the events queued for a feed on its own greenlet, so
+    a slow feed doesn't delay the delivery of events to the other ones. If a
+    spool reader is provided, events are read from the spool instead, and
+    acknowledged once the feed no longer keeps them in memory, so the ones
+    buffered by the feed are delivered again if the process dies.
+
+    If a payload store is provided, the worker keeps track of the payloads
+    delivered to its feed, and delivers the payload event carrying one
+    before the first event referencing it that is routed to the feed, even
+    if the payload was first seen on an event routed to other feeds.
+    """
+
+    spool_batch = 1000
+
+    def __init__(self, feed, reader=None, name=None, payloads=None):
+        """Initialize the worker with a queue for the feed."""
+        self.feed = feed
+        self.name = name or feed.alias
+        self.reader = reader
+        self.payloads = payloads
+        self.queue = EventQueue(feed.queue_size, feed.queue_overflow)
+        # Set when there are no queued events left to deliver
+        self.drained = Event()
+        self.drained.set()
+        # Events read from the spool are routed by the worker itself
+        self.router = None
+        if reader is not None:
+            self.router = EventRouter()
+            self.router.add(self, feed.routes)
+        self.greenlet = None
+        # Payload events preceding the next event, routed along with the
+        # event referencing them
+        self.payload_events = []
+        # Digests of the payloads delivered to the feed, bounded as the
+        # index of the payload store
+        self.delivered_payloads = OrderedDict()
+        # Offsets of the spooled events along with the number of events
+        # processed up to them, waiting for the feed to flush them
+        self.unacked = deque()
+        self.processed = 0
+        self.failed = 0
+        self.lag = 0.0
+        self.lag_max = 0.0
+        self.logger_name = "FeedWorker_%s" % self.name
+
+    def put(self, event):
+        """Queue an event for the feed along with the time it was queued."""
+        self.drained.clear()
+        self.queue.put((time(), event))
+
+    def run(self):
+        """Start delivering events to the feed."""
+        if self.reader is None:
+            self.greenlet = spawn(self.process_events)
+        else:
+            self.greenlet = spawn(self.process_spool)
+
+    def stop(self):
+        """Stop delivering events, waiting for the queued ones to be
+        delivered, and stop the feed."""
+        if self.greenlet is not None:
+            if self.reader is None:
+                self.drained.wait(self.feed.queue_drain_timeout)
+                if self.queue.qsize():
+                    self.logger.warning("Discarding %d events not delivered in %.1f seconds",
+                                        self.queue.qsize(), self.feed.queue_drain_timeout)
+            self.greenlet.kill()
+        self.feed.stop()
+        if self.reader is not None:
+            self.ack()
+
+    def process_events(self):
+        """Deliver the events in the queue to the feed."""
+        while True:
+            queued_on, event = self.queue.get()
+            if event.event == payload_event:
+                self.payload_events.append(event)
+            else:
+                self.deliver_event(event, queued_on)
+            if not self.queue.qsize():
+                self.drained.set()
+
+    def process_spool(self):
+        """Deliver the events in the spool to the feed, starting from the
+        last acknowledged one."""
+        while True:
+            records = self.reader.read(self.spool_batch)
+            if not records:
+                self.ack()
+                self.reader.wait(1.0)
+                continue
+            for record, offset in records:
+                try:
+                    event = load_event(record)
+                except Exception:
+                    self.failed += 1
+                    self.logger.exception("Invalid spooled event at offset %d", offset)
+                else:
+                    if event.event == payload_event:
+                        # Not acknowledged until the event referencing it
+                        self.payload_events.append(event)
+                        continue
+                    if self.router.route(event):
+                        self.deliver_event(event, event.time)
+                    self.payload_events = []
+                if self.unacked and self.unacked[-1][0] == self.processed:
+                    self.unacked[-1] = (self.processed, offset)
+                else:
+                    self.unacked.append((self.processed, offset))
+            self.ack()
+
+    def ack(self):
+        """Acknowledges the spooled events up to the ones the feed still
+        keeps in memory."""
+        flushed = self.processed - self.feed.unflushed()
+        offset = None
+        while self.unacked and self.unacked[0][0] <= flushed:
+            offset = self.unacked.popleft()[1]
+        if offset is not None:
+            self.reader.ack(offset)
+
+    def deliver_event(self, event, queued_on):
+        """Deliver an event to the feed, preceded by the payload events it
+        references that weren't delivered to the feed yet."""
+        held = dict((payload.data["digest"], payload) for payload in self.payload_events)
+        self.payload_events = []
+        if self.payloads is not None:
+            for field in ("request", "response"):
+                reference = (event.payloads or {}).get(field)
+                if not reference:
+                    continue
+                digest = reference["digest"]
+                if digest in self.delivered_payloads:
+                    del self.delivered_payloads[digest]
+                else:
+                    payload = held.get(digest) or self.load_payload(event, field, reference)
+                    if payload is None:
+                        continue
+                    self.deliver(payload, queued_on)
+                self.delivered_payloads[digest] = True
+                if len(self.delivered_payloads) > self.payloads.index_size:
+                    self.delivered_payloads.popitem(last=False)
+        self.deliver(event, queued_on)
+
+    def load_payload(self, event, field, reference):
+        """Builds the payload event for a payload first seen on an event not
+        routed to the feed, or returns None if it's no longer in the store."""
+        data = self.payloads.get(reference["digest"])
+        if data is None:
+            self.logger.warning("Payload %s no longer in the payload store", reference["digest"])
+            return None
+        return build_payload_event(event, field, reference["digest"], data)
+
+    def deliver(self, event, queued_on):
+        """Deliver an event to the feed."""
+        lag = time() - queued_on
+        self.lag += lag
+        self.lag_max = max(self.lag_max, lag)
+        # If the feed fails, log the exception and continue with the
+        # next event
+        try:
+            self.feed.log(event)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            self.logger.exception("Feed failed at processing event '%s'" % event)
+
+    def stats(self):
+        """Returns the counters of the worker and its feed."""
+        delivered = self.processed + self.failed
+        if self.reader is None:
+            queued = self.queue.qsize()
+        else:
+            queued = self.reader.spool.flushed_offset - self.reader.offset
+        stats = {"queued": queued,
+                 "dropped": self.queue.dropped,
+                 "processed": self.processed,
+                 "failed": self.failed,
+                 "lag_avg": self.lag / delivered if delivered else 0.0,
+                 "lag_max": self.lag_max}
+        stats.update(self.feed.stats())
+        return stats
+
+
 class FeedManager(Loggeable):
     """ Feed manager class
     """
 
     feeds_path = "honeysap/feeds"
 
+    @property
+    def spool_directory(self):
+        return self.config.get("spool_directory", None)
+
+    @property
+    def spool_segment_size(self):
+        return self.config.get("spool_segment_size", 67108864)
+
+    @property
+    def spool_fsync(self):
+        return self.config.get("spool_fsync", Spool.FSYNC_INTERVAL)
+
+    @property
+    def spool_fsync_interval(self):
+        return self.config.get("spool_fsync_interval", 1.0)
+
+    @property
+    def spool_commit_interval(self):
+        return self.config.get("spool_commit_interval", 1.0)
+
+    @property
+    def payload_store(self):
+        return self.config.get("payload_store", False)
+
+    @property
+    def payload_store_directory(self):
+        return self.config.get("payload_store_directory", None)
+
+    @property
+    def payload_store_cache_size(self):
+        return self.config.get("payload_store_cache_size", 10000)
+
+    @property
+    def payload_store_index_size(self):
+        return self.config.get("payload_store_index_size", 100000)
+
+    @property
+    def payload_store_pack_size(self):
+        return self.config.get("payload_store_pack_size", 67108864)
+
+    @property
+    def payload_store_min_size(self):
+        return self.config.get("payload_store_min_size", 64)
+
+    @property
+    def stages_flush_interval(self):
+        return self.config.get("stages_flush_interval", 1.0)
+
     def __init__(self, config, session_manager):
         """Initialize the feed manager.
         """
         self.config = config
         self.feeds = []
+        self.workers = []
+        self.stages = []
+        self.router = EventRouter()
         self.stopped = Event()
+        self.greenlets = []
         self.session_manager = session_manager
+
+        # Spool the events on disk before delivering them to the feeds if
+        # a spool directory was configured
+        self.spool = None
+        if self.spool_directory:
+            self.spool = Spool(self.spool_directory,
+                               segment_size=self.spool_segment_size,
+                               fsync=self.spool_fsync,
+                               fsync_interval=self.spool_fsync_interval)
+
+        # Deliver the payloads only the first time they're seen if the
+        # payload store is enabled
+        self.payloads = None
+        if self.payload_store:
+            self.payloads = PayloadStore(self.payload_store_directory,
+                                         cache_size=self.payload_store_cache_size,
+                                         pack_size=self.payload_store_pack_size,
+                                         index_size=self.payload_store_index_size)
         self.logger.debug("Feeds manager initialized")
 
     def add_feed(self, feed):
         """Add a feed processor to the feed manager."""
         self.feeds.append(feed)
+        # Feeds with the same alias get a suffix, as the name identifies
+        # their counters and spool cursor
+        names = set(worker.name for worker in self.workers)
+        name, index = feed.alias, 1
+        while name in names:
+            index += 1
+            name = "%s_%d" % (feed.alias, index)
+        reader = self.spool.reader(name) if self.spool else None
+        worker = FeedWorker(feed, reader, name, self.payloads)
+        self.workers.append(worker)
+        self.router.add(worker, feed.routes)
         self.logger.debug("Added feed %s to feed manager", feed._logger_name)
 
+    def add_stage(self, stage):
+        """Add a stage at the end of the event processing pipeline."""
+        self.stages.append(stage)
+        self.logger.debug("Added stage %s to feed manager", stage.alias)
+
+    def load_stages(self):
+        """Loads all the stages in the configuration."""
+        for stage in load_stages(self.config):
+            self.add_stage(stage)
+
     def load_feeds(self):
         """Loads all the feeds in the configuration."""
 
@@ -99,33 +414,127 @@ class FeedManager(Loggeable):
 
     def run(self):
         """Start the feed manager by processing events in the session manager."""
-        spawn(self.process_events)
+        for worker in self.workers:
+            worker.run()
+        self.greenlets = [spawn(self.process_events)]
+        if self.stages:
+            self.greenlets.append(spawn(self.flush_stages_periodically))
+        if self.spool:
+            self.greenlets.append(spawn(self.commit_spool_periodically))
 
     def stop(self):
         """Stop the feed manager processing and all the feeds attached."""
         if not self.stopped.is_set():
-            for feed in self.feeds:
-                feed.stop()
+            # Stop processing events before the workers drain their queues,
+            # and pass on the events still queued and the ones held back by
+            # the stages
             self.stopped.set()
+            for greenlet in self.greenlets:
+                greenlet.kill()
+            event_queue = self.session_manager.event_queue
+            while not event_queue.empty():
+                self.publish(self.run_stages([event_queue.get_nowait()]))
+            for index, stage in enumerate(self.stages):
+                self.publish(self.run_stages(stage.stop(), index + 1))
+            for worker in self.workers:
+                worker.stop()
+            if self.spool:
+                self.spool.close()
+            if self.payloads:
+                self.payloads.close()
 
     def process_events(self):
-        """Process events on the session manager event queue."""
+        """Process events on the session manager event queue by handing them
+        to the worker of each feed."""
         while not self.stopped.is_set():
             try:
                 # Obtain the next event to process
                 event = self.session_manager.event_queue.get()
                 self.logger.debug("Processing event '%s'", event)
-                for feed in self.feeds:
-                    # Try to process the event with all the feeds. If a feed
-                    # fails, log the exception and continue with the rest of
-                    # the feeds
-                    try:
-                        feed.log(event)
-                    except Exception as e:
-                        self.logger.exception("Feed failed at processing event '%s'" % event)
+                self.publish(self.run_stages([event]))
             except Empty:
                 pass
 
+    def run_stages(self, events, start=0):
+        """Runs a list of events through the stages, starting at a given
+        stage. Returns the events passed on by the last stage."""
+        for stage in self.stages[start:]:
+            events = [processed for event in events
+                      for processed in stage.process(event)]
+        return events
+
+    def flush_stages(self, now=None):
+        """Runs the events held back by each stage through the following
+        stages and publishes them."""
+        now = time() if now is None else now
+        for index, stage in enumerate(self.stages):
+            events = stage.flush(now)
+            if events:
+                self.publish(self.run_stages(events, index + 1))
+
+    def flush_stages_periodically(self):
+        """Flushes the stages periodically."""
+        while not self.stopped.is_set():
+            sleep(self.stages_flush_interval)
+            try:
+                self.flush_stages()
+            except Exception:
+                self.logger.exception("Failed to flush the stages")
+
+    def publish(self, events):
+        """Publishes a list of events to the feeds, replacing their payloads
+        by their digests if the payload store is enabled."""
+        for event in events:
+            if self.payloads:
+                stored = self.payloads.process(event, self.payload_store_min_size)
+                self.dispatch(stored[-1], stored[:-1])
+            else:
+                self.dispatch(event)
+
+    def dispatch(self, event, payloads=()):
+        """Hands an event to the spool or to the worker of each feed the
+        event is routed to, preceded by the payload events it references,
+        which are routed along with it."""
+        if self.spool:
+            for payload in payloads:
+                self.spool_event(payload)
+            self.spool_event(event)
+        else:
+            for worker in self.router.route(event):
+                for payload in payloads:
+                    worker.put(payload)
+                worker.put(event)
+
+    def spool_event(self, event):
+        """Appends an event to the spool, flushing it when there are no more
+        events to process or enough events are pending."""
+        self.spool.append(dump_event(event))
+        if self.session_manager.event_queue.empty() or \
+           self.spool.offset - self.spool.flushed_offset >= self.spool.flush_size:
+            self.spool.flush()
+
+    def commit_spool_periodically(self):
+        """Persists the cursors of the feeds and recycles the segments
+        already delivered."""
+        while not self.stopped.is_set():
+            sleep(self.spool_commit_interval)
+            try:
+                self.spool.flush()
+                self.spool.commit()
+            except Exception:
+                self.logger.exception("Failed to commit the spool")
+
+    def stats(self):
+        """Returns the counters of each feed."""
+        stats = {worker.name: worker.stats() for worker in self.workers}
+        if self.spool:
+            stats["spool"] = self.spool.stats()
+        if self.payloads:
+            stats["payload_store"] = self.payloads.stats()
+        if self.stages:
+            stats["stages"] = {stage.alias: stage.stats() for stage in self.stages}
+        return stats
+
     def consume_events(self, callback):
         """Consume events in a feed."""
 
@@ -16,15 +16,22 @@
 #
 
 # Standard imports
+import os
 import sys
 import logging
-from optparse import OptionGroup
+from signal import SIGTERM
+from os.path import join
+from tempfile import gettempdir
+from optparse import OptionGroup, SUPPRESS_HELP
 # External imports
 from gevent.monkey import patch_all; patch_all()  # @IgnorePep8
+from gevent import spawn, signal
 # Custom imports
 from .feed import FeedManager
-from .session import SessionManager
-from .service import ServiceManager
+from .workers import WorkerSupervisor
+from .ipc import IPCServer, IPCClient
+from .session import SessionManager, load_event, dump_event
+from .service import ServiceManager, SO_REUSEPORT
 from .datastore import DataStoreManager
 from .config import ConfigurationParserFromFile
 from .logger import (Loggeable, default_formatter, colored_formatter)
@@ -34,6 +41,28 @@ class HoneySAP(Loggeable):
 
     default_config = "honeysap.yml"
 
+    #: Number of worker processes running the services, or 0 for running
+    #: everything in a single process
+    @property
+    def workers(self):
+        return self.config.get("workers", 0)
+
+    #: Unix socket used by the workers for sending events to the main
+    #: process, by default a file named after the main process' pid
+    @property
+    def workers_socket(self):
+        pid = os.getpid() if self.config.worker is None else os.getppid()
+        return self.config.get("workers_socket",
+                               join(gettempdir(), "honeysap-%d.sock" % pid))
+
+    @property
+    def workers_restart_delay(self):
+        return self.config.get("workers_restart_delay", 1.0)
+
+    @property
+    def workers_backlog(self):
+        return self.config.get("workers_backlog", 100000)
+
     def main(self, argv=None):
         """Main function to run the program"""
         self.argv = argv
@@ -46,8 +75,19 @@ class HoneySAP(Loggeable):
         self.setup_logger()
         self.setup_datastore()
         self.setup_sessions()
-        self.setup_feeds()
-        self.setup_services()
+        if self.config.worker is not None:
+            # Worker process: run the services and send the events to the
+            # main process
+            self.setup_worker()
+            self.setup_services()
+        elif self.workers:
+            # Main process: receive the events and run the feeds, while the
+            # workers run the services
+            self.setup_feeds()
+            self.setup_supervisor()
+        else:
+            self.setup_feeds()
+            self.setup_services()
 
     def get_configuration(self):
         """Pase configuration from command line and configuration file """
@@ -65,6 +105,11 @@ class HoneySAP(Loggeable):
                                  help="if the console should print logs for all namespaces (root logger) [default: %default]")
         parser.add_option_group(logging_group)
 
+        # Index of the worker process, only used by the main process when
+        # starting the workers
+        parser.add_option("--worker", dest="worker", type="int",
+                          default=None, help=SUPPRESS_HELP)
+
         self.config, __ = parser.parse_args(self.argv)
 
     def setup_logger(self):
@@ -108,6 +153,7 @@ class HoneySAP(Loggeable):
         """Setup attack session feeds configured."""
         self.logger.info("Setting up feeds")
         self.feed_manager = FeedManager(self.config, self.session_manager)
+        self.feed_manager.load_stages()
         self.feed_manager.load_feeds()
 
     def setup_services(self):
@@ -116,18 +162,98 @@ class HoneySAP(Loggeable):
         self.service_manager = ServiceManager(self.config, self.datastore, self.session_manager)
         self.service_manager.load_services()
 
+    def setup_worker(self):
+        """Setup a worker process, sharing the listeners of the services
+        with the other workers and sending the events to the main
+        process."""
+        self.logger.info("Setting up worker %d", self.config.worker)
+        self.config.update({"reuse_port": True})
+        self.event_sender = IPCClient(self.workers_socket,
+                                      max_backlog=self.workers_backlog)
+        self.event_sending = None
+        signal(SIGTERM, self.terminate_worker)
+
+    def terminate_worker(self):
+        """Stops the worker when terminated by the supervisor, sending the
+        pending events to the main process before exiting."""
+        self.logger.info("Stopping worker %d", self.config.worker)
+        self.stop()
+        sys.exit(0)
+
+    def setup_supervisor(self):
+        """Setup the supervisor of the worker processes and the server
+        receiving their events."""
+        if SO_REUSEPORT is None:
+            raise ValueError("Running workers requires SO_REUSEPORT, not available on this platform")
+        self.logger.info("Setting up %d workers", self.workers)
+        argv = sys.argv[1:] if self.argv is None else list(self.argv)
+        self.supervisor = WorkerSupervisor([sys.executable, sys.argv[0]] + argv,
+                                           self.workers,
+                                           restart_delay=self.workers_restart_delay)
+        self.event_receiver = IPCServer(self.workers_socket, self.receive_event)
+
+    def receive_event(self, frame):
+        """Queues an event received from a worker."""
+        self.session_manager.event_queue.put(load_event(frame))
+
+    def send_events(self):
+        """Sends the events of the worker's sessions to the main
+        process."""
+        while True:
+            event = self.session_manager.event_queue.get()
+            self.event_sender.send(dump_event(event))
+
     def run(self):
         """Launch the configured and enabled services"""
 
-        self.logger.info("Starting feed manager")
-        self.feed_manager.run()
+        if self.config.worker is None and self.workers:
+            return self.run_supervisor()
+
+        self.logger.info("Starting session manager")
+        self.session_manager.run()
+        if self.config.worker is None:
+            self.logger.info("Starting feed manager")
+            self.feed_manager.run()
+        else:
+            self.event_sender.run()
+            self.event_sending = spawn(self.send_events)
         self.logger.info("Starting services")
         try:
             self.service_manager.run()
         except KeyboardInterrupt:
             self.stop()
 
+    def run_supervisor(self):
+        """Launch the feeds and the worker processes"""
+
+        self.logger.info("Starting feed manager")
+        self.feed_manager.run()
+        self.event_receiver.start()
+        self.logger.info("Starting workers")
+        signal(SIGTERM, self.supervisor.stopped.set)
+        try:
+            self.supervisor.run()
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
     def stop(self):
         """Stop all running services and feeds"""
-        self.feed_manager.stop()
-        self.service_manager.stop()
+        self.session_manager.stop()
+        if self.config.worker is not None:
+            self.service_manager.stop()
+            # Hand the events still queued to the client and give it time to
+            # send them before the supervisor kills the worker
+            if self.event_sending is not None:
+                self.event_sending.kill()
+            event_queue = self.session_manager.event_queue
+            while not event_queue.empty():
+                self.event_sender.send(dump_event(event_queue.get_nowait()))
+            self.event_sender.stop(timeout=3.0)
+        elif self.workers:
+            self.supervisor.stop()
+            self.event_receiver.stop()
+            self.feed_manager.stop()
+        else:
+            self.feed_manager.stop()
+            self.service_manager.stop()
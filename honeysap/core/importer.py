@@ -0,0 +1,316 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import os
+import re
+import csv
+import json
+import gzip
+from io import BytesIO
+from time import time
+from hashlib import sha1
+from multiprocessing import cpu_count
+from datetime import datetime
+from os.path import exists, getsize, join
+# External imports
+from sqlalchemy import create_engine
+# Custom imports
+from .event import json_loads
+from .logger import Loggeable
+from ..feeds.dbfeed import Base, DBEvent
+
+# Optional imports
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def open_log(path):
+    """Opens a log file for reading, decompressing gzip and zstd files."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ValueError("Reading zstd files requires the zstandard library")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, "rb")
+
+
+def parse_timestamp(timestamp):
+    """Parses a timestamp as formatted by str(datetime), faster than with
+    strptime."""
+    return datetime(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                    int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+                    int(timestamp[20:26] or 0))
+
+
+session_re = re.compile(r'"session": "([^"]*)"')
+timestamp_re = re.compile(r'"timestamp": "([^"]*)"')
+
+
+def parse_line(line):
+    """Parses a line of a LogFeed file and returns the session, timestamp and
+    event to insert in the events table, or None if the line is not an
+    event."""
+    if line.startswith(b"{"):
+        event = line.rstrip(b"\r\n").decode("utf-8")
+    else:
+        # Lines in the legacy format are "<logger> - <time> - <level> - <event>"
+        parts = line.split(b" - ", 3)
+        if len(parts) < 4 or parts[2].rstrip() != b"EVENT":
+            return None
+        event = parts[3].rstrip(b"\r\n").decode("utf-8")
+
+    # Look for the session and timestamp fields without parsing the whole
+    # event, unless the event's data contains fields with the same names
+    sessions = session_re.findall(event)
+    timestamps = timestamp_re.findall(event)
+    if len(sessions) != 1 or len(timestamps) != 1:
+        fields = json_loads(event)
+        sessions, timestamps = [fields["session"]], [fields["timestamp"]]
+    return sessions[0], parse_timestamp(timestamps[0]), event
+
+
+class ImportUnit(object):
+    """A range of a log file imported by a worker, with its progress kept in
+    a checkpoint file. Compressed files are always imported as a whole, and
+    their offsets refer to the decompressed data.
+
+    Ranges of plain files have a fixed size and their checkpoints are keyed
+    by their start, so the last range of a log that kept growing since the
+    previous import is resumed from its offset instead of imported again.
+    """
+
+    def __init__(self, path, start=0, end=None, checkpoint_directory=None):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.offset = start
+        self.rows = 0
+        self.done = False
+        self.checkpoint_path = None
+        if checkpoint_directory:
+            key = "%s:%d" % (os.path.abspath(path), start)
+            self.checkpoint_path = join(checkpoint_directory,
+                                        sha1(key.encode("utf-8")).hexdigest() + ".json")
+            if exists(self.checkpoint_path):
+                with open(self.checkpoint_path) as fd:
+                    checkpoint = json.load(fd)
+                self.offset = checkpoint["offset"]
+                self.rows = checkpoint["rows"]
+                self.done = checkpoint["done"]
+
+    def __str__(self):
+        return "%s [%d-%s]" % (self.path, self.start, self.end if self.end is not None else "")
+
+    def checkpoint(self):
+        """Persists the progress of the unit."""
+        if self.checkpoint_path is None:
+            return
+        with open(self.checkpoint_path + ".tmp", "w") as fd:
+            json.dump({"path": self.path, "start": self.start, "end": self.end,
+                       "offset": self.offset, "rows": self.rows,
+                       "done": self.done}, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+    def lines(self):
+        """Yields the lines starting in the unit's range from the offset
+        reached, with the offset following each one."""
+        with open_log(self.path) as fd:
+            offset = self.offset
+            if self.end is not None:
+                # Plain files can be seeked, and a range not starting at the
+                # beginning of the file skips the line started before it
+                fd.seek(offset)
+                if offset == self.start and offset > 0:
+                    fd.seek(offset - 1)
+                    offset += len(fd.readline()) - 1
+            else:
+                # Skip the already imported decompressed data
+                while offset > 0:
+                    skipped = len(fd.read(min(offset, 1048576)))
+                    if not skipped:
+                        break
+                    offset -= skipped
+                offset = self.offset
+
+            for line in fd:
+                if self.end is not None and offset >= self.end:
+                    break
+                # Leave a line still being written for the next import
+                if self.end is not None and not line.endswith(b"\n"):
+                    break
+                offset += len(line)
+                yield line, offset
+
+    def completed(self):
+        """Returns if the whole range was imported. The range of a plain file
+        isn't complete until the file grows past its end."""
+        return self.end is None or self.offset >= self.end
+
+
+class LogImporter(Loggeable):
+    """Bulk importer of the events of LogFeed files into the events table of
+    the DBFeed.
+
+    Files are split in units of up to `split_size` bytes, aligned to lines,
+    imported in parallel by up to `workers` forked processes. Each worker
+    parses its unit and inserts the events in chunks of `chunk_size` rows
+    with a single multi-row insert, or with COPY on PostgreSQL, and persists
+    its progress after each chunk in the checkpoint directory. Importing
+    again the same files continues from the last chunk committed, so only
+    the events of a chunk being inserted when the import was interrupted can
+    be imported twice.
+    """
+
+    #: Placeholders for the positional parameter styles of DB-API drivers
+    placeholders = {"qmark": "?",
+                    "format": "%s"}
+
+    def __init__(self, db_engine, workers=None, chunk_size=10000,
+                 split_size=268435456, checkpoint_directory=None):
+        self.db_engine = db_engine
+        self.workers = workers or cpu_count()
+        self.chunk_size = chunk_size
+        self.split_size = split_size
+        self.checkpoint_directory = checkpoint_directory
+        if checkpoint_directory and not exists(checkpoint_directory):
+            os.makedirs(checkpoint_directory)
+
+    def units(self, paths):
+        """Splits the files in units of work."""
+        units = []
+        for path in paths:
+            if path.endswith((".gz", ".zst")):
+                units.append(ImportUnit(path, checkpoint_directory=self.checkpoint_directory))
+                continue
+            size = getsize(path)
+            for start in range(0, max(size, 1), self.split_size):
+                units.append(ImportUnit(path, start, start + self.split_size,
+                                        checkpoint_directory=self.checkpoint_directory))
+        return units
+
+    def run(self, paths):
+        """Imports the files, returning the number of units that failed."""
+        engine = create_engine(self.db_engine)
+        Base.metadata.create_all(engine)
+        engine.dispose()
+
+        units = [unit for unit in self.units(paths) if not unit.done]
+        self.logger.info("Importing %d units of %d files with %d workers",
+                         len(units), len(paths), self.workers)
+        start = time()
+        running = {}
+        failed = 0
+        while units or running:
+            while units and len(running) < self.workers:
+                unit = units.pop(0)
+                pid = os.fork()
+                if pid == 0:
+                    os._exit(self.run_worker(unit))
+                running[pid] = unit
+            pid, status = os.wait()
+            unit = running.pop(pid, None)
+            if unit is None:
+                continue
+            if status:
+                failed += 1
+                self.logger.error("Failed to import %s", unit)
+            else:
+                self.logger.debug("Imported %s", unit)
+        self.logger.info("Import finished in %.2f seconds, %d units failed",
+                         time() - start, failed)
+        return failed
+
+    def run_worker(self, unit):
+        """Imports a unit on a worker process and returns its exit code."""
+        try:
+            engine = create_engine(self.db_engine)
+            self.import_unit(engine, unit)
+            return 0
+        except Exception:
+            self.logger.exception("Failed to import %s", unit)
+            return 1
+
+    def import_unit(self, engine, unit):
+        """Imports the events of a unit in chunks, checkpointing after each
+        one."""
+        rows = []
+        for line, offset in unit.lines():
+            row = parse_line(line)
+            if row is not None:
+                rows.append(row)
+            if len(rows) >= self.chunk_size:
+                self.insert(engine, rows)
+                unit.offset, unit.rows = offset, unit.rows + len(rows)
+                unit.checkpoint()
+                rows = []
+            else:
+                unit.offset = offset
+        if rows:
+            self.insert(engine, rows)
+            unit.rows += len(rows)
+        unit.done = unit.completed()
+        unit.checkpoint()
+
+    def insert(self, engine, rows):
+        """Inserts a chunk of rows in a single transaction, with COPY on
+        PostgreSQL or with the driver's executemany if it accepts positional
+        parameters, skipping SQLAlchemy's per row processing."""
+        if engine.dialect.name == "postgresql":
+            self.copy(engine, rows)
+            return
+        placeholder = self.placeholders.get(engine.dialect.paramstyle)
+        if placeholder is None:
+            with engine.begin() as connection:
+                connection.execute(DBEvent.__table__.insert(),
+                                   [{"session": session, "timestamp": timestamp, "event": event}
+                                    for session, timestamp, event in rows])
+            return
+
+        # Convert the timestamps as SQLAlchemy would for the dialect
+        process = DBEvent.__table__.c.timestamp.type.bind_processor(engine.dialect)
+        if process is not None:
+            rows = [(session, process(timestamp), event) for session, timestamp, event in rows]
+        statement = "INSERT INTO %s (session, timestamp, event) VALUES (%s)" % \
+                    (DBEvent.__tablename__, ", ".join([placeholder] * 3))
+        connection = engine.raw_connection()
+        try:
+            connection.cursor().executemany(statement, rows)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def copy(self, engine, rows):
+        """Inserts a chunk of rows with COPY on PostgreSQL."""
+        buffer = BytesIO()
+        writer = csv.writer(buffer)
+        for session, timestamp, event in rows:
+            writer.writerow([session, timestamp.isoformat(), event.encode("utf-8")])
+        buffer.seek(0)
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.copy_expert("COPY %s (session, timestamp, event) FROM STDIN WITH CSV" %
+                               DBEvent.__tablename__, buffer)
+            connection.commit()
+        finally:
+            connection.close()
@@ -0,0 +1,349 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import os
+import errno
+from struct import Struct
+from collections import deque
+# External imports
+from gevent import socket
+from gevent import spawn, sleep
+from gevent.event import Event
+from gevent.server import StreamServer
+# Custom imports
+from .logger import Loggeable
+
+
+class IPCError(Exception):
+    """Raised when an invalid frame is received."""
+
+
+#: Header of each frame, with the length of the payload
+frame_header = Struct("!I")
+
+#: Acknowledgement of the number of frames received on a connection
+ack_header = Struct("!Q")
+
+
+def parse_address(address):
+    """Parses an IPC address, either a Unix socket path as "unix:<path>" or
+    "<path>", or a TCP address as "<host>:<port>". Returns the socket family
+    and address."""
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[5:]
+    if "/" in address:
+        return socket.AF_UNIX, address
+    host, __, port = address.rpartition(":")
+    try:
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    except ValueError:
+        raise IPCError("Invalid address '%s'" % address)
+
+
+def pack_frames(payloads):
+    """Packs a list of payloads as length-prefixed frames."""
+    return b"".join(frame_header.pack(len(payload)) + payload
+                    for payload in payloads)
+
+
+class FrameReader(object):
+    """Splits a stream of data into length-prefixed frames. The chunks
+    received are kept apart until the next frame is complete, so a large
+    frame arriving in many chunks is joined only once."""
+
+    def __init__(self, max_size=16777216):
+        self.max_size = max_size
+        self.chunks = []
+        self.pending = 0
+        # Bytes needed for completing the next frame, or its header if the
+        # length isn't known yet
+        self.needed = frame_header.size
+
+    def feed(self, data):
+        """Adds data received and returns the frames completed."""
+        self.chunks.append(data)
+        self.pending += len(data)
+        if self.pending < self.needed:
+            return []
+
+        buffer = b"".join(self.chunks)
+        frames = []
+        offset = 0
+        while True:
+            available = len(buffer) - offset
+            if available < frame_header.size:
+                self.needed = frame_header.size
+                break
+            length, = frame_header.unpack_from(buffer, offset)
+            if length > self.max_size:
+                raise IPCError("Frame of %d bytes exceeds the maximum size" % length)
+            if available < frame_header.size + length:
+                self.needed = frame_header.size + length
+                break
+            offset += frame_header.size
+            frames.append(buffer[offset:offset + length])
+            offset += length
+        rest = buffer[offset:]
+        self.chunks = [rest] if rest else []
+        self.pending = len(rest)
+        return frames
+
+
+def listen(address, backlog=128):
+    """Creates a listening socket for an IPC address, removing a stale Unix
+    socket file if present."""
+    family, address = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX:
+        try:
+            os.unlink(address)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    else:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+def connect(address, timeout=None):
+    """Connects to an IPC address."""
+    family, address = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+    except socket.error:
+        sock.close()
+        raise
+    sock.settimeout(None)
+    return sock
+
+
+class IPCServer(Loggeable):
+    """Receives frames from IPC clients and hands each one to a handler,
+    serving each client on its own greenlet. If acknowledgements are
+    enabled, the number of frames handled on the connection is sent back to
+    the client after each read."""
+
+    def __init__(self, address, handler, acks=False, max_size=16777216,
+                 buffer_size=65536):
+        self.address = address
+        self.handler = handler
+        self.acks = acks
+        self.max_size = max_size
+        self.buffer_size = buffer_size
+        self.server = None
+        self.connections = set()
+        self.received = 0
+
+    def start(self):
+        self.server = StreamServer(listen(self.address), self.handle)
+        self.server.start()
+        self.logger.debug("Listening for frames on '%s'", self.address)
+
+    def serve_forever(self):
+        self.start()
+        self.server.serve_forever()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+            # Shutdown the connections so their handlers finish
+            for sock in list(self.connections):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            family, address = parse_address(self.address)
+            if family == socket.AF_UNIX and os.path.exists(address):
+                os.unlink(address)
+
+    def handle(self, sock, address):
+        """Reads frames from a client until it disconnects."""
+        reader = FrameReader(self.max_size)
+        received = 0
+        self.connections.add(sock)
+        try:
+            while True:
+                data = sock.recv(self.buffer_size)
+                if not data:
+                    break
+                frames = reader.feed(data)
+                for frame in frames:
+                    self.handle_frame(frame)
+                received += len(frames)
+                self.received += len(frames)
+                if self.acks and frames:
+                    sock.sendall(ack_header.pack(received))
+        except (socket.error, IPCError) as e:
+            self.logger.warning("Closing IPC connection: %s", e)
+        finally:
+            self.connections.discard(sock)
+            sock.close()
+
+    def handle_frame(self, frame):
+        try:
+            self.handler(frame)
+        except Exception:
+            self.logger.exception("Failed to handle frame")
+
+    def stats(self):
+        return {"connections": len(self.connections),
+                "received": self.received}
+
+
+class IPCClient(Loggeable):
+    """Sends frames to an IPC server from a greenlet. Frames are kept in a
+    bounded backlog while the server is not reachable, dropping the oldest
+    ones when it's full, and sent in batches once connected.
+
+    If acknowledgements are enabled, up to max_inflight frames are sent
+    without being acknowledged by the server. Frames not acknowledged when
+    the connection fails are sent again on the next one, so frames are
+    delivered at least once.
+    """
+
+    def __init__(self, address, max_backlog=100000, batch_size=1000,
+                 reconnect_delay=1.0, acks=False, max_inflight=10000):
+        self.address = address
+        self.max_backlog = max_backlog
+        self.batch_size = batch_size
+        self.reconnect_delay = reconnect_delay
+        self.acks = acks
+        self.max_inflight = max_inflight
+        self.backlog = deque()
+        self.inflight = deque()
+        self.pending = Event()
+        self.sock = None
+        self.greenlet = None
+        self.sent = 0
+        self.acked = 0
+        self.dropped = 0
+        self.reconnects = 0
+
+    def send(self, payload):
+        """Queues a payload to be sent."""
+        self.backlog.append(payload)
+        if len(self.backlog) > self.max_backlog:
+            self.backlog.popleft()
+            self.dropped += 1
+        self.pending.set()
+
+    def run(self):
+        self.greenlet = spawn(self.send_frames)
+
+    def stop(self, timeout=1.0):
+        """Tries to send the frames in the backlog and stops the client."""
+        if self.greenlet is not None:
+            waited = 0.0
+            while (self.backlog or self.inflight) and self.sock is not None and \
+                    waited < timeout:
+                sleep(0.05)
+                waited += 0.05
+            self.greenlet.kill()
+        self.disconnect()
+
+    def connect(self):
+        self.sock = connect(self.address)
+        self.logger.debug("Connected to '%s'", self.address)
+        if self.acks:
+            spawn(self.read_acks, self.sock)
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def connection_lost(self, sock, error):
+        """Closes a failed connection, keeping the frames not acknowledged to
+        be sent again."""
+        if sock is not self.sock:
+            return
+        self.logger.warning("Connection to '%s' failed: %s", self.address, error)
+        self.backlog.extendleft(reversed(self.inflight))
+        self.inflight.clear()
+        self.disconnect()
+        self.reconnects += 1
+        self.pending.set()
+
+    def send_frames(self):
+        """Sends the frames in the backlog in batches, reconnecting to the
+        server when the connection fails."""
+        while True:
+            if not self.backlog or (self.acks and len(self.inflight) >= self.max_inflight):
+                self.pending.clear()
+                self.pending.wait()
+                continue
+            if self.sock is None:
+                try:
+                    self.connect()
+                except socket.error as e:
+                    self.logger.debug("Unable to connect to '%s': %s", self.address, e)
+                    sleep(self.reconnect_delay)
+                    continue
+
+            count = min(self.batch_size, len(self.backlog))
+            if self.acks:
+                count = min(count, self.max_inflight - len(self.inflight))
+            batch = [self.backlog.popleft() for __ in range(count)]
+            if self.acks:
+                self.inflight.extend(batch)
+            sock = self.sock
+            try:
+                sock.sendall(pack_frames(batch))
+                self.sent += len(batch)
+            except socket.error as e:
+                if not self.acks:
+                    # Keep the batch for the next connection
+                    self.backlog.extendleft(reversed(batch))
+                self.connection_lost(sock, e)
+                sleep(self.reconnect_delay)
+
+    def read_acks(self, sock):
+        """Reads the acknowledgements of a connection, releasing the frames
+        acknowledged."""
+        buffer = b""
+        acked = 0
+        try:
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    raise socket.error("Connection closed by the server")
+                buffer += data
+                count = len(buffer) // ack_header.size
+                if not count:
+                    continue
+                received, = ack_header.unpack_from(buffer, (count - 1) * ack_header.size)
+                buffer = buffer[count * ack_header.size:]
+                for __ in range(received - acked):
+                    self.inflight.popleft()
+                self.acked += received - acked
+                acked = received
+                self.pending.set()
+        except socket.error as e:
+            self.connection_lost(sock, e)
+
+    def stats(self):
+        return {"backlog": len(self.backlog),
+                "inflight": len(self.inflight),
+                "sent": self.sent,
+                "acked": self.acked,
+                "dropped": self.dropped,
+                "reconnects": self.reconnects}
@@ -0,0 +1,226 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import os
+from struct import Struct
+from collections import OrderedDict
+from os.path import exists, join, getsize
+# External imports
+# Custom imports
+from .event import Event
+from .logger import Loggeable
+
+# Optional imports
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+if blake2b is None:
+    from hashlib import sha256
+
+    hash_algorithm = "sha256"
+
+    def hash_payload(data):
+        return sha256(data).hexdigest()
+else:
+    hash_algorithm = "blake2b"
+
+    def hash_payload(data):
+        return blake2b(data, digest_size=32).hexdigest()
+
+
+# Name of the events carrying the payloads seen for the first time
+payload_event = "Payload"
+
+
+def build_payload_event(event, field, digest, data):
+    """Returns the event carrying a payload of an event in the given field,
+    along with its digest and length."""
+    payload = Event(payload_event, data={"digest": digest, "length": len(data)},
+                    session=event.session, time=event.time)
+    setattr(payload, field, data)
+    return payload
+
+
+class PayloadStore(Loggeable):
+    """Content-addressed store of request and response payloads.
+
+    Payloads are identified by their digest, prefixed by the hash algorithm
+    used. The most recently seen payloads are kept in memory and, if a
+    directory is given, all of them are appended to pack files so they can
+    be retrieved later. Packs are scanned when the store is opened to
+    rebuild the index of stored payloads.
+
+    The index keeps only the `index_size` most recently seen digests, along
+    with their location on the packs. A payload not seen for longer is
+    considered new again, so it's appended again to the packs and its
+    digest delivered again, and its previous copy can't be retrieved with
+    `get` until it's seen again.
+    """
+
+    header = Struct("!80sI")
+    pack_suffix = ".pack"
+
+    def __init__(self, directory=None, cache_size=10000, pack_size=67108864,
+                 index_size=100000):
+        self.directory = directory
+        self.cache_size = cache_size
+        self.pack_size = pack_size
+        self.index_size = index_size
+        self.cache = OrderedDict()
+        self.index = OrderedDict()
+        self.pack = None
+        self.stored = 0
+        self.deduplicated = 0
+        self.bytes_saved = 0
+
+        if directory:
+            if not exists(directory):
+                os.makedirs(directory)
+            packs = sorted(int(filename[:-len(self.pack_suffix)])
+                           for filename in os.listdir(directory)
+                           if filename.endswith(self.pack_suffix))
+            for number in packs:
+                self.load_pack(number)
+            self.open_pack(packs[-1] if packs else 0)
+            self.logger.debug("Payload store opened at '%s' with %d payloads",
+                              directory, len(self.index))
+
+    def pack_path(self, number):
+        return join(self.directory, "%08d%s" % (number, self.pack_suffix))
+
+    def open_pack(self, number):
+        """Opens a pack for appending payloads."""
+        self.pack_number = number
+        self.pack = open(self.pack_path(number), "ab")
+        self.pack.seek(0, os.SEEK_END)
+
+    def load_pack(self, number):
+        """Adds the payloads of a pack to the index, truncating any partially
+        written payload at its end."""
+        path = self.pack_path(number)
+        size = getsize(path)
+        offset = 0
+        with open(path, "rb") as fd:
+            while offset + self.header.size <= size:
+                digest, length = self.header.unpack(fd.read(self.header.size))
+                if offset + self.header.size + length > size:
+                    break
+                self.remember(digest.rstrip(b"\x00").decode("ascii"),
+                              (number, offset + self.header.size, length))
+                offset += self.header.size + length
+                fd.seek(offset)
+        if offset < size:
+            self.logger.warning("Truncating payload pack '%s' at %d bytes", path, offset)
+            with open(path, "r+b") as fd:
+                fd.truncate(offset)
+
+    def digest(self, data):
+        return "%s:%s" % (hash_algorithm, hash_payload(data))
+
+    def remember(self, digest, location):
+        """Adds a digest to the index as the most recently seen one, with
+        its location on the packs, evicting the least recently seen."""
+        self.index.pop(digest, None)
+        self.index[digest] = location
+        if len(self.index) > self.index_size:
+            self.index.popitem(last=False)
+
+    def add(self, data):
+        """Adds a payload to the store. Returns its digest and if it was the
+        first time the payload was seen."""
+        digest = self.digest(data)
+        new = digest not in self.index
+        if new:
+            location = self.write(digest, data) if self.pack is not None else None
+        else:
+            location = self.index[digest]
+        self.remember(digest, location)
+
+        # Keep the most recently seen payloads in the cache
+        self.cache.pop(digest, None)
+        self.cache[digest] = data
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        if new:
+            self.stored += 1
+        else:
+            self.deduplicated += 1
+            self.bytes_saved += len(data)
+        return digest, new
+
+    def write(self, digest, data):
+        """Appends a payload to the current pack and returns its
+        location."""
+        if self.pack.tell() >= self.pack_size:
+            self.pack.close()
+            self.open_pack(self.pack_number + 1)
+        offset = self.pack.tell() + self.header.size
+        self.pack.write(self.header.pack(digest.encode("ascii"), len(data)))
+        self.pack.write(data)
+        return self.pack_number, offset, len(data)
+
+    def get(self, digest):
+        """Returns a payload given its digest, or None if it's not in the
+        store."""
+        if digest in self.cache:
+            return self.cache[digest]
+        location = self.index.get(digest)
+        if location is None:
+            return None
+        number, offset, length = location
+        if number == self.pack_number:
+            self.pack.flush()
+        with open(self.pack_path(number), "rb") as fd:
+            fd.seek(offset)
+            return fd.read(length)
+
+    def process(self, event, min_size=0):
+        """Replaces the request and response payloads of an event with their
+        digest and length. Returns the list of events to deliver: a payload
+        event for each payload seen for the first time, followed by the
+        event itself."""
+        events = []
+        for field in ("request", "response"):
+            data = getattr(event, field)
+            if not data or len(data) < min_size:
+                continue
+            digest, new = self.add(data)
+            if new:
+                events.append(build_payload_event(event, field, digest, data))
+            payloads = dict(event.payloads or {})
+            payloads[field] = {"digest": digest, "length": len(data)}
+            event.payloads = payloads
+            setattr(event, field, None)
+        events.append(event)
+        return events
+
+    def close(self):
+        if self.pack is not None:
+            self.pack.close()
+            self.pack = None
+
+    def stats(self):
+        """Returns the counters of the store."""
+        return {"payloads_stored": self.stored,
+                "payloads_deduplicated": self.deduplicated,
+                "bytes_saved": self.bytes_saved}
@@ -0,0 +1,162 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+from datetime import datetime
+# External imports
+from six import string_types
+from sqlalchemy import create_engine, select, func, and_
+# Custom imports
+from .event import json_loads
+from .logger import Loggeable
+from ..feeds.dbfeed import DBSession, DBSessionEvent
+
+
+def parse_time(value):
+    """Parses a time given as "YYYY-MM-DD" or "YYYY-MM-DD HH:MM:SS", or
+    returns None if not given."""
+    if not value:
+        return None
+    for time_format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise ValueError("'%s' doesn't match YYYY-MM-DD [HH:MM:SS]" % value)
+
+
+class EventQuery(Loggeable):
+    """Common lookups of the events stored by the DBFeed in the normalized
+    schema. Results are returned as lists of dicts, with the timestamps as
+    strings and the events' data decoded."""
+
+    def __init__(self, db_engine):
+        if isinstance(db_engine, string_types):
+            db_engine = create_engine(db_engine)
+        self.engine = db_engine
+
+    def execute(self, statement):
+        with self.engine.connect() as connection:
+            return [dict(row._mapping) for row in connection.execute(statement)]
+
+    def time_range(self, column, since=None, until=None):
+        conditions = []
+        if since is not None:
+            conditions.append(column >= since)
+        if until is not None:
+            conditions.append(column < until)
+        return conditions
+
+    def events(self, conditions, limit):
+        """Returns the events matching the conditions with the fields of
+        their session, in chronological order."""
+        events = DBSessionEvent.__table__
+        sessions = DBSession.__table__
+        statement = select([sessions.c.uuid.label("session"),
+                            events.c.service,
+                            events.c.source_ip,
+                            sessions.c.source_port,
+                            sessions.c.target_ip,
+                            sessions.c.target_port,
+                            events.c.timestamp,
+                            events.c.event,
+                            events.c.target,
+                            events.c.data,
+                            events.c.request_digest,
+                            events.c.response_digest]).\
+            select_from(events.join(sessions, events.c.session_id == sessions.c.id)).\
+            where(*conditions).\
+            order_by(events.c.timestamp, events.c.id).\
+            limit(limit)
+        results = self.execute(statement)
+        for result in results:
+            result["timestamp"] = str(result["timestamp"])
+            if result["data"] is not None:
+                result["data"] = json_loads(result["data"])
+        return results
+
+    def events_by_source(self, source_ip, since=None, until=None, limit=100):
+        """Returns the events of the sessions from a source address."""
+        events = DBSessionEvent.__table__
+        return self.events([events.c.source_ip == source_ip] +
+                           self.time_range(events.c.timestamp, since, until), limit)
+
+    def events_by_service(self, service, event=None, since=None, until=None,
+                          limit=100):
+        """Returns the events of a service, optionally only of a type."""
+        events = DBSessionEvent.__table__
+        conditions = [events.c.service == service]
+        if event is not None:
+            conditions.append(events.c.event == event)
+        return self.events(conditions + self.time_range(events.c.timestamp, since, until), limit)
+
+    def session(self, uuid, limit=1000):
+        """Returns a session with its events, or None if it's not found."""
+        sessions = DBSession.__table__
+        results = self.execute(select([sessions]).where(sessions.c.uuid == uuid))
+        if not results:
+            return None
+        session = results[0]
+        session_id = session.pop("id")
+        session["first_seen"] = str(session["first_seen"])
+        session["last_seen"] = str(session["last_seen"])
+        session["events"] = self.events([DBSessionEvent.__table__.c.session_id == session_id], limit)
+        return session
+
+    def sessions_by_source(self, source_ip, since=None, until=None, limit=100):
+        """Returns the sessions from a source address."""
+        sessions = DBSession.__table__
+        statement = select([sessions.c.uuid, sessions.c.service,
+                            sessions.c.source_ip, sessions.c.source_port,
+                            sessions.c.target_ip, sessions.c.target_port,
+                            sessions.c.first_seen, sessions.c.last_seen]).\
+            where(and_(sessions.c.source_ip == source_ip,
+                       *self.time_range(sessions.c.first_seen, since, until))).\
+            order_by(sessions.c.first_seen).\
+            limit(limit)
+        results = self.execute(statement)
+        for result in results:
+            result["first_seen"] = str(result["first_seen"])
+            result["last_seen"] = str(result["last_seen"])
+        return results
+
+    def top_targets(self, since=None, until=None, limit=20):
+        """Returns the route targets most requested, with the number of
+        events and of distinct sources requesting them."""
+        events = DBSessionEvent.__table__
+        count = func.count().label("count")
+        statement = select([events.c.target, count,
+                            func.count(events.c.source_ip.distinct()).label("sources")]).\
+            where(and_(events.c.target.isnot(None),
+                       *self.time_range(events.c.timestamp, since, until))).\
+            group_by(events.c.target).\
+            order_by(count.desc()).\
+            limit(limit)
+        return self.execute(statement)
+
+    def event_counts(self, service=None, since=None, until=None):
+        """Returns the number of events per service and type."""
+        events = DBSessionEvent.__table__
+        conditions = self.time_range(events.c.timestamp, since, until)
+        if service is not None:
+            conditions.append(events.c.service == service)
+        count = func.count().label("count")
+        statement = select([events.c.service, events.c.event, count]).\
+            where(*conditions).\
+            group_by(events.c.service, events.c.event).\
+            order_by(count.desc())
+        return self.execute(statement)
@@ -0,0 +1,162 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import socket
+from fnmatch import fnmatchcase
+from binascii import hexlify
+# External imports
+from six import string_types
+# Custom imports
+from .logger import Loggeable
+
+
+class InvalidRoute(Exception):
+    """Raised when an event route rule is not valid."""
+
+
+def parse_address(address):
+    """Parses an IPv4 or IPv6 address and returns its family and integer
+    value."""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return family, int(hexlify(socket.inet_pton(family, address)), 16)
+        except (socket.error, ValueError, TypeError):
+            pass
+    return None, None
+
+
+def parse_network(network):
+    """Parses a network in CIDR notation and returns its family, network
+    value and mask."""
+    address, __, prefix = network.partition("/")
+    family, value = parse_address(address)
+    if family is None:
+        raise InvalidRoute("Invalid network '%s'" % network)
+    bits = 32 if family == socket.AF_INET else 128
+    try:
+        prefix = int(prefix) if prefix else bits
+    except ValueError:
+        raise InvalidRoute("Invalid network '%s'" % network)
+    if not 0 <= prefix <= bits:
+        raise InvalidRoute("Invalid network '%s'" % network)
+    mask = ((1 << prefix) - 1) << (bits - prefix)
+    return family, value & mask, mask
+
+
+def as_list(value):
+    if value is None:
+        return None
+    if isinstance(value, string_types):
+        return [value]
+    return list(value)
+
+
+class RouteRule(object):
+    """A rule matching events by service, event name, source network and
+    presence of data fields. Services and event names accept shell-style
+    wildcards. Conditions not set match any event."""
+
+    def __init__(self, rule):
+        unknown = set(rule) - set(["service", "event", "source", "data"])
+        if unknown:
+            raise InvalidRoute("Unknown route rule options: %s" % ", ".join(sorted(unknown)))
+        self.services = as_list(rule.get("service"))
+        self.events = as_list(rule.get("event"))
+        self.networks = [parse_network(network) for network in as_list(rule.get("source")) or []]
+        self.data = as_list(rule.get("data")) or []
+
+    @staticmethod
+    def match_patterns(patterns, value):
+        return patterns is None or any(fnmatchcase(value or "", pattern) for pattern in patterns)
+
+    def match_key(self, service, name):
+        """Checks the service and event name conditions."""
+        return self.match_patterns(self.services, service) and \
+            self.match_patterns(self.events, name)
+
+    @property
+    def static(self):
+        """If the rule only depends on the service and event name."""
+        return not self.networks and not self.data
+
+    def match_event(self, event):
+        """Checks the conditions depending on each event."""
+        if self.networks:
+            family, value = parse_address(event.session.source_ip if event.session else None)
+            if not any(family == network_family and value & mask == network
+                       for network_family, network, mask in self.networks):
+                return False
+        if self.data:
+            if not isinstance(event.data, dict) or \
+               not all(field in event.data for field in self.data):
+                return False
+        return True
+
+
+class EventRouter(Loggeable):
+    """Routes events to targets according to the rules of each target.
+
+    The targets for each service and event name are resolved the first time
+    they're seen and kept in a dispatch table, so routing an event costs a
+    dictionary lookup plus the evaluation of the rules that depend on the
+    event's source or data, if any.
+    """
+
+    max_table_size = 10000
+
+    def __init__(self):
+        self.targets = []
+        self.table = {}
+
+    def add(self, target, rules=None):
+        """Adds a target receiving the events that match any of the rules, or
+        all the events if no rules are given."""
+        if rules is not None:
+            rules = [RouteRule(rule) for rule in rules]
+        self.targets.append((target, rules))
+        self.table.clear()
+
+    def compile(self, service, name):
+        """Resolves the targets for a service and event name. Returns a
+        list of targets along with the rules to evaluate on each event, or
+        None if the target receives all the events."""
+        entry = []
+        for target, rules in self.targets:
+            if rules is None:
+                entry.append((target, None))
+                continue
+            matching = [rule for rule in rules if rule.match_key(service, name)]
+            if not matching:
+                continue
+            if any(rule.static for rule in matching):
+                entry.append((target, None))
+            else:
+                entry.append((target, matching))
+        return entry
+
+    def route(self, event):
+        """Returns the targets for an event."""
+        key = (event.session.service if event.session else None, event.event)
+        entry = self.table.get(key)
+        if entry is None:
+            # Bound the table for events with arbitrary names
+            if len(self.table) >= self.max_table_size:
+                self.table.clear()
+            entry = self.table[key] = self.compile(*key)
+        return [target for target, rules in entry
+                if rules is None or any(rule.match_event(event) for rule in rules)]
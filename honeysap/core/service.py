@@ -17,6 +17,8 @@
 
 # Standard imports
 from abc import abstractmethod, ABCMeta
+import socket
+from socket import SOL_SOCKET
 # External imports
 from flask.app import Flask
 from gevent.event import Event
@@ -26,6 +28,9 @@ from pysap.SAPNI import SAPNIServerThreaded, SAPNIServerHandler
 from .logger import Loggeable
 from .loader import ClassLoader
 
+# Not available on every platform, only required when running workers
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", None)
+
 
 class BaseService(Loggeable):
     """ Base service class
@@ -53,6 +58,17 @@ class BaseService(Loggeable):
     def listener_address(self):
         return self.config.get("listener_address", "127.0.0.1")
 
+    #: If the listener socket should be shared with other processes, set
+    #: when running in worker mode
+    @property
+    def reuse_port(self):
+        return self.config.get("reuse_port", False)
+
+    #: Index of the worker process running the service, if any
+    @property
+    def worker(self):
+        return self.config.get("worker", None)
+
     def __str__(self):
         return "<Service %s>" % self.alias
 
@@ -118,6 +134,11 @@ class BaseTCPService(BaseService):
         # we would be passing the client's socket from other service. This
         # also avoids trying to bind to an address not valid for this host.
         if not self.virtual:
+            if self.reuse_port:
+                if SO_REUSEPORT is None:
+                    raise ValueError("Sharing the listener socket with reuse_port/workers "
+                                     "requires SO_REUSEPORT, not available on this platform")
+                self.server.socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
             self.server.server_bind()
             self.server.server_activate()
 
@@ -177,6 +198,11 @@ class BaseHTTPService(BaseService):
             self.logger.debug("Adding handler '%s' for error code '%d'", name, code)
 
     def run(self):
+        # HTTP services can't share their listener, so in worker mode they
+        # only run in the first worker
+        if self.worker:
+            self.logger.debug("Not running on worker %d", self.worker)
+            return
         self.logger.debug("Waiting for clients")
         try:
             self.app.run(self.listener_address,
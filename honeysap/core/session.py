@@ -16,65 +16,337 @@
 #
 
 # Standard imports
+from time import time
 from uuid import uuid4
+from logging import getLogger, LoggerAdapter
+from collections import OrderedDict
 # External imports
-from gevent.queue import Queue
+from six import text_type
+from gevent import spawn
+from gevent.event import Event as gEvent
 # Custom imports
-from .event import Event
+from .event import Event, json_dumps, json_loads
 from .logger import Loggeable
+from .eventqueue import EventQueue
 
 
-class Session(Loggeable):
-    """An object representing an attack session
+# Shared logger for all the attack sessions
+session_logger = getLogger("honeysap.Session")
+
+
+class SessionLogMessage(object):
+    """Log message prefixed by its session, formatted only if the record is
+    emitted."""
+
+    __slots__ = ("session", "msg")
+
+    def __init__(self, session, msg):
+        self.session = session
+        self.msg = msg
+
+    def __str__(self):
+        return "%s - %s" % (self.session, self.msg)
+
+
+class SessionLoggerAdapter(LoggerAdapter):
+    """Logger adapter for the shared sessions logger that prefixes the
+    messages with the session and adds it as a contextual field of the log
+    records."""
+
+    def process(self, msg, kwargs):
+        kwargs["extra"] = {"session": self.extra}
+        return SessionLogMessage(self.extra, msg), kwargs
+
+
+class Session(object):
+    """An object representing an attack session. Sessions log through a
+    shared logger, prefixing the messages with the session.
     """
 
+    __slots__ = ("uuid", "event_queue", "service", "source_ip", "source_port",
+                 "target_ip", "target_port", "created", "last_seen", "events",
+                 "request_bytes", "response_bytes", "_json_prefix", "_logger")
+
     def __init__(self, event_queue, service, source_ip, source_port, target_ip,
-                 target_port):
+                 target_port, uuid=None):
         """Initialize the attack session.
         """
-        super(Session, self).__init__()
-        self.uuid = uuid4()
+        self.uuid = uuid or str(uuid4())
         self.event_queue = event_queue
         self.service = service
         self.source_ip = source_ip
         self.source_port = source_port
         self.target_ip = target_ip
         self.target_port = target_port
-        self.logger_name = "Session_%s_%s:%s_%s:%s" % (service,
-                                                       target_ip,
-                                                       target_port,
-                                                       source_ip,
-                                                       source_port)
+        self.created = self.last_seen = time()
+        self.events = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self._json_prefix = None
+        self._logger = None
+
+    def __str__(self):
+        return "Session_%s_%s:%s_%s:%s" % (self.service,
+                                           self.target_ip,
+                                           self.target_port,
+                                           self.source_ip,
+                                           self.source_port)
+
+    @property
+    def logger(self):
+        if self._logger is None:
+            self._logger = SessionLoggerAdapter(session_logger, self)
+        return self._logger
+
+    @property
+    def key(self):
+        return (self.service, self.source_ip, self.source_port,
+                self.target_ip, self.target_port)
+
+    @property
+    def json_prefix(self):
+        """Returns the JSON representation of the session's fields, without
+        the closing bracket, to prefix the JSON representation of events."""
+        if self._json_prefix is None:
+            self._json_prefix = json_dumps({"session": str(self.uuid),
+                                            "service": self.service,
+                                            "source_ip": self.source_ip,
+                                            "source_port": self.source_port,
+                                            "target_ip": self.target_ip,
+                                            "target_port": self.target_port})[:-1]
+        return self._json_prefix
 
     def add_event(self, event, **kwargs):
         """Add an event to the attack session."""
         if not isinstance(event, Event):
             event = Event(event, **kwargs)
         event.session = self
+        self.last_seen = time()
+        self.events += 1
+        if event.request:
+            self.request_bytes += len(event.request)
+        if event.response:
+            self.response_bytes += len(event.response)
         self.logger.debug("Received event %s", event)
         self.event_queue.put(event)
 
 
+def dump_event(event):
+    """Returns the JSON representation of an event as bytes, to be later
+    rebuilt with `load_event`."""
+    value = repr(event)
+    if isinstance(value, text_type):
+        value = value.encode("utf-8")
+    return value
+
+
+def load_event(value):
+    """Builds an event attached to a detached session from the JSON
+    representation of the event, as produced by `repr`. The representation
+    is kept as the cached one of the event, so it's not serialized again."""
+    fields = json_loads(value)
+    session = Session(None, fields["service"], fields["source_ip"],
+                      fields["source_port"], fields["target_ip"],
+                      fields["target_port"], uuid=str(fields["session"]))
+    event = Event.from_fields(fields)
+    event.session = session
+    event._repr = value
+    return event
+
+
+class TimerWheel(object):
+    """Hashed timer wheel for scheduling the expiration of items. Items are
+    placed in the slot corresponding to their deadline tick, so advancing the
+    wheel only looks at the slots of the elapsed ticks instead of all the
+    scheduled items. Items are scheduled at most once, and can be cancelled
+    so the wheel doesn't keep references to them.
+    """
+
+    def __init__(self, resolution=1.0, slots=512, now=None):
+        self.resolution = resolution
+        self.wheel = [{} for __ in range(slots)]
+        self.scheduled = {}
+        self.current = self.tick(time() if now is None else now)
+
+    def __len__(self):
+        return len(self.scheduled)
+
+    def tick(self, when):
+        return int(when / self.resolution)
+
+    def schedule(self, item, when):
+        """Schedules an item to expire at a given time, replacing its
+        previous schedule."""
+        self.cancel(item)
+        tick = max(self.tick(when), self.current + 1)
+        self.wheel[tick % len(self.wheel)][item] = tick
+        self.scheduled[item] = tick
+
+    def cancel(self, item):
+        """Removes an item from the wheel if it's scheduled."""
+        tick = self.scheduled.pop(item, None)
+        if tick is not None:
+            del self.wheel[tick % len(self.wheel)][item]
+
+    def advance(self, now):
+        """Advances the wheel up to a given time and returns the items
+        expired."""
+        target = self.tick(now)
+        expired = []
+        for step in range(1, min(target - self.current, len(self.wheel)) + 1):
+            slot = self.wheel[(self.current + step) % len(self.wheel)]
+            for item, tick in list(slot.items()):
+                if tick <= target:
+                    expired.append(item)
+                    del slot[item]
+                    del self.scheduled[item]
+        self.current = max(self.current, target)
+        return expired
+
+
 class SessionManager(Loggeable):
     """Object that keeps track of all attack sessions.
     """
 
+    @property
+    def event_queue_size(self):
+        return self.config.get("event_queue_size", 100000)
+
+    @property
+    def event_queue_overflow(self):
+        return self.config.get("event_queue_overflow", EventQueue.OVERFLOW_BLOCK)
+
+    @property
+    def event_queue_timeout(self):
+        return self.config.get("event_queue_timeout", 5)
+
+    @property
+    def event_queue_sample_rate(self):
+        return self.config.get("event_queue_sample_rate", 10)
+
+    @property
+    def event_queue_report_interval(self):
+        return self.config.get("event_queue_report_interval", 60)
+
+    @property
+    def session_timeout(self):
+        return self.config.get("session_timeout", 600)
+
+    @property
+    def session_max(self):
+        return self.config.get("session_max", 100000)
+
     def __init__(self, config):
         """Initialize the attack session."""
         self.config = config
-        self.sessions = dict()
-        self.event_queue = Queue()
+        self.sessions = OrderedDict()
+        self.close_callbacks = []
+        self.wheel = TimerWheel()
+        self.stopped = gEvent()
+        self.event_queue = EventQueue(self.event_queue_size,
+                                      self.event_queue_overflow,
+                                      timeout=self.event_queue_timeout,
+                                      drop_callback=self.event_dropped,
+                                      sample_rate=self.event_queue_sample_rate)
+        self.dropped_events = dict()
+        self.dropped_reported = 0
         self.logger.debug("Session manager initialized")
 
+    def event_dropped(self, event):
+        """Accounts for an event dropped from the event queue per service and
+        event type, and periodically reports the dropped events."""
+        service = event.session.service if event.session else None
+        key = (service, event.event)
+        self.dropped_events[key] = self.dropped_events.get(key, 0) + 1
+
+        now = time()
+        if now - self.dropped_reported >= self.event_queue_report_interval:
+            self.dropped_reported = now
+            self.logger.warning("Event queue full, %d events dropped: %s",
+                                self.event_queue.dropped,
+                                ", ".join("%s/%s: %d" % (service, name, count)
+                                          for (service, name), count in sorted(self.dropped_events.items())))
+
+    def stats(self):
+        """Returns the counters of the event queue."""
+        return {"queued": self.event_queue.qsize(),
+                "dropped": self.event_queue.dropped,
+                "dropped_events": dict(("%s/%s" % key, count)
+                                       for key, count in self.dropped_events.items())}
+
     def get_session(self, service, source_ip, source_port, target_ip,
                     target_port):
         """Obtain an attack session for a given service and a pair of source
         and destination addresses/ports. If the session is not found, it
         creates a new one."""
         key = (service, source_ip, source_port, target_ip, target_port)
-        if key not in self.sessions:
-            self.sessions[key] = Session(self.event_queue, service, source_ip,
-                                         source_port, target_ip, target_port)
+        session = self.sessions.pop(key, None)
+        if session is None:
+            session = Session(self.event_queue, service, source_ip,
+                              source_port, target_ip, target_port)
             self.logger.debug("Session created for service '%s' on %s:%d client %s:%d",
                               service, target_ip, target_port, source_ip, source_port)
-        return self.sessions[key]
+            if self.session_timeout:
+                self.wheel.schedule(session, session.created + self.session_timeout)
+        else:
+            session.last_seen = time()
+
+        # Keep the sessions sorted by last use and evict the least recently
+        # used ones if the maximum was reached
+        self.sessions[key] = session
+        while self.session_max and len(self.sessions) > self.session_max:
+            __, evicted = self.sessions.popitem(last=False)
+            self.close_session(evicted, "evicted")
+        return session
+
+    def add_close_callback(self, callback):
+        """Registers a callback to be called with the session and the reason
+        when a session is closed."""
+        self.close_callbacks.append(callback)
+
+    def close_session(self, session, reason):
+        """Closes a session, removing it from the session manager and
+        registering an event with its duration and counters."""
+        if self.sessions.get(session.key) is session:
+            del self.sessions[session.key]
+        self.wheel.cancel(session)
+        self.logger.debug("Session closed for service '%s' on %s:%d client %s:%d (%s)",
+                          session.service, session.target_ip, session.target_port,
+                          session.source_ip, session.source_port, reason)
+        session.add_event("Session closed", data={"reason": reason,
+                                                  "duration": session.last_seen - session.created,
+                                                  "events": session.events,
+                                                  "request_bytes": session.request_bytes,
+                                                  "response_bytes": session.response_bytes})
+        for callback in self.close_callbacks:
+            callback(session, reason)
+
+    def expire_sessions(self, now=None):
+        """Closes the sessions idle for longer than the session timeout."""
+        now = time() if now is None else now
+        for session in self.wheel.advance(now):
+            # Skip sessions that were already closed
+            if self.sessions.get(session.key) is not session:
+                continue
+            deadline = session.last_seen + self.session_timeout
+            if deadline <= now:
+                self.close_session(session, "timeout")
+            else:
+                self.wheel.schedule(session, deadline)
+
+    def run(self):
+        """Start expiring idle sessions."""
+        if self.session_timeout:
+            spawn(self.expire_sessions_periodically)
+
+    def stop(self):
+        """Stop expiring idle sessions."""
+        self.stopped.set()
+
+    def expire_sessions_periodically(self):
+        """Expires idle sessions on each tick of the timer wheel."""
+        while not self.stopped.wait(self.wheel.resolution):
+            try:
+                self.expire_sessions()
+            except Exception:
+                self.logger.exception("Failed to expire sessions")
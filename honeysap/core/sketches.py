@@ -0,0 +1,351 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import os
+import json
+from math import asin, log, pi
+from time import time
+from array import array
+from hashlib import md5
+from struct import Struct
+from zlib import crc32, adler32
+# External imports
+from six import text_type
+# Custom imports
+from .logger import Loggeable
+from .event import route_target
+
+
+def encode_key(key):
+    if isinstance(key, text_type):
+        return key.encode("utf-8")
+    return key if isinstance(key, bytes) else str(key).encode("utf-8")
+
+
+class CountMinSketch(object):
+    """Count-Min sketch estimating the count of keys in a fixed amount of
+    memory. Estimates are never below the real count, and exceed it by at
+    most 2/width of the total count with probability 1 - 1/2^depth."""
+
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [array("L", [0]) * width for __ in range(depth)]
+        self.total = 0
+
+    def indexes(self, key):
+        # Derive the row hashes from two base hashes
+        key = encode_key(key)
+        h1 = crc32(key) & 0xffffffff
+        h2 = adler32(key) & 0xffffffff
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key, count=1):
+        """Counts a key and returns its estimated count."""
+        self.total += count
+        estimate = None
+        for row, index in zip(self.rows, self.indexes(key)):
+            row[index] += count
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        return estimate
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self.rows, self.indexes(key)))
+
+    def merge(self, other):
+        """Adds the counts of another sketch of the same size."""
+        for row, other_row in zip(self.rows, other.rows):
+            for index, count in enumerate(other_row):
+                if count:
+                    row[index] += count
+        self.total += other.total
+
+
+class HeavyHitters(object):
+    """Tracks the most frequent keys of a stream with a Count-Min sketch,
+    keeping as candidates the `size` keys with the highest estimates."""
+
+    def __init__(self, size=20, width=2048, depth=4):
+        self.size = size
+        self.sketch = CountMinSketch(width, depth)
+        self.candidates = {}
+
+    def add(self, key, count=1):
+        estimate = self.sketch.add(key, count)
+        if key in self.candidates or len(self.candidates) < self.size:
+            self.candidates[key] = estimate
+            return
+        # Replace the candidate with the lowest estimate if exceeded
+        lowest = min(self.candidates, key=self.candidates.get)
+        if estimate > self.candidates[lowest]:
+            del self.candidates[lowest]
+            self.candidates[key] = estimate
+
+    def merge(self, other):
+        """Merges another tracker, estimating the candidates of both on the
+        merged sketch."""
+        self.sketch.merge(other.sketch)
+        keys = set(self.candidates) | set(other.candidates)
+        estimates = sorted(((self.sketch.estimate(key), key) for key in keys), reverse=True)
+        self.candidates = dict((key, estimate) for estimate, key in estimates[:self.size])
+
+    def top(self, count=None):
+        """Returns the keys with the highest estimated counts."""
+        return sorted(self.candidates.items(), key=lambda item: (-item[1], item[0]))[:count]
+
+
+class HyperLogLog(object):
+    """HyperLogLog estimating the number of distinct keys in 2^precision
+    bytes, with a standard error of 1.04/sqrt(2^precision)."""
+
+    hash_struct = Struct("!Q")
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+        self.alpha = 0.7213 / (1 + 1.079 / self.size)
+
+    def add(self, key):
+        value, = self.hash_struct.unpack(md5(encode_key(key)).digest()[:8])
+        index = value >> (64 - self.precision)
+        # Position of the leftmost 1 bit in the remaining bits
+        remaining = value & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        estimate = self.alpha * self.size * self.size / sum(2.0 ** -register for register in self.registers)
+        if estimate <= 2.5 * self.size:
+            # Linear counting for small cardinalities
+            zeros = self.registers.count(b"\x00")
+            if zeros:
+                estimate = self.size * log(float(self.size) / zeros)
+        return int(round(estimate))
+
+    def merge(self, other):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+
+class TDigest(object):
+    """Merging t-digest estimating quantiles of a stream of values with a
+    bounded number of centroids, more accurate on the extreme quantiles."""
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.buffer = []
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value, weight=1):
+        self.buffer.append((value, weight))
+        self.count += weight
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self.buffer) >= self.compression * 5:
+            self.compress()
+
+    def scale(self, q):
+        return self.compression * asin(2 * min(q, 1.0) - 1) / (2 * pi)
+
+    def compress(self):
+        """Merges the buffered values into the centroids."""
+        if not self.buffer:
+            return
+        points = sorted(list(zip(self.means, self.weights)) + self.buffer)
+        self.buffer = []
+        means, weights = [], []
+        total = float(self.count)
+        cumulative = 0.0
+        k_left = self.scale(0.0)
+        for mean, weight in points:
+            # Merge into the last centroid while it spans at most one unit of
+            # the scale function, so centroids are smaller on the tails
+            if means and self.scale((cumulative + weights[-1] + weight) / total) - k_left <= 1:
+                merged = weights[-1] + weight
+                means[-1] += (mean - means[-1]) * weight / merged
+                weights[-1] = merged
+                continue
+            if means:
+                cumulative += weights[-1]
+                k_left = self.scale(cumulative / total)
+            means.append(float(mean))
+            weights.append(weight)
+        self.means, self.weights = means, weights
+
+    def quantile(self, q):
+        """Returns the estimated value at a quantile."""
+        self.compress()
+        if not self.means:
+            return None
+        if len(self.means) == 1:
+            return self.means[0]
+        target = q * self.count
+        cumulative = 0.0
+        for index, weight in enumerate(self.weights):
+            center = cumulative + weight / 2.0
+            if target < center:
+                if index == 0:
+                    return self.min + (self.means[0] - self.min) * target / center
+                previous = cumulative - self.weights[index - 1] / 2.0
+                ratio = (target - previous) / (center - previous)
+                return self.means[index - 1] + (self.means[index] - self.means[index - 1]) * ratio
+            cumulative += weight
+        last = cumulative - self.weights[-1] / 2.0
+        ratio = (target - last) / (self.count - last)
+        return self.means[-1] + (self.max - self.means[-1]) * min(ratio, 1.0)
+
+    def merge(self, other):
+        other.compress()
+        for mean, weight in zip(other.means, other.weights):
+            self.add(mean, weight)
+        if other.min is not None:
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+
+
+class SketchWindow(object):
+    """Sketches of the events received in a time window."""
+
+    def __init__(self, start, top=20, width=2048, depth=4, precision=14,
+                 compression=100):
+        self.start = start
+        self.events = 0
+        self.sources = HeavyHitters(top, width, depth)
+        self.distinct_sources = HyperLogLog(precision)
+        self.targets = HeavyHitters(top, width, depth)
+        self.passwords = HeavyHitters(top, width, depth)
+        self.durations = {}
+        self.compression = compression
+
+    def add(self, fields):
+        """Adds the fields of an event to the sketches."""
+        self.events += 1
+        source = fields.get("source_ip")
+        if source:
+            self.sources.add(source)
+            self.distinct_sources.add(source)
+
+        data = fields.get("data")
+        target = route_target(fields.get("service"), fields.get("event"), data)
+        if target:
+            self.targets.add(target)
+        if isinstance(data, dict):
+            password = data.get("password")
+            if password:
+                self.passwords.add(password)
+            if fields.get("event") == "Session closed" and "duration" in data:
+                service = fields.get("service")
+                if service not in self.durations:
+                    self.durations[service] = TDigest(self.compression)
+                self.durations[service].add(data["duration"])
+        elif data and fields.get("event", "").startswith("Information request"):
+            # Information requests carry the admin password as data
+            self.passwords.add(data)
+
+    def merge(self, other):
+        self.events += other.events
+        self.sources.merge(other.sources)
+        self.distinct_sources.merge(other.distinct_sources)
+        self.targets.merge(other.targets)
+        self.passwords.merge(other.passwords)
+        for service, digest in other.durations.items():
+            if service not in self.durations:
+                self.durations[service] = TDigest(self.compression)
+            self.durations[service].merge(digest)
+
+    def snapshot(self, top):
+        durations = {}
+        for service, digest in self.durations.items():
+            durations[service] = {"count": digest.count,
+                                  "min": digest.min,
+                                  "p50": digest.quantile(0.5),
+                                  "p90": digest.quantile(0.9),
+                                  "p99": digest.quantile(0.99),
+                                  "max": digest.max}
+        return {"start": self.start,
+                "events": self.events,
+                "top_sources": self.sources.top(top),
+                "distinct_sources": self.distinct_sources.count(),
+                "top_targets": self.targets.top(top),
+                "top_passwords": self.passwords.top(top),
+                "session_durations": durations}
+
+
+class EventSketches(Loggeable):
+    """Streaming sketches of the events consumed by the eater: the top
+    source addresses, route targets and passwords tried, the number of
+    distinct sources and the quantiles of the session durations per
+    service.
+
+    Sketches are kept per time window of `window` seconds, up to `windows`
+    windows, so the memory used doesn't depend on the number of events.
+    Snapshots report the current window and all the windows kept merged.
+    """
+
+    def __init__(self, window=3600, windows=24, top=20, width=2048, depth=4,
+                 precision=14, compression=100):
+        self.window = window
+        self.windows = windows
+        self.top = top
+        self.options = {"top": top, "width": width, "depth": depth,
+                        "precision": precision, "compression": compression}
+        self.history = []
+        self.current = None
+
+    def window_for(self, now):
+        """Returns the window for a time, starting a new one if the current
+        window ended and dropping the oldest ones."""
+        start = int(now // self.window) * self.window
+        if self.current is None or start > self.current.start:
+            if self.current is not None:
+                self.history.append(self.current)
+            # Keep only the windows in the last `windows` windows
+            oldest = start - (self.windows - 1) * self.window
+            self.history = [window for window in self.history if window.start >= oldest]
+            self.current = SketchWindow(start, **self.options)
+        return self.current
+
+    def add(self, fields, now=None):
+        self.window_for(time() if now is None else now).add(fields)
+
+    def snapshot(self, now=None):
+        """Returns the snapshot of the current window and of all the windows
+        kept merged."""
+        now = time() if now is None else now
+        current = self.window_for(now)
+        total = SketchWindow(self.history[0].start if self.history else current.start,
+                             **self.options)
+        for window in self.history + [current]:
+            total.merge(window)
+        return {"time": now,
+                "window": self.window,
+                "current": current.snapshot(self.top),
+                "total": total.snapshot(self.top)}
+
+    def write_snapshot(self, filename, now=None):
+        """Writes a snapshot as JSON, replacing the file atomically."""
+        with open(filename + ".tmp", "w") as fd:
+            json.dump(self.snapshot(now), fd, indent=2, sort_keys=True)
+        os.rename(filename + ".tmp", filename)
+        self.logger.debug("Wrote sketches snapshot to '%s'", filename)
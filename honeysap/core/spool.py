@@ -0,0 +1,269 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import os
+import json
+from time import time
+from zlib import crc32
+from struct import Struct
+from bisect import bisect_right
+from os.path import exists, join
+# External imports
+from gevent.event import Event
+# Custom imports
+from .logger import Loggeable
+
+
+class SpoolError(Exception):
+    """Raised when the spool can't be opened or written."""
+
+
+class Spool(Loggeable):
+    """Append-only on-disk spool of records split in segment files.
+
+    Each record is stored as its length and CRC32 followed by the record
+    bytes, and is addressed by its offset across all the segments. Segments
+    are named after the offset of their first record. Readers keep their own
+    cursor, persisted in the spool directory, and segments are removed once
+    all the registered readers have acknowledged their records.
+
+    Records are appended to a buffered file and made visible to the readers
+    when the spool is flushed. The fsync policy controls when flushed
+    records are synced to disk: on every flush ("always"), at most every
+    `fsync_interval` seconds ("interval") or left to the OS ("never").
+    """
+
+    FSYNC_ALWAYS = "always"
+    FSYNC_INTERVAL = "interval"
+    FSYNC_NEVER = "never"
+
+    #: Pending bytes after which appended records should be flushed
+    flush_size = 1048576
+
+    header = Struct("!II")
+    segment_suffix = ".seg"
+    cursors_filename = "cursors.json"
+
+    def __init__(self, directory, segment_size=67108864, fsync=FSYNC_INTERVAL,
+                 fsync_interval=1.0):
+        if fsync not in [self.FSYNC_ALWAYS, self.FSYNC_INTERVAL, self.FSYNC_NEVER]:
+            raise SpoolError("Invalid fsync policy '%s'" % fsync)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.synced = time()
+        self.flushed = Event()
+        self.readers = {}
+
+        if not exists(directory):
+            os.makedirs(directory)
+
+        # Load the cursors and the segments, recovering the last one
+        self.cursors = {}
+        cursors_path = join(directory, self.cursors_filename)
+        if exists(cursors_path):
+            with open(cursors_path) as fd:
+                self.cursors = json.load(fd)
+        self.segments = sorted(int(filename[:-len(self.segment_suffix)])
+                               for filename in os.listdir(directory)
+                               if filename.endswith(self.segment_suffix))
+        if not self.segments:
+            self.segments = [0]
+        self.offset = self.segments[-1] + self.recover(self.segments[-1])
+        self.flushed_offset = self.offset
+        self.file = open(self.segment_path(self.segments[-1]), "ab")
+        self.segment_written = self.offset - self.segments[-1]
+        self.logger.debug("Spool opened at '%s' with %d segments up to offset %d",
+                          directory, len(self.segments), self.offset)
+
+    def segment_path(self, base):
+        return join(self.directory, "%020d%s" % (base, self.segment_suffix))
+
+    def recover(self, base):
+        """Scans a segment and truncates any partially written record at its
+        end. Returns the size of the valid records."""
+        path = self.segment_path(base)
+        if not exists(path):
+            return 0
+        valid = 0
+        with open(path, "rb") as fd:
+            while True:
+                header = fd.read(self.header.size)
+                if len(header) < self.header.size:
+                    break
+                length, checksum = self.header.unpack(header)
+                record = fd.read(length)
+                if len(record) < length or crc32(record) & 0xffffffff != checksum:
+                    break
+                valid += self.header.size + length
+        if valid < os.path.getsize(path):
+            self.logger.warning("Truncating spool segment '%s' at %d bytes", path, valid)
+            with open(path, "r+b") as fd:
+                fd.truncate(valid)
+        return valid
+
+    def append(self, record):
+        """Appends a record to the spool and returns its offset. The record
+        is not visible to readers until the spool is flushed."""
+        offset = self.offset
+        self.file.write(self.header.pack(len(record), crc32(record) & 0xffffffff))
+        self.file.write(record)
+        size = self.header.size + len(record)
+        self.offset += size
+        self.segment_written += size
+        if self.segment_written >= self.segment_size:
+            self.roll()
+        return offset
+
+    def roll(self):
+        """Closes the current segment and starts a new one."""
+        self.sync(True)
+        self.file.close()
+        self.segments.append(self.offset)
+        self.file = open(self.segment_path(self.offset), "ab")
+        self.segment_written = 0
+        self.logger.debug("Started spool segment at offset %d", self.offset)
+
+    def sync(self, force=False):
+        """Flushes the appended records and syncs them to disk according to
+        the fsync policy."""
+        self.file.flush()
+        now = time()
+        if self.fsync == self.FSYNC_ALWAYS or \
+           (self.fsync == self.FSYNC_INTERVAL and (force or now - self.synced >= self.fsync_interval)):
+            os.fsync(self.file.fileno())
+            self.synced = now
+
+    def flush(self):
+        """Flushes the appended records and wakes up the readers."""
+        if self.flushed_offset == self.offset:
+            return
+        self.sync()
+        self.flushed_offset = self.offset
+        self.flushed.set()
+        self.flushed.clear()
+
+    def reader(self, name):
+        """Returns the reader for a given name, starting from its persisted
+        cursor or from the oldest record in the spool."""
+        if name not in self.readers:
+            offset = max(self.cursors.get(name, 0), self.segments[0])
+            self.readers[name] = SpoolReader(self, name, offset)
+        return self.readers[name]
+
+    def commit(self):
+        """Persists the cursors of the readers and removes the segments
+        already read by all of them."""
+        cursors = dict(self.cursors)
+        cursors.update((name, reader.offset) for name, reader in self.readers.items())
+        if cursors != self.cursors:
+            path = join(self.directory, self.cursors_filename)
+            with open(path + ".tmp", "w") as fd:
+                json.dump(cursors, fd)
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.rename(path + ".tmp", path)
+            self.cursors = cursors
+
+        # Only the readers in use hold segments
+        if not self.readers:
+            return
+        oldest = min(reader.offset for reader in self.readers.values())
+        while len(self.segments) > 1 and self.segments[1] <= oldest:
+            base = self.segments.pop(0)
+            for reader in self.readers.values():
+                reader.close_segment(base)
+            os.remove(self.segment_path(base))
+            self.logger.debug("Removed spool segment at offset %d", base)
+
+    def close(self):
+        """Flushes the pending records, persists the cursors and closes the
+        spool."""
+        self.sync(True)
+        self.flushed_offset = self.offset
+        self.commit()
+        self.file.close()
+        for reader in self.readers.values():
+            reader.close_segment()
+
+    def stats(self):
+        """Returns the counters of the spool."""
+        return {"segments": len(self.segments),
+                "size": self.offset - self.segments[0],
+                "pending": dict((name, self.flushed_offset - reader.offset)
+                                for name, reader in self.readers.items())}
+
+
+class SpoolReader(object):
+    """Reads the records of a spool from a cursor. The cursor is only
+    advanced when the records are acknowledged."""
+
+    def __init__(self, spool, name, offset):
+        self.spool = spool
+        self.name = name
+        self.offset = offset
+        self.position = offset
+        self.base = None
+        self.file = None
+        self.file_position = None
+
+    def close_segment(self, base=None):
+        if self.file is not None and base in (None, self.base):
+            self.file.close()
+            self.file = None
+            self.base = None
+
+    def read(self, count=1000):
+        """Reads up to count flushed records following the last read one.
+        Returns a list of tuples with each record and the offset following
+        it, to be acknowledged once the record was processed."""
+        spool = self.spool
+        records = []
+        while len(records) < count and self.position < spool.flushed_offset:
+            # Open the segment containing the position to read, seeking only
+            # if the file is not already there
+            base = spool.segments[bisect_right(spool.segments, self.position) - 1]
+            if base != self.base:
+                self.close_segment()
+                self.file = open(spool.segment_path(base), "rb")
+                self.base = base
+                self.file_position = base
+            if self.file_position != self.position:
+                self.file.seek(self.position - base)
+            header = self.file.read(spool.header.size)
+            if len(header) < spool.header.size:
+                raise SpoolError("Spool segment %d truncated at offset %d" % (base, self.position))
+            length, __ = spool.header.unpack(header)
+            self.position += spool.header.size + length
+            self.file_position = self.position
+            records.append((self.file.read(length), self.position))
+        return records
+
+    def ack(self, offset):
+        """Acknowledges the records up to an offset."""
+        self.offset = offset
+
+    def rewind(self):
+        """Continue reading from the last acknowledged record."""
+        self.position = self.offset
+
+    def wait(self, timeout=None):
+        """Waits until new records are flushed."""
+        if self.position >= self.spool.flushed_offset:
+            self.spool.flushed.wait(timeout)
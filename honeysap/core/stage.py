@@ -0,0 +1,92 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+from abc import abstractmethod, ABCMeta
+# External imports
+# Custom imports
+from .logger import Loggeable
+from .loader import ClassLoader
+from .config import Configuration
+
+
+class BaseStage(Loggeable):
+    """ Base event processing stage class
+
+    Stages are chained in the configured order between the session manager
+    and the feeds. Each stage receives the events produced by the previous
+    one and returns the events to pass to the next one, so it can drop,
+    modify, add or hold back events.
+    """
+
+    __metaclass__ = ABCMeta
+
+    @property
+    def alias(self):
+        return self.config.get("alias", self.__class__.__name__)
+
+    def __init__(self, config):
+        """Initialize the stage with the options provided.
+        """
+        self.config = config
+        if self.alias != self.__class__.__name__:
+            self.logger_name = self.alias
+        self.setup()
+        self.logger.debug("Stage initialized")
+
+    def setup(self):
+        """Setup the stage"""
+        pass
+
+    @abstractmethod
+    def process(self, event):
+        """Process an event and return the list of events to pass on"""
+        pass
+
+    def flush(self, now):
+        """Called periodically, returns the list of events held back by the
+        stage that should be passed on"""
+        return []
+
+    def stop(self):
+        """Stop the stage and return the list of events held back"""
+        return []
+
+    def stats(self):
+        """Returns a dict with the counters of the stage"""
+        return {}
+
+
+def load_stages(config, stages_path="honeysap/stages"):
+    """Loads the stages enabled in the configuration, keeping the order in
+    which they were configured."""
+    stages = []
+    if "stages" not in config:
+        return stages
+
+    classes = dict(ClassLoader([BaseStage], stages_path).load())
+    for item in config.stages:
+        if not item.get("enabled", False):
+            continue
+        if item.get("stage") not in classes:
+            raise ValueError("Stage '%s' not found" % item.get("stage"))
+        stage_config = Configuration()
+        stage_config.update(config)
+        stage_config.update(item)
+        del(stage_config["_config_files"])
+        stages.append(classes[item["stage"]](stage_config))
+    return stages
@@ -0,0 +1,56 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import sys
+# External imports
+from six import reraise
+from gevent.threadpool import ThreadPool as BaseThreadPool
+# Custom imports
+
+
+class ThreadResult(object):
+    """Result of a function run on a thread of the pool, raising on the
+    waiting greenlet the exception raised by the function."""
+
+    def __init__(self, result):
+        self.result = result
+
+    def ready(self):
+        return self.result.ready()
+
+    def get(self, block=True, timeout=None):
+        error, value = self.result.get(block, timeout)
+        if error is not None:
+            reraise(*error)
+        return value
+
+
+class ThreadPool(BaseThreadPool):
+    """Pool of threads that propagates the exceptions raised by the functions
+    run on it. The gevent pool only prints them and returns None as the
+    result, so errors on the threads would go unnoticed."""
+
+    def spawn(self, func, *args, **kwargs):
+        return ThreadResult(super(ThreadPool, self).spawn(self.call, func, args, kwargs))
+
+    @staticmethod
+    def call(func, args, kwargs):
+        try:
+            return None, func(*args, **kwargs)
+        except Exception:
+            return sys.exc_info(), None
@@ -0,0 +1,93 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+from time import time
+# External imports
+from gevent import sleep
+from gevent.event import Event
+from gevent.subprocess import Popen
+# Custom imports
+from .logger import Loggeable
+
+
+class WorkerSupervisor(Loggeable):
+    """Starts a number of worker processes and restarts the ones that exit
+    until the supervisor is stopped. Each worker runs the given command with
+    its index appended as a `--worker` argument.
+    """
+
+    def __init__(self, command, count, restart_delay=1.0, poll_interval=0.5):
+        self.command = command
+        self.count = count
+        self.restart_delay = restart_delay
+        self.poll_interval = poll_interval
+        self.workers = [None] * count
+        self.exited = [None] * count
+        self.restarts = 0
+        self.stopped = Event()
+
+    def start_worker(self, index):
+        self.workers[index] = Popen(self.command + ["--worker", str(index)],
+                                     close_fds=True)
+        self.exited[index] = None
+        self.logger.info("Started worker %d with pid %d", index, self.workers[index].pid)
+
+    def check_workers(self, now=None):
+        """Restarts the workers that exited at least restart_delay seconds
+        ago."""
+        now = time() if now is None else now
+        for index, worker in enumerate(self.workers):
+            if self.exited[index] is None:
+                if worker.poll() is None:
+                    continue
+                self.logger.warning("Worker %d with pid %d exited with code %d",
+                                    index, worker.pid, worker.returncode)
+                self.exited[index] = now
+            if now - self.exited[index] >= self.restart_delay:
+                self.start_worker(index)
+                self.restarts += 1
+
+    def run(self):
+        """Starts the workers and supervises them until stopped."""
+        for index in range(self.count):
+            self.start_worker(index)
+        while not self.stopped.wait(self.poll_interval):
+            self.check_workers()
+
+    def stop(self, timeout=5.0):
+        """Stops supervising and terminates the workers, killing the ones
+        still running after the timeout."""
+        self.stopped.set()
+        running = [worker for worker in self.workers
+                   if worker is not None and worker.poll() is None]
+        for worker in running:
+            worker.terminate()
+        waited = 0.0
+        while waited < timeout and any(worker.poll() is None for worker in running):
+            sleep(0.1)
+            waited += 0.1
+        for worker in running:
+            if worker.poll() is None:
+                self.logger.warning("Killing worker with pid %d", worker.pid)
+                worker.kill()
+                worker.wait()
+
+    def stats(self):
+        return {"workers": sum(1 for worker in self.workers
+                               if worker is not None and worker.poll() is None),
+                "restarts": self.restarts}
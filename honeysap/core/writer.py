@@ -0,0 +1,228 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import os
+import gzip
+from time import time, strftime, localtime
+from os.path import basename, dirname, exists, getmtime, join
+# External imports
+from gevent import spawn
+from gevent.event import Event
+# Custom imports
+from .logger import Loggeable
+from .threadpool import ThreadPool
+
+# Optional imports
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class RotatingWriter(Loggeable):
+    """Buffered writer of lines to a file, or to an already opened file
+    object like the standard output.
+
+    Lines are buffered in memory and written when the buffer reaches
+    `buffer_size` bytes or every `flush_interval` seconds. Writes are done on
+    a background thread, so a slow disk doesn't block the greenlets writing
+    lines, and at most one buffer waits for the previous one to be written.
+
+    Files are rotated when they reach `rotate_size` bytes or were opened for
+    `rotate_interval` seconds, renaming them after the time they were
+    rotated, and only the last `rotate_keep` rotated files are kept. Files
+    can be compressed with gzip or zstd while being written.
+    """
+
+    COMPRESSION_GZIP = "gzip"
+    COMPRESSION_ZSTD = "zstd"
+
+    suffixes = {None: "",
+                COMPRESSION_GZIP: ".gz",
+                COMPRESSION_ZSTD: ".zst"}
+
+    def __init__(self, filename=None, fd=None, buffer_size=1048576,
+                 flush_interval=1.0, rotate_size=0, rotate_interval=0,
+                 rotate_keep=0, compression=None, compression_level=None,
+                 threaded=True):
+        if compression not in self.suffixes:
+            raise ValueError("Invalid compression '%s'" % compression)
+        if compression == self.COMPRESSION_ZSTD and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard library")
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.rotate_keep = rotate_keep
+        self.compression = compression
+        self.compression_level = compression_level
+        self.buffer = []
+        self.buffered = 0
+        self.lines = 0
+        self.written = 0
+        self.rotations = 0
+        self.errors = 0
+        self.dropped = 0
+        self.pending = None
+        self.stopped = Event()
+
+        if fd is not None:
+            self.raw = self.file = fd
+        else:
+            self.open()
+        self.pool = ThreadPool(1) if threaded else None
+        self.greenlet = spawn(self.flush_periodically) if flush_interval else None
+
+    @property
+    def path(self):
+        return self.filename + self.suffixes[self.compression]
+
+    def open(self):
+        """Opens the file for appending, wrapping it in a compressor if
+        configured. Appending to a compressed file adds a new frame/member
+        to it, so it can still be decompressed as a whole."""
+        self.raw = open(self.path, "ab")
+        if self.compression == self.COMPRESSION_GZIP:
+            self.file = gzip.GzipFile(fileobj=self.raw, mode="ab",
+                                      compresslevel=self.compression_level or 6)
+        elif self.compression == self.COMPRESSION_ZSTD:
+            compressor = zstandard.ZstdCompressor(level=self.compression_level or 3)
+            self.file = compressor.stream_writer(self.raw)
+        else:
+            self.file = self.raw
+        self.opened = time()
+
+    def close_file(self):
+        if self.filename is None:
+            self.file.flush()
+            return
+        self.file.close()
+        if not self.raw.closed:
+            self.raw.close()
+
+    def rotated_path(self, now):
+        """Returns the path for a rotated file, after the rotation time."""
+        path = "%s.%s" % (self.filename, strftime("%Y%m%d%H%M%S", localtime(now)))
+        suffix = self.suffixes[self.compression]
+        candidate, count = path + suffix, 0
+        while exists(candidate):
+            count += 1
+            candidate = "%s-%d%s" % (path, count, suffix)
+        return candidate
+
+    def rotate(self, now):
+        """Renames the current file and opens a new one, removing the oldest
+        rotated files."""
+        self.close_file()
+        os.rename(self.path, self.rotated_path(now))
+        self.open()
+        self.rotations += 1
+
+        if self.rotate_keep:
+            directory = dirname(self.filename) or "."
+            prefix = basename(self.filename) + "."
+            suffix = self.suffixes[self.compression]
+            rotated = sorted((join(directory, name) for name in os.listdir(directory)
+                              if name.startswith(prefix) and name.endswith(suffix) and
+                              join(directory, name) != self.path),
+                             key=getmtime)
+            for path in rotated[:-self.rotate_keep]:
+                os.remove(path)
+
+    def should_rotate(self, now):
+        if self.filename is None:
+            return False
+        return (self.rotate_size and self.raw.tell() >= self.rotate_size) or \
+               (self.rotate_interval and now - self.opened >= self.rotate_interval)
+
+    def write(self, line):
+        """Buffers a line, writing the buffer if it's full."""
+        self.buffer.append(line)
+        self.buffered += len(line)
+        self.lines += 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self, wait=False):
+        """Writes the buffered lines on the background thread, waiting for
+        the previous write to finish."""
+        if self.buffer:
+            data, lines = b"".join(self.buffer), len(self.buffer)
+            self.buffer = []
+            self.buffered = 0
+            self.wait()
+            if self.pool is None:
+                try:
+                    self.write_data(data)
+                except Exception:
+                    self.write_failed(len(data))
+            else:
+                self.pending = (self.pool.spawn(self.write_data, data), len(data), lines)
+        if wait:
+            self.wait()
+
+    def wait(self):
+        """Waits until the pending write finishes."""
+        if self.pending is not None:
+            (pending, size, __), self.pending = self.pending, None
+            try:
+                pending.get()
+            except Exception:
+                self.write_failed(size)
+
+    def unflushed(self):
+        """Returns the number of lines buffered or being written."""
+        unflushed = len(self.buffer)
+        if self.pending is not None and not self.pending[0].ready():
+            unflushed += self.pending[2]
+        return unflushed
+
+    def write_failed(self, size):
+        """Accounts for a buffer that couldn't be written, which is
+        dropped."""
+        self.errors += 1
+        self.dropped += size
+        self.logger.exception("Failed to write %d bytes to '%s'", size, self.filename)
+
+    def write_data(self, data):
+        now = time()
+        if self.should_rotate(now):
+            self.rotate(now)
+        self.file.write(data)
+        self.file.flush()
+        self.written += len(data)
+
+    def flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Writes the buffered lines and closes the file."""
+        self.stopped.set()
+        self.flush(wait=True)
+        self.close_file()
+        if self.pool is not None:
+            self.pool.kill()
+
+    def stats(self):
+        return {"lines": self.lines,
+                "written": self.written,
+                "rotations": self.rotations,
+                "errors": self.errors,
+                "dropped": self.dropped}
@@ -16,15 +16,28 @@
 #
 
 # Standard imports
-
+from time import time
+from os.path import join
+from collections import deque
+from tempfile import gettempdir
 # External imports
-from sqlalchemy import create_engine
-from sqlalchemy.schema import Column
-from sqlalchemy.orm import sessionmaker
+from six import text_type
+from gevent import spawn, sleep
+from gevent.event import Event
+from gevent.queue import Queue
+from gevent.timeout import Timeout
+from sqlalchemy import create_engine, select, bindparam
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import Column, ForeignKey, Index
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.types import Integer, DateTime, String, Text
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.types import Integer, DateTime, String, Text, LargeBinary
 # Custom imports
 from honeysap.core.feed import BaseFeed
+from honeysap.core.threadpool import ThreadPool
+from honeysap.core.event import json_dumps, route_target
+from honeysap.core.payload import hash_algorithm, hash_payload
 
 
 Base = declarative_base()
@@ -39,10 +52,199 @@ class DBEvent(Base):
     event = Column(Text)
 
 
+# Normalized schema, with the sessions, the events and the payloads in their
+# own tables and the columns used for lookups indexed
+NormalizedBase = declarative_base()
+
+
+class DBSession(NormalizedBase):
+    __tablename__ = "sessions"
+    __table_args__ = (Index("ix_sessions_source", "source_ip", "first_seen"),)
+
+    id = Column(Integer, primary_key=True)
+    uuid = Column(String(64), unique=True, nullable=False)
+    service = Column(String(64))
+    source_ip = Column(String(45))
+    source_port = Column(Integer)
+    target_ip = Column(String(45))
+    target_port = Column(Integer)
+    first_seen = Column(DateTime)
+    last_seen = Column(DateTime)
+
+
+class DBPayload(NormalizedBase):
+    __tablename__ = "payloads"
+
+    digest = Column(String(80), primary_key=True)
+    length = Column(Integer)
+    data = Column(LargeBinary)
+
+
+class DBSessionEvent(NormalizedBase):
+    __tablename__ = "session_events"
+    __table_args__ = (Index("ix_session_events_source", "source_ip", "timestamp"),
+                      Index("ix_session_events_service", "service", "event", "timestamp"),
+                      Index("ix_session_events_target", "target"))
+
+    id = Column(Integer, primary_key=True)
+    session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False, index=True)
+    timestamp = Column(DateTime)
+    service = Column(String(64))
+    source_ip = Column(String(45))
+    event = Column(String(255))
+    target = Column(String(255))
+    data = Column(Text)
+    request_digest = Column(String(80), ForeignKey("payloads.digest"))
+    response_digest = Column(String(80), ForeignKey("payloads.digest"))
+
+
+def normalize_event(event):
+    """Returns the row of an event for the normalized schema, with the
+    fields of its session and its payloads."""
+    session = event.session
+    row = {"session": str(session.uuid),
+           "service": session.service,
+           "source_ip": session.source_ip,
+           "source_port": session.source_port,
+           "target_ip": session.target_ip,
+           "target_port": session.target_port,
+           "timestamp": event.timestamp,
+           "event": event.event,
+           "target": route_target(session.service, event.event, event.data),
+           "data": json_dumps(event.data) if event.data is not None else None,
+           "payloads": []}
+    for field in ("request", "response"):
+        data = getattr(event, field)
+        digest = None
+        if data:
+            if not isinstance(data, bytes):
+                data = data.encode("utf-8")
+            digest = "%s:%s" % (hash_algorithm, hash_payload(data))
+            row["payloads"].append((digest, data))
+        elif event.payloads and field in event.payloads:
+            # Payloads already replaced by their digest by the payload store
+            digest = event.payloads[field]["digest"]
+        row[field + "_digest"] = digest
+    return row
+
+
+def select_in(connection, column, values, *columns):
+    """Selects the rows with a column in a list of values, in chunks to keep
+    the number of parameters low."""
+    values = list(values)
+    results = []
+    for start in range(0, len(values), 500):
+        results.extend(connection.execute(select(list(columns) or [column]).
+                                          where(column.in_(values[start:start + 500]))))
+    return results
+
+
+def insert_ignore(connection, table):
+    """Returns an insert statement for a table that ignores the rows
+    already inserted, as other sensors or threads can insert the same
+    sessions or payloads in the meantime."""
+    dialect = connection.dialect.name
+    if dialect == "postgresql":
+        return postgresql_insert(table).on_conflict_do_nothing()
+    if dialect == "sqlite":
+        return table.insert().prefix_with("OR IGNORE")
+    if dialect == "mysql":
+        return table.insert().prefix_with("IGNORE")
+    return table.insert()
+
+
+def insert_normalized(connection, rows):
+    """Inserts rows of the normalized schema, creating or updating their
+    sessions and inserting the payloads not yet stored."""
+    sessions = DBSession.__table__
+    payloads = DBPayload.__table__
+
+    # Sessions seen on the rows, with the time range of their events
+    seen = {}
+    for row in rows:
+        session = seen.get(row["session"])
+        if session is None:
+            seen[row["session"]] = {"uuid": row["session"],
+                                    "service": row["service"],
+                                    "source_ip": row["source_ip"],
+                                    "source_port": row["source_port"],
+                                    "target_ip": row["target_ip"],
+                                    "target_port": row["target_port"],
+                                    "first_seen": row["timestamp"],
+                                    "last_seen": row["timestamp"]}
+        else:
+            session["first_seen"] = min(session["first_seen"], row["timestamp"])
+            session["last_seen"] = max(session["last_seen"], row["timestamp"])
+
+    existing = dict((uuid, (id, last_seen)) for id, uuid, last_seen in
+                    select_in(connection, sessions.c.uuid, seen,
+                              sessions.c.id, sessions.c.uuid, sessions.c.last_seen))
+    new = [session for uuid, session in seen.items() if uuid not in existing]
+    if new:
+        connection.execute(insert_ignore(connection, sessions), new)
+        # Sessions inserted in the meantime are updated as existing ones
+        existing.update((uuid, (id, last_seen)) for id, uuid, last_seen in
+                        select_in(connection, sessions.c.uuid, [session["uuid"] for session in new],
+                                  sessions.c.id, sessions.c.uuid, sessions.c.last_seen))
+    updated = [{"session_id": existing[uuid][0], "seen": session["last_seen"]}
+               for uuid, session in seen.items()
+               if existing[uuid][1] is not None and existing[uuid][1] < session["last_seen"]]
+    if updated:
+        connection.execute(sessions.update().
+                           where(sessions.c.id == bindparam("session_id")).
+                           values(last_seen=bindparam("seen")), updated)
+
+    # Payloads not already stored
+    data = dict(payload for row in rows for payload in row["payloads"])
+    if data:
+        stored = set(digest for digest, in select_in(connection, payloads.c.digest, data))
+        missing = [{"digest": digest, "length": len(value), "data": value}
+                   for digest, value in data.items() if digest not in stored]
+        if missing:
+            connection.execute(insert_ignore(connection, payloads), missing)
+
+    connection.execute(DBSessionEvent.__table__.insert(),
+                       [{"session_id": existing[row["session"]][0],
+                         "timestamp": row["timestamp"],
+                         "service": row["service"],
+                         "source_ip": row["source_ip"],
+                         "event": row["event"],
+                         "target": row["target"],
+                         "data": row["data"],
+                         "request_digest": row["request_digest"],
+                         "response_digest": row["response_digest"]}
+                        for row in rows])
+
+
 class DBFeed(BaseFeed):
     """ Database based feed class
+
+    Events are buffered and inserted in bulk when the number of buffered rows
+    reaches `db_batch_size`, when the buffered events size reaches
+    `db_batch_max_bytes` or when the oldest buffered event is older than
+    `db_batch_latency` seconds. The default batch size of 1 inserts each
+    event as soon as it's logged.
+
+    Batches are handed off through a queue to a pool of threads that run the
+    inserts, as most database drivers block the process while waiting for
+    the database. When `db_queue_size` events are waiting to be inserted,
+    flushing waits for the threads to catch up. A circuit breaker opens when
+    `db_timeout` is exceeded or inserts fail `db_breaker_failures`
+    consecutive times, and while it's open batches are written to a fallback
+    file instead, in the format of the log feed so they can be imported
+    later. The breaker lets a single trial batch through after
+    `db_breaker_reset` seconds, and closes again if it's inserted in time. The fallback file
+    is kept on the spool directory if there's one, or on the temporary
+    directory otherwise.
+
+    With `db_schema` set to "normalized", events are stored in the
+    normalized schema instead of as JSON in the events table, so they can
+    be looked up by session, source, service or target with the query API.
     """
 
+    SCHEMA_BLOB = "blob"
+    SCHEMA_NORMALIZED = "normalized"
+
     @property
     def db_engine(self):
         return self.config.get("db_engine")
@@ -51,27 +253,325 @@ class DBFeed(BaseFeed):
     def db_echo(self):
         return self.config.get("db_echo", False)
 
+    @property
+    def db_schema(self):
+        return self.config.get("db_schema", self.SCHEMA_BLOB)
+
+    @property
+    def db_batch_size(self):
+        return self.config.get("db_batch_size", 1)
+
+    @property
+    def db_batch_latency(self):
+        return self.config.get("db_batch_latency", 1.0)
+
+    @property
+    def db_batch_max_bytes(self):
+        return self.config.get("db_batch_max_bytes", 1048576)
+
+    #: Number of threads running inserts, and of pooled connections
+    @property
+    def db_threads(self):
+        return self.config.get("db_threads", 1)
+
+    #: Maximum number of events waiting to be inserted
+    @property
+    def db_queue_size(self):
+        return self.config.get("db_queue_size", 10000)
+
+    #: Seconds after which an insert is considered failed
+    @property
+    def db_timeout(self):
+        return self.config.get("db_timeout", 5.0)
+
+    @property
+    def db_breaker_failures(self):
+        return self.config.get("db_breaker_failures", 3)
+
+    @property
+    def db_breaker_reset(self):
+        return self.config.get("db_breaker_reset", 30.0)
+
+    @property
+    def db_fallback_filename(self):
+        filename = self.config.get("db_fallback_filename")
+        if filename is None:
+            filename = join(self.config.get("spool_directory") or gettempdir(),
+                            "honeysap-%s-fallback.log" % self.alias)
+        return filename
+
     def setup(self):
-        """Initializes the database connection"""
+        """Initializes the database connection pool and the threads"""
+        if self.db_schema not in [self.SCHEMA_BLOB, self.SCHEMA_NORMALIZED]:
+            raise ValueError("Invalid database schema '%s'" % self.db_schema)
+        options = {}
+        threads = self.db_threads
+        if self.db_schema == self.SCHEMA_NORMALIZED and threads > 1:
+            # Payload events must be inserted before the events referencing
+            # their digest, so batches are inserted in order
+            self.logger.debug("Inserting normalized events on a single thread")
+            threads = 1
+        url = make_url(self.db_engine)
+        if url.get_backend_name() != "sqlite":
+            options = {"pool_size": threads,
+                       "max_overflow": 0,
+                       "pool_pre_ping": True}
+        elif url.database in (None, "", ":memory:"):
+            # An in-memory database lives only on its connection, so a single
+            # connection is shared with the thread running the inserts
+            options = {"poolclass": StaticPool,
+                       "connect_args": {"check_same_thread": False}}
+            threads = 1
         self.engine = create_engine(self.db_engine,
-                                    echo=self.db_echo)
-        Base.metadata.create_all(self.engine)
-        Session = sessionmaker(bind=self.engine)
-        self.session = Session()
+                                    echo=self.db_echo,
+                                    **options)
+        if self.db_schema == self.SCHEMA_NORMALIZED:
+            NormalizedBase.metadata.create_all(self.engine)
+        else:
+            Base.metadata.create_all(self.engine)
         self.logger.debug("Database connection created with '%s'", self.db_engine)
 
+        # Buffer of events pending to be inserted, with their JSON
+        # representation and their row
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.buffer_started = None
+
+        # Batches handed off to the threads, and number of events on them
+        self.pool = ThreadPool(threads)
+        self.queue = Queue()
+        self.queued = 0
+        self.dequeued = Event()
+        self.inserting = 0
+        # Batches being inserted, in the order they were queued, along with
+        # whether they're done
+        self.inflight = deque()
+        self.fallback = None
+
+        # Circuit breaker
+        self.failures = 0
+        self.breaker_opened = None
+        self.breaker_probing = False
+
+        # Counters
+        self.rows_flushed = 0
+        self.rows_failed = 0
+        self.rows_shed = 0
+        self.flushes = 0
+        self.timeouts = 0
+        self.flush_time = 0.0
+        self.flush_time_max = 0.0
+
+        self.stopped = Event()
+        self.inserters = [spawn(self.insert_batches) for __ in range(threads)]
+
+        # Start the greenlet in charge of flushing on the time window only if
+        # we're batching events
+        self.flusher = None
+        if self.db_batch_size > 1:
+            self.flusher = spawn(self.flush_periodically)
+            self.logger.debug("Batching up to %d events (%d bytes) for %.2f seconds",
+                              self.db_batch_size, self.db_batch_max_bytes,
+                              self.db_batch_latency)
+
     def stop(self):
-        """Stops the database connection"""
-        self.session.close_all()
-        self.logger.debug("Closed database session")
+        """Flushes the pending events and stops the database connection"""
+        self.stopped.set()
+        self.flush()
+        self.wait(self.db_timeout)
+        # Batches not inserted in time are kept in the fallback file, while
+        # the inserts already running can't be cancelled so they're waited for
+        while not self.queue.empty():
+            rows = self.queue.get_nowait()
+            self.queued -= len(rows)
+            self.shed(rows)
+        if self.inserting:
+            self.logger.warning("Waiting for %d inserts in progress", self.inserting)
+            while self.inserting:
+                sleep(0.01)
+        for inserter in self.inserters:
+            inserter.kill()
+        self.pool.kill()
+        self.engine.dispose()
+        if self.fallback is not None:
+            self.fallback.close()
+            self.fallback = None
+        self.logger.debug("Closed database connection")
+
+    def wait(self, timeout=None):
+        """Waits until the batches handed off are inserted."""
+        waited = 0.0
+        while (not self.queue.empty() or self.inserting) and \
+                (timeout is None or waited < timeout):
+            sleep(0.01)
+            waited += 0.01
 
     def log(self, event):
         """Logs an event in the database"""
-        dbevent = DBEvent(session=str(event.session.uuid),
-                          timestamp=event.timestamp,
-                          event=repr(event))
-        self.session.add(dbevent)
-        self.session.commit()
+        event_repr = repr(event)
+        if not self.buffer:
+            self.buffer_started = time()
+        if self.db_schema == self.SCHEMA_NORMALIZED:
+            row = normalize_event(event)
+        else:
+            row = {"session": str(event.session.uuid),
+                   "timestamp": event.timestamp,
+                   "event": event_repr}
+        self.buffer.append((event_repr, row))
+        self.buffer_bytes += len(event_repr)
+
+        if len(self.buffer) >= self.db_batch_size or \
+           self.buffer_bytes >= self.db_batch_max_bytes:
+            self.flush()
+
+    def flush(self):
+        """Hands off all the buffered events to be inserted in a single
+        transaction"""
+        if not self.buffer:
+            return
+
+        # Swap the buffer so events logged in the meantime are kept for the
+        # next flush
+        rows = self.buffer
+        self.buffer, self.buffer_bytes, self.buffer_started = [], 0, None
+
+        # Wait for the threads to catch up while the queue is full, unless
+        # the breaker opens in the meantime
+        while self.queued and self.queued + len(rows) > self.db_queue_size and \
+                not self.breaker_open():
+            self.dequeued.clear()
+            self.dequeued.wait()
+        if self.breaker_open():
+            self.shed(rows)
+            return
+        self.queued += len(rows)
+        self.queue.put_nowait(rows)
+
+    def breaker_open(self):
+        """Returns if the circuit breaker is open. Once the reset time
+        elapsed it lets a trial batch through, and stays open while it's
+        being inserted."""
+        if self.breaker_opened is None:
+            return False
+        return self.breaker_probing or time() - self.breaker_opened < self.db_breaker_reset
+
+    def insert_failed(self):
+        self.failures += 1
+        if self.failures >= self.db_breaker_failures:
+            if not self.breaker_open():
+                self.logger.warning("Database is failing or slow, writing events to '%s' for %.1f seconds",
+                                    self.db_fallback_filename, self.db_breaker_reset)
+            self.breaker_opened = time()
+            # Let the flushes waiting on the queue shed their batches
+            self.dequeued.set()
+
+    def insert(self, batch):
+        """Inserts a batch in a transaction, running on a thread of the
+        pool."""
+        rows = [row for __, row in batch]
+        with self.engine.begin() as connection:
+            if self.db_schema == self.SCHEMA_NORMALIZED:
+                insert_normalized(connection, rows)
+            else:
+                connection.execute(DBEvent.__table__.insert(), rows)
+
+    def insert_batches(self):
+        """Inserts the batches handed off on a thread of the pool, waiting
+        for the result up to the timeout before counting it as failed."""
+        while True:
+            rows = self.queue.get()
+            self.queued -= len(rows)
+            self.dequeued.set()
+            if self.breaker_open():
+                self.shed(rows)
+                continue
+
+            # The first batch after the breaker reset time is a trial
+            probing = self.breaker_opened is not None
+            self.breaker_probing = probing
+            self.inserting += 1
+            batch = [rows, False]
+            self.inflight.append(batch)
+            timed_out = False
+            start = time()
+            result = self.pool.spawn(self.insert, rows)
+            try:
+                try:
+                    result.get(timeout=self.db_timeout)
+                except Timeout:
+                    # The insert can't be cancelled, so keep waiting for it
+                    # with the breaker open
+                    self.timeouts += 1
+                    timed_out = True
+                    self.insert_failed()
+                    result.get()
+            except Exception:
+                self.logger.exception("Failed to insert %d events", len(rows))
+                # A batch that timed out was already counted as failed
+                if not timed_out:
+                    self.rows_failed += len(rows)
+                    self.insert_failed()
+                self.shed(rows)
+                continue
+            finally:
+                if probing:
+                    self.breaker_probing = False
+                self.inserting -= 1
+                batch[1] = True
+                while self.inflight and self.inflight[0][1]:
+                    self.inflight.popleft()
+
+            elapsed = time() - start
+            if elapsed < self.db_timeout:
+                self.failures = 0
+                self.breaker_opened = None
+            self.rows_flushed += len(rows)
+            self.flushes += 1
+            self.flush_time += elapsed
+            self.flush_time_max = max(self.flush_time_max, elapsed)
+            self.logger.debug("Flushed %d events in %.4f seconds", len(rows), elapsed)
+
+    def shed(self, rows):
+        """Writes rows to the fallback file instead of the database."""
+        if self.fallback is None:
+            self.fallback = open(self.db_fallback_filename, "ab")
+        for event_repr, __ in rows:
+            if isinstance(event_repr, text_type):
+                event_repr = event_repr.encode("utf-8")
+            self.fallback.write(event_repr + b"\n")
+        self.fallback.flush()
+        self.rows_shed += len(rows)
+
+    def flush_periodically(self):
+        """Flushes the buffered events when the oldest one exceeds the
+        maximum latency."""
+        timeout = self.db_batch_latency
+        while not self.stopped.wait(timeout):
+            timeout = self.db_batch_latency
+            if self.buffer_started is None:
+                continue
+            age = time() - self.buffer_started
+            if age < self.db_batch_latency:
+                timeout = self.db_batch_latency - age
+                continue
+            self.flush()
+
+    def stats(self):
+        """Returns the counters of the database feed"""
+        return {"rows_buffered": len(self.buffer),
+                "rows_flushed": self.rows_flushed,
+                "rows_failed": self.rows_failed,
+                "rows_shed": self.rows_shed,
+                "rows_queued": self.queued,
+                "batches_queued": self.queue.qsize(),
+                "breaker_open": self.breaker_open(),
+                "timeouts": self.timeouts,
+                "flushes": self.flushes,
+                "flush_time_avg": self.flush_time / self.flushes if self.flushes else 0.0,
+                "flush_time_max": self.flush_time_max}
+
+    def unflushed(self):
+        return len(self.buffer) + self.queued + sum(len(rows) for rows, __ in self.inflight)
 
     def consume(self, queue):
         pass
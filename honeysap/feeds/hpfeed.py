@@ -16,17 +16,36 @@
 #
 
 # Standard imports
-import json
+from time import time
+from random import random
+from collections import deque
 # External imports
+from gevent import socket
+from gevent import spawn, sleep
+from gevent.event import Event
 from hpfeeds import new as new_hpc
+from hpfeeds.protocol import (OP_INFO, OP_ERROR, Unpacker, msgauth,
+                              msgpublish, readinfo, readerror)
 # Custom imports
 from honeysap.core.feed import BaseFeed
+from honeysap.core.event import json_dumps, json_loads
+from honeysap.core.session import dump_event
 
 
 class HPFeed(BaseFeed):
     """ HPFeeds based feed class
+
+    Events are published from a greenlet, so a broker that is slow or not
+    reachable doesn't block the delivery of events. Events are kept in a
+    bounded outbox, dropping the oldest ones when it's full, while the
+    publisher reconnects to the broker with an exponential backoff. Several
+    events can be coalesced in one message, either as a JSON array or as
+    newline-delimited JSON, up to a maximum message size.
     """
 
+    BATCH_JSON = "json"
+    BATCH_LINES = "lines"
+
     @property
     def feed_host(self):
         return self.config.get("feed_host")
@@ -49,40 +68,255 @@ class HPFeed(BaseFeed):
 
     @property
     def channels(self):
-        return self.config.get("channels", None)
+        return self.config.get("channels", ["honeysap.events"])
+
+    #: Maximum number of events kept while the broker is not reachable
+    @property
+    def feed_outbox_size(self):
+        return self.config.get("feed_outbox_size", 10000)
+
+    #: Format of the messages coalescing several events, "json" or "lines"
+    #: (one event per message if not set)
+    @property
+    def feed_batch_format(self):
+        return self.config.get("feed_batch_format", None)
+
+    #: Maximum size in bytes of the messages coalescing several events
+    @property
+    def feed_batch_max_size(self):
+        return self.config.get("feed_batch_max_size", 65536)
+
+    @property
+    def feed_reconnect_delay(self):
+        return self.config.get("feed_reconnect_delay", 1.0)
+
+    @property
+    def feed_reconnect_max_delay(self):
+        return self.config.get("feed_reconnect_max_delay", 60.0)
+
+    #: Seconds to wait for the outbox to be published when stopping
+    @property
+    def feed_stop_timeout(self):
+        return self.config.get("feed_stop_timeout", 5.0)
 
     def setup(self):
-        """Initializes the HPFeed connection"""
-        if self.channels is None:
-            self.channels = ["honeysap.events"]
-        self.hpc = new_hpc(host=self.feed_host,
-                           port=self.feed_port,
-                           ident=self.ident,
-                           secret=self.secret,
-                           timeout=self.feed_timeout)
-        self.logger.debug("Connected to HPFeeds server (%s:%s - %s)",
-                          self.feed_host, self.feed_port, self.ident)
+        """Initializes the outbox, the publisher connects to the HPFeeds
+        server when the first event is logged"""
+        if self.feed_batch_format not in [None, self.BATCH_JSON, self.BATCH_LINES]:
+            raise ValueError("Invalid batch format '%s'" % self.feed_batch_format)
+        self.outbox = deque()
+        self.pending = Event()
+        self.sock = None
+        self.hpc = None
+        self.greenlet = None
+        self.attempts = 0
+        self.dropped = 0
+        self.discarded = 0
+        self.sending = 0
+        self.published = 0
+        self.messages = 0
+        self.reconnects = 0
+        self.latency = 0.0
+        self.latency_max = 0.0
 
     def stop(self):
-        """Stops the HPFeed connection"""
-        self.hpc.close()
+        """Tries to publish the events in the outbox and stops the HPFeed
+        connection, discarding the events not published in time"""
+        if self.greenlet is not None:
+            waited = 0.0
+            while (self.outbox or self.sending) and waited < self.feed_stop_timeout:
+                sleep(0.05)
+                waited += 0.05
+            self.greenlet.kill()
+            self.disconnect()
+            discarded = len(self.outbox) + self.sending
+            if discarded:
+                self.discarded += discarded
+                self.logger.warning("Discarding %d events not published in %.1f seconds",
+                                    discarded, self.feed_stop_timeout)
+            self.outbox.clear()
+            self.sending = 0
+        if self.hpc is not None:
+            self.hpc.stop()
+            self.hpc.close()
         self.logger.debug("Closed communication with HPFeeds server (%s:%s - %s)",
                           self.feed_host, self.feed_port, self.ident)
 
+    def stats(self):
+        return {"outbox": len(self.outbox),
+                "outbox_dropped": self.dropped,
+                "outbox_discarded": self.discarded,
+                "published": self.published,
+                "messages": self.messages,
+                "reconnects": self.reconnects,
+                "publish_latency_avg": self.latency / self.published if self.published else 0.0,
+                "publish_latency_max": self.latency_max}
+
+    def unflushed(self):
+        return len(self.outbox) + self.sending
+
     def log(self, event):
         """Log an event to the feed"""
-        self.hpc.publish(self.channels, repr(event))
+        self.outbox.append((time(), dump_event(event)))
+        if len(self.outbox) > self.feed_outbox_size:
+            self.outbox.popleft()
+            self.dropped += 1
+        if self.greenlet is None:
+            self.greenlet = spawn(self.publish_events)
+        self.pending.set()
+
+    def connect(self):
+        """Connects and authenticates to the HPFeeds server"""
+        sock = socket.create_connection((self.feed_host, self.feed_port),
+                                        timeout=self.feed_timeout)
+        try:
+            unpacker = Unpacker()
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    raise socket.error("Connection closed by the server")
+                unpacker.feed(data)
+                message = next(unpacker, None)
+                if message is not None:
+                    break
+            opcode, data = message
+            if opcode != OP_INFO:
+                raise socket.error("Expected info message from the server")
+            name, rand = readinfo(data)
+            sock.sendall(msgauth(rand, self.ident, self.secret))
+            sock.settimeout(None)
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+        spawn(self.read_errors, sock, unpacker)
+        self.logger.debug("Connected to HPFeeds server %s (%s:%s - %s)",
+                          name, self.feed_host, self.feed_port, self.ident)
+
+    def disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def connection_lost(self, sock, error):
+        if sock is not self.sock:
+            return
+        self.logger.warning("Connection to HPFeeds server (%s:%s) failed: %s",
+                            self.feed_host, self.feed_port, error)
+        self.disconnect()
+        self.reconnects += 1
+        self.pending.set()
+
+    def read_errors(self, sock, unpacker):
+        """Reads the messages sent by the server on a connection, which are
+        only expected to be errors (e.g. failed authentication or publishing
+        to a channel not allowed)."""
+        try:
+            while True:
+                for opcode, data in unpacker:
+                    if opcode == OP_ERROR:
+                        self.logger.warning("HPFeeds server error: %s", readerror(data))
+                data = sock.recv(4096)
+                if not data:
+                    raise socket.error("Connection closed by the server")
+                unpacker.feed(data)
+        except Exception as e:
+            self.connection_lost(sock, e)
+
+    def backoff(self):
+        """Returns the delay before the next connection attempt, doubling it
+        on each failed attempt with a random jitter."""
+        delay = min(self.feed_reconnect_delay * 2 ** self.attempts,
+                    self.feed_reconnect_max_delay)
+        self.attempts += 1
+        return delay * (0.5 + random() / 2)
+
+    def next_batch(self):
+        """Takes the events for the next message from the outbox."""
+        if self.feed_batch_format is None:
+            return [self.outbox.popleft()]
+        batch = [self.outbox.popleft()]
+        size = len(batch[0][1]) + 2
+        while self.outbox and size + len(self.outbox[0][1]) + 1 <= self.feed_batch_max_size:
+            batch.append(self.outbox.popleft())
+            size += len(batch[-1][1]) + 1
+        return batch
+
+    def pack_batch(self, batch):
+        payloads = [payload for __, payload in batch]
+        if self.feed_batch_format == self.BATCH_JSON:
+            return b"[" + b",".join(payloads) + b"]"
+        return b"\n".join(payloads)
+
+    def publish_events(self):
+        """Publishes the events in the outbox, reconnecting to the server
+        when the connection fails."""
+        while True:
+            if not self.outbox:
+                self.pending.clear()
+                self.pending.wait()
+                continue
+            if self.sock is None:
+                try:
+                    self.connect()
+                except Exception as e:
+                    delay = self.backoff()
+                    self.logger.debug("Unable to connect to HPFeeds server (%s:%s), retrying in %.1fs: %s",
+                                      self.feed_host, self.feed_port, delay, e)
+                    sleep(delay)
+                    continue
+                self.attempts = 0
+
+            batch = self.next_batch()
+            message = self.pack_batch(batch)
+            sock = self.sock
+            self.sending = len(batch)
+            try:
+                sock.sendall(b"".join(msgpublish(self.ident, channel, message)
+                                      for channel in self.channels))
+            except Exception as e:
+                # Keep the batch for the next connection, dropping the
+                # oldest events if the outbox filled up in the meantime
+                self.sending = 0
+                self.outbox.extendleft(reversed(batch))
+                while len(self.outbox) > self.feed_outbox_size:
+                    self.outbox.popleft()
+                    self.dropped += 1
+                self.connection_lost(sock, e)
+                sleep(self.backoff())
+                continue
+            self.sending = 0
+            now = time()
+            self.messages += 1
+            self.published += len(batch)
+            for queued_on, __ in batch:
+                self.latency += now - queued_on
+                self.latency_max = max(self.latency_max, now - queued_on)
+
+    def split_message(self, payload):
+        """Splits a message in the events coalesced in it."""
+        if self.feed_batch_format == self.BATCH_LINES:
+            return payload.split(b"\n")
+        if self.feed_batch_format == self.BATCH_JSON:
+            return [json_dumps(fields) for fields in json_loads(payload)]
+        return [payload]
 
     def consume(self, queue):
         """Setup the feed to subscribe to the HPFeed and put the events on
         a queue."""
 
         def on_message(identifier, channel, payload):
-            queue.put(payload)
+            for event in self.split_message(payload):
+                queue.put(event)
 
         def on_error(payload):
             self.hpc.stop()
 
+        self.hpc = new_hpc(host=self.feed_host,
+                           port=self.feed_port,
+                           ident=self.ident,
+                           secret=self.secret,
+                           timeout=self.feed_timeout)
         self.logger.debug("Subscribing to channels %s", self.channels)
         self.hpc.subscribe(self.channels)
         self.hpc.run(on_message, on_error)
@@ -16,45 +16,125 @@
 #
 
 # Standard imports
-import logging
+from time import time, strftime, localtime
 # External imports
+from six import text_type
 # Custom imports
 from honeysap.core.feed import BaseFeed
-from honeysap.core.logger import default_formatter
+from honeysap.core.writer import RotatingWriter
 
 
 class LogFeed(BaseFeed):
-    """Log file based feed class"""
+    """Log file based feed class
 
-    EVENT = 9
+    Events are written as JSON lines through a buffered writer, flushed when
+    the buffer is full or periodically and written on a background thread.
+    Files can be rotated by size or time, keeping a number of rotated files,
+    and compressed while written. The "legacy" format writes the events as
+    the log records of previous versions, prefixed by the logger name, the
+    time and the level.
+    """
+
+    FORMAT_JSON = "json"
+    FORMAT_LEGACY = "legacy"
+
+    legacy_name = "honeysap.events.logfeed"
 
     @property
     def log_filename(self):
         return self.config.get("log_filename", "honeysap.log")
 
+    @property
+    def log_format(self):
+        return self.config.get("log_format", self.FORMAT_JSON)
+
+    #: Bytes buffered before writing to the file
+    @property
+    def log_buffer_size(self):
+        return self.config.get("log_buffer_size", 1048576)
+
+    #: Seconds between flushes of the buffer
+    @property
+    def log_flush_interval(self):
+        return self.config.get("log_flush_interval", 1.0)
+
+    @property
+    def log_rotate_size(self):
+        return self.config.get("log_rotate_size", 0)
+
+    @property
+    def log_rotate_interval(self):
+        return self.config.get("log_rotate_interval", 0)
+
+    @property
+    def log_rotate_keep(self):
+        return self.config.get("log_rotate_keep", 0)
+
+    #: Compression of the files, "gzip" or "zstd"
+    @property
+    def log_compression(self):
+        return self.config.get("log_compression", None)
+
+    @property
+    def log_compression_level(self):
+        return self.config.get("log_compression_level", None)
+
     def setup(self):
         """Initializes the log file"""
-        logging.addLevelName(self.EVENT, "EVENT")
+        if self.log_format not in [self.FORMAT_JSON, self.FORMAT_LEGACY]:
+            raise ValueError("Invalid log format '%s'" % self.log_format)
+        self.writer = RotatingWriter(self.log_filename,
+                                     buffer_size=self.log_buffer_size,
+                                     flush_interval=self.log_flush_interval,
+                                     rotate_size=self.log_rotate_size,
+                                     rotate_interval=self.log_rotate_interval,
+                                     rotate_keep=self.log_rotate_keep,
+                                     compression=self.log_compression,
+                                     compression_level=self.log_compression_level)
+        self.second = None
+        self.asctime = None
+        self.logger.debug("Logging events to filename %s", self.writer.path)
+        if self.log_format == self.FORMAT_LEGACY:
+            self.writer.write(self.legacy_prefix("INFO") + b"Starting log feed\n")
 
-        self.logfile_handler = logging.FileHandler(self.log_filename)
-        self.logfile_handler.setFormatter(default_formatter)
+    def stop(self):
+        """Writes the buffered events and closes the log file"""
+        if self.log_format == self.FORMAT_LEGACY:
+            self.writer.write(self.legacy_prefix("INFO") + b"Stopping log feed\n")
+        self.writer.close()
+        self.logger.debug("Closed log filename %s", self.writer.path)
 
-        self.feed_logger = logging.getLogger("honeysap.events.logfeed")
-        self.feed_logger.setLevel(self.EVENT)
-        self.feed_logger.addHandler(self.logfile_handler)
+    def stats(self):
+        stats = self.writer.stats()
+        return {"lines_written": stats["lines"],
+                "bytes_written": stats["written"],
+                "rotations": stats["rotations"],
+                "write_errors": stats["errors"],
+                "bytes_dropped": stats["dropped"]}
 
-        self.logger.debug("Logging events to filename %s", self.log_filename)
-        self.feed_logger.info("Starting log feed")
+    def unflushed(self):
+        return self.writer.unflushed()
 
-    def stop(self):
-        """Removes the log file handler"""
-        self.feed_logger.info("Stopping log feed")
-        self.feed_logger.removeHandler(self.logfile_handler)
-        self.logger.debug("Closed log filename handler")
+    def legacy_prefix(self, level):
+        """Returns the prefix of a line in the legacy format, as formatted by
+        the default logging formatter, formatting the time only once per
+        second."""
+        now = time()
+        second = int(now)
+        if second != self.second:
+            self.second = second
+            self.asctime = strftime("%Y-%m-%d %H:%M:%S", localtime(second))
+        return ("%s - %s,%03d - %-8s - " % (self.legacy_name, self.asctime,
+                                            (now - second) * 1000, level)).encode("ascii")
 
     def log(self, event):
         """Logs an event in the log file"""
-        self.feed_logger.log(self.EVENT, repr(event))
+        line = repr(event)
+        if isinstance(line, text_type):
+            line = line.encode("utf-8")
+        if self.log_format == self.FORMAT_LEGACY:
+            line = self.legacy_prefix("EVENT") + line
+        self.writer.write(line + b"\n")
 
     def consume(self):
         raise Exception("Log feed can't be consumed")
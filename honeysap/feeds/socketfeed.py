@@ -0,0 +1,98 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+# External imports
+# Custom imports
+from honeysap.core.feed import BaseFeed
+from honeysap.core.session import dump_event
+from honeysap.core.ipc import IPCServer, IPCClient
+
+
+class SocketFeed(BaseFeed):
+    """Feed sending the events to an eater over a Unix or TCP socket, without
+    going through a broker. Sensors connect to the address the eater is
+    listening on and send the events as length-prefixed frames, which are
+    acknowledged by the eater. Events are kept in a bounded backlog while the
+    eater is not reachable, and the ones not acknowledged when a connection
+    fails are sent again.
+    """
+
+    #: Address as "unix:<path>" or "<host>:<port>"
+    @property
+    def feed_address(self):
+        return self.config.get("feed_address", "unix:/tmp/honeysap-feed.sock")
+
+    #: Maximum number of events kept while the eater is not reachable
+    @property
+    def feed_backlog(self):
+        return self.config.get("feed_backlog", 100000)
+
+    #: Maximum number of events sent in one write
+    @property
+    def feed_batch_size(self):
+        return self.config.get("feed_batch_size", 1000)
+
+    #: Maximum number of events sent and not yet acknowledged
+    @property
+    def feed_max_inflight(self):
+        return self.config.get("feed_max_inflight", 10000)
+
+    @property
+    def feed_reconnect_delay(self):
+        return self.config.get("feed_reconnect_delay", 1.0)
+
+    def setup(self):
+        """Initializes the client, which connects when the first event is
+        sent"""
+        self.client = IPCClient(self.feed_address,
+                                max_backlog=self.feed_backlog,
+                                batch_size=self.feed_batch_size,
+                                reconnect_delay=self.feed_reconnect_delay,
+                                acks=True,
+                                max_inflight=self.feed_max_inflight)
+        self.client.run()
+        self.server = None
+
+    def stop(self):
+        """Sends the pending events and closes the connection, or stops
+        listening if consuming"""
+        self.client.stop()
+        if self.server is not None:
+            self.server.stop()
+        self.logger.debug("Closed socket feed (%s)", self.feed_address)
+
+    def stats(self):
+        stats = self.client.stats()
+        return {"backlog": stats["backlog"],
+                "inflight": stats["inflight"],
+                "acked": stats["acked"],
+                "backlog_dropped": stats["dropped"],
+                "reconnects": stats["reconnects"]}
+
+    def unflushed(self):
+        return len(self.client.backlog) + len(self.client.inflight)
+
+    def log(self, event):
+        """Log an event to the feed"""
+        self.client.send(dump_event(event))
+
+    def consume(self, queue):
+        """Listen for sensors and put the events received on a queue."""
+        self.server = IPCServer(self.feed_address, queue.put, acks=True)
+        self.logger.debug("Listening for events on '%s'", self.feed_address)
+        self.server.serve_forever()
@@ -0,0 +1,273 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import os
+import re
+import sqlite3
+from time import time, strftime, localtime
+from datetime import date, timedelta
+from os.path import exists, join
+# External imports
+from gevent import spawn
+from gevent.event import Event
+# Custom imports
+from honeysap.core.feed import BaseFeed
+from honeysap.core.threadpool import ThreadPool
+
+
+class SQLiteFeed(BaseFeed):
+    """Feed storing the events on local SQLite databases, one file per day
+    so old days can be archived or removed by just moving or removing their
+    file.
+
+    Databases are written in WAL mode with synchronous set to NORMAL, so a
+    commit doesn't wait for the data to be synced, and events are inserted
+    in batches with a single prepared statement. Inserts and checkpoints of
+    the WAL run on a background thread, and checkpoints are done
+    periodically instead of on the commits. Days older than
+    `sqlite_retention_days` are removed.
+    """
+
+    partition_re = re.compile(r"^events-(\d{4})-(\d{2})-(\d{2})\.sqlite$")
+
+    create_statement = "CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, " \
+                       "session TEXT, timestamp TEXT, service TEXT, source_ip TEXT, event TEXT)"
+    insert_statement = "INSERT INTO events (session, timestamp, service, source_ip, event) " \
+                       "VALUES (?, ?, ?, ?, ?)"
+
+    @property
+    def sqlite_directory(self):
+        return self.config.get("sqlite_directory", "honeysap-events")
+
+    @property
+    def sqlite_batch_size(self):
+        return self.config.get("sqlite_batch_size", 1000)
+
+    @property
+    def sqlite_batch_latency(self):
+        return self.config.get("sqlite_batch_latency", 1.0)
+
+    @property
+    def sqlite_synchronous(self):
+        return self.config.get("sqlite_synchronous", "NORMAL")
+
+    @property
+    def sqlite_checkpoint_interval(self):
+        return self.config.get("sqlite_checkpoint_interval", 60.0)
+
+    #: Number of days kept, including today, or 0 to keep all of them
+    @property
+    def sqlite_retention_days(self):
+        return self.config.get("sqlite_retention_days", 0)
+
+    def setup(self):
+        """Initializes the thread writing to the databases"""
+        if not exists(self.sqlite_directory):
+            os.makedirs(self.sqlite_directory)
+        self.pool = ThreadPool(1)
+        self.pending = None
+        self.connections = {}
+
+        # Rows pending to be inserted, by day
+        self.buffer = {}
+        self.buffered = 0
+        self.buffer_started = None
+        self.second = None
+        self.second_prefix = None
+
+        # Counters
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.flushes = 0
+        self.flush_time = 0.0
+        self.flush_time_max = 0.0
+        self.checkpoints = 0
+        self.partitions_removed = 0
+
+        self.stopped = Event()
+        self.flusher = spawn(self.flush_periodically)
+        self.checkpointer = None
+        if self.sqlite_checkpoint_interval:
+            self.checkpointer = spawn(self.checkpoint_periodically)
+        self.logger.debug("Storing events on '%s'", self.sqlite_directory)
+
+    def stop(self):
+        """Writes the pending events, checkpoints and closes the databases"""
+        self.stopped.set()
+        self.flush(wait=True)
+        self.pool.spawn(self.close_connections).get()
+        self.pool.kill()
+        self.logger.debug("Closed databases on '%s'", self.sqlite_directory)
+
+    def log(self, event):
+        """Logs an event in the database of its day"""
+        session = event.session
+        # Format the time as str(event.timestamp) would, formatting the
+        # date and time only once per second
+        second, microsecond = divmod(int(round(event.time * 1000000)), 1000000)
+        if second != self.second:
+            self.second = second
+            self.second_prefix = strftime("%Y-%m-%d %H:%M:%S", localtime(second))
+        timestamp = "%s.%06d" % (self.second_prefix, microsecond)
+        day = self.second_prefix[:10]
+        rows = self.buffer.get(day)
+        if rows is None:
+            rows = self.buffer[day] = []
+        rows.append((str(session.uuid), timestamp, session.service,
+                     session.source_ip, repr(event)))
+        if not self.buffered:
+            self.buffer_started = time()
+        self.buffered += 1
+        if self.buffered >= self.sqlite_batch_size:
+            self.flush()
+
+    def flush(self, wait=False):
+        """Inserts the buffered events on the background thread, waiting for
+        the previous insert to finish."""
+        if self.buffered:
+            partitions, count = self.buffer, self.buffered
+            self.buffer, self.buffered, self.buffer_started = {}, 0, None
+            self.wait()
+            self.pending = (self.pool.spawn(self.write, partitions), count)
+        if wait:
+            self.wait()
+
+    def wait(self):
+        """Waits until the pending insert finishes."""
+        if self.pending is not None:
+            (pending, count), self.pending = self.pending, None
+            try:
+                elapsed = pending.get()
+            except Exception:
+                self.rows_failed += count
+                self.logger.exception("Failed to insert %d events", count)
+                return
+            self.rows_written += count
+            self.flushes += 1
+            self.flush_time += elapsed
+            self.flush_time_max = max(self.flush_time_max, elapsed)
+
+    def unflushed(self):
+        unflushed = self.buffered
+        if self.pending is not None and not self.pending[0].ready():
+            unflushed += self.pending[1]
+        return unflushed
+
+    def connection(self, day):
+        """Returns the connection to the database of a day, creating it if
+        needed. Runs on the background thread."""
+        connection = self.connections.get(day)
+        if connection is None:
+            path = join(self.sqlite_directory, "events-%s.sqlite" % day)
+            connection = sqlite3.connect(path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=%s" % self.sqlite_synchronous)
+            if self.sqlite_checkpoint_interval:
+                connection.execute("PRAGMA wal_autocheckpoint=0")
+            connection.execute(self.create_statement)
+            self.connections[day] = connection
+            self.logger.debug("Opened database '%s'", path)
+        return connection
+
+    def write(self, partitions):
+        """Inserts the rows of each day in a transaction. Runs on the
+        background thread and returns the time it took."""
+        start = time()
+        for day, rows in partitions.items():
+            connection = self.connection(day)
+            with connection:
+                connection.executemany(self.insert_statement, rows)
+        return time() - start
+
+    def flush_periodically(self):
+        """Flushes the buffered events when the oldest one exceeds the
+        maximum latency."""
+        timeout = self.sqlite_batch_latency
+        while not self.stopped.wait(timeout):
+            timeout = self.sqlite_batch_latency
+            if self.buffer_started is None:
+                continue
+            age = time() - self.buffer_started
+            if age < self.sqlite_batch_latency:
+                timeout = self.sqlite_batch_latency - age
+                continue
+            try:
+                self.flush()
+                self.wait()
+            except Exception:
+                self.logger.exception("Failed to flush events")
+
+    def checkpoint(self, today=None):
+        """Checkpoints the WAL of the open databases, closes the ones of past
+        days and removes the expired days. Runs on the background thread."""
+        today = today or date.today()
+        for day, connection in list(self.connections.items()):
+            connection.execute("PRAGMA wal_checkpoint(PASSIVE)")
+            # Keep the previous day open for events arriving late
+            if day < str(today - timedelta(days=1)):
+                connection.close()
+                del self.connections[day]
+        self.checkpoints += 1
+        if self.sqlite_retention_days:
+            self.remove_partitions(today - timedelta(days=self.sqlite_retention_days - 1))
+
+    def remove_partitions(self, oldest):
+        """Removes the databases of the days before a given one."""
+        for filename in os.listdir(self.sqlite_directory):
+            match = self.partition_re.match(filename)
+            if not match or date(*map(int, match.groups())) >= oldest:
+                continue
+            day = "-".join(match.groups())
+            if day in self.connections:
+                self.connections.pop(day).close()
+            for suffix in ("", "-wal", "-shm"):
+                path = join(self.sqlite_directory, filename + suffix)
+                if exists(path):
+                    os.remove(path)
+            self.partitions_removed += 1
+            self.logger.info("Removed expired database '%s'", filename)
+
+    def checkpoint_periodically(self):
+        while not self.stopped.wait(self.sqlite_checkpoint_interval):
+            try:
+                self.pool.spawn(self.checkpoint).get()
+            except Exception:
+                self.logger.exception("Failed to checkpoint databases")
+
+    def close_connections(self):
+        """Checkpoints the WAL and closes all the databases. Runs on the
+        background thread."""
+        for connection in self.connections.values():
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            connection.close()
+        self.connections = {}
+
+    def stats(self):
+        """Returns the counters of the feed"""
+        return {"rows_buffered": self.buffered,
+                "rows_written": self.rows_written,
+                "rows_failed": self.rows_failed,
+                "flushes": self.flushes,
+                "flush_time_avg": self.flush_time / self.flushes if self.flushes else 0.0,
+                "flush_time_max": self.flush_time_max,
+                "partitions": len(self.connections),
+                "partitions_removed": self.partitions_removed,
+                "checkpoints": self.checkpoints}
+
+    def consume(self, queue):
+        pass
@@ -16,10 +16,12 @@
 #
 
 # Standard imports
-import socket
+from time import time
 # External imports
+from gevent import socket
+from gevent.pool import Pool
+from gevent import spawn, wait, killall
 from gevent.event import Event as gEvent
-from gevent.select import select
 from scapy.supersocket import StreamSocket
 # Custom imports
 from honeysap.core.event import Event
@@ -94,10 +96,35 @@ class ForwarderService(BaseService):
     def backlog(self):
         return self.config.get("backlog", 5)
 
-    #: The MTU to use when receiving and sending packets
+    #: The size of the buffer used when receiving and sending data
     @property
-    def mtu(self):
-        return self.config.get("mtu", 2048)
+    def buffer_size(self):
+        return self.config.get("buffer_size", self.config.get("mtu", 65536))
+
+    #: What to capture from the forwarded traffic: the full payload, the
+    #: first capture_bytes of each direction or only the byte counters
+    @property
+    def capture(self):
+        return self.config.get("capture", self.CAPTURE_FULL)
+
+    #: Number of bytes to capture per direction in head capture mode
+    @property
+    def capture_bytes(self):
+        return self.config.get("capture_bytes", 4096)
+
+    #: Maximum number of concurrent client connections
+    @property
+    def max_connections(self):
+        return self.config.get("max_connections", 100)
+
+    #: Seconds without traffic after which a connection is closed
+    @property
+    def idle_timeout(self):
+        return self.config.get("idle_timeout", 300)
+
+    CAPTURE_FULL = "full"
+    CAPTURE_HEAD = "head"
+    CAPTURE_COUNTERS = "counters"
 
     def setup_server(self):
         super(ForwarderService, self).setup_server()
@@ -105,9 +132,15 @@ class ForwarderService(BaseService):
         # Create an event for stopping the handle loop
         self.stopped = gEvent()
 
+        if self.capture not in [self.CAPTURE_FULL, self.CAPTURE_HEAD,
+                                self.CAPTURE_COUNTERS]:
+            raise ValueError("Invalid capture mode '%s'" % self.capture)
+
         # Create and bind the listener socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         # If the server is not virtual, bind and listen to the
         # specified address/port
@@ -120,24 +153,17 @@ class ForwarderService(BaseService):
         # If is not virtual, wait until a client connection arrives
         if not self.virtual:
 
+            # Each client connection is handled on its own greenlet, up to
+            # the maximum number of connections
+            self.pool = Pool(self.max_connections or None)
             try:
                 while not self.stopped.is_set():
+                    # Wait for a free slot before accepting new clients
+                    self.pool.wait_available()
+
                     # Connects with the client
                     (client, client_address) = self.listener.ins.accept()
-
-                    # Connects with the target
-                    remote = self.create_remote(client_address,
-                                                self.target_address,
-                                                self.target_port)
-
-                    # Handle the messages until the service is stopped
-                    try:
-                        while not self.stopped.is_set():
-                            self.handle(remote, client, client_address)
-                    # If a socket error was raised, we should continue
-                    # to allow other connections
-                    except socket.error as e:
-                        continue
+                    self.pool.spawn(self.handle_client, client, client_address)
 
             # Other exceptions should be raised
             except Exception as e:
@@ -150,11 +176,11 @@ class ForwarderService(BaseService):
     def create_remote(self, client_address, host, port):
         # Creates a session for registering the events
         (client_ip, client_port) = client_address
-        self.session = self.session_manager.get_session("forwarder",
-                                                        client_ip,
-                                                        client_port,
-                                                        self.target_address,
-                                                        self.target_port)
+        session = self.session_manager.get_session("forwarder",
+                                                   client_ip,
+                                                   client_port,
+                                                   self.target_address,
+                                                   self.target_port)
 
         self.logger.debug("Connecting client %s:%s to remote %s:%d" % (client_ip,
                                                                        client_port,
@@ -163,58 +189,112 @@ class ForwarderService(BaseService):
         remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         remote.connect((host, port))
 
-        self.session.add_event("Connected to target", data={"target_host": host,
-                                                            "target_port": port})
+        session.add_event("Connected to target", data={"target_host": host,
+                                                       "target_port": port})
         # Wrap it into a StreamSocket so both remote and client are
         # StreamSockets
-        return StreamSocket(remote)
+        return session, StreamSocket(remote)
+
+    def handle_client(self, client, client_address):
+        """Handles a client connection accepted by the listener."""
+        client = StreamSocket(client)
+        try:
+            self.handle_virtual(client, client_address)
+        finally:
+            client.close()
 
     def handle_virtual(self, client, client_address):
 
         # Connects with the target
-        remote = self.create_remote(client_address,
-                                    self.target_address,
-                                    self.target_port)
+        try:
+            session, remote = self.create_remote(client_address,
+                                                 self.target_address,
+                                                 self.target_port)
+        # If the target is not reachable, we should continue to allow other
+        # connections
+        except socket.error as e:
+            self.logger.error("Unable to connect to target: %s", e)
+            return
+
+        # Relay the traffic until one of the peers disconnects, the
+        # connection is idle or the service is stopped
+        self.relay(session, remote, client)
+
+    def relay(self, session, server, client):
+        """Relays the traffic between the client and the server using a
+        greenlet for each direction, until one of the peers disconnects, the
+        connection is idle for longer than the idle timeout or the service is
+        stopped."""
+        counters = {True: 0, False: 0}
+        # Work with the underlying sockets of the StreamSockets
+        pumps = [spawn(self.pump, client.ins, server.ins, session, counters, True),
+                 spawn(self.pump, server.ins, client.ins, session, counters, False)]
+
+        idle_timeout = self.idle_timeout
+        while True:
+            timeout = None
+            if idle_timeout:
+                timeout = max(session.last_seen + idle_timeout - time(), 0)
+            if wait(pumps + [self.stopped], count=1, timeout=timeout):
+                reason = "stopped" if self.stopped.is_set() else "closed"
+                break
+            if time() - session.last_seen >= idle_timeout:
+                reason = "idle"
+                break
+        killall(pumps)
+
+        # Close the connection with the target, the client's socket is
+        # owned by the caller
+        server.close()
+
+        session.add_event("Forwarding finished",
+                          data={"target_host": self.target_address,
+                                "target_port": self.target_port,
+                                "reason": reason,
+                                "request_bytes": counters[True],
+                                "response_bytes": counters[False]})
+
+    def pump(self, local, remote, session, counters, request):
+        """Receives data from the local peer into a reusable buffer and sends
+        it to the remote peer, capturing it according to the capture mode."""
+        buffer = bytearray(self.buffer_size)
+        view = memoryview(buffer)
+        capture = self.capture
+        capture_bytes = self.capture_bytes
 
-        # Handle the messages until the service is stopped
         try:
-            while not self.stopped.is_set():
-                self.handle(remote, client, client_address)
-        except:
-            pass
-
-    def handle(self, server, client, client_address):
-        # Simple select bag with client and server sockets
-        r, __, __ = select([client, server], [], [], 0.5)
-        if client in r:
-            self.recv_send(client, server, request=True)
-        if server in r:
-            self.recv_send(server, client, request=False)
-
-    def recv_send(self, local, remote, request):
-
-        # Receive data from the local peer
-        data = local.recv(self.mtu)
-
-        # If we received zero bytes, the connection got down, raise the
-        # exception so we can exit the loop and accept other clients
-        if len(data) == 0:
-            raise socket.error((100, "Underlying stream socket tore down"))
-
-        # Record the event
+            while True:
+                # If we received zero bytes, the connection got down
+                length = local.recv_into(buffer)
+                if length == 0:
+                    break
+
+                # Capture the packet before sending it, as the buffer is
+                # reused for the next one
+                session.last_seen = time()
+                captured = counters[request]
+                counters[request] += length
+                if capture == self.CAPTURE_FULL:
+                    self.record(session, view[:length].tobytes(), request)
+                elif capture == self.CAPTURE_HEAD and captured < capture_bytes:
+                    self.record(session, view[:min(length, capture_bytes - captured)].tobytes(), request)
+
+                # Send it to the remote peer
+                remote.sendall(view[:length])
+        except socket.error as e:
+            self.logger.debug("Forwarding stopped: %s", e)
+
+    def record(self, session, data, request):
+        """Records a forwarded packet in the session."""
         event = Event("Forwarding packet",
                       data={"target_host": self.target_address,
                             "target_port": self.target_port})
 
-        # Add the entire packet to the event
-        data = str(data)
+        # Add the packet to the event
         if request:
             event.request = data
         else:
             event.response = data
 
         # Register the event
-        self.session.add_event(event)
-
-        # Send it to the remote peer
-        remote.send(data)
+        session.add_event(event)
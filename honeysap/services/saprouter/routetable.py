@@ -16,7 +16,10 @@
 #
 
 # Standard imports
-
+import shlex
+from bisect import bisect_right
+from fnmatch import translate
+from re import compile as re_compile, IGNORECASE
 # External imports
 from six import string_types
 from six.moves import range
@@ -33,8 +36,113 @@ class InvalidRouteTableEntry(Exception):
     """The entry in the route table is invalid"""
 
 
+def parse_saprouttab(lines):
+    """Parses the lines of a saprouttab file and returns a list of route
+    table entries in the order they appear in the file.
+
+    Each line has the format `<type> <source> <target> <service> [<password>]`,
+    where the type is one of `P` (permit), `S` (permit only NI connections),
+    `D` (deny) or the SNC variants `KP`, `KS` and `KT`. Hosts can be
+    hostnames, addresses, networks or wildcard patterns using `*`, and `$`
+    matches a single character in hostnames and a single digit in services.
+    Services can be port numbers, `*`, or `sapdpNN`/`sapgwNN` names. Fields
+    can be quoted, as SNC names usually contain spaces. Empty lines and
+    comments starting with `#` are ignored.
+    """
+    types = {"P": ("allow", "any"),
+             "S": ("allow", "ni"),
+             "D": ("deny", "any"),
+             "KP": ("allow", "any"),
+             "KS": ("allow", "ni"),
+             "KT": ("allow", "any")}
+    entries = []
+    for line in lines:
+        try:
+            fields = shlex.split(line, comments=True)
+        except ValueError:
+            raise InvalidRouteTableEntry("Invalid saprouttab line '%s'" % line.strip())
+        if not fields:
+            continue
+        if len(fields) < 4 or fields[0].upper() not in types:
+            raise InvalidRouteTableEntry("Invalid saprouttab line '%s'" % line.strip())
+        action, mode = types[fields[0].upper()]
+        source = fields[1]
+        # SNC names can't be matched against the client address
+        if fields[0].upper().startswith("K"):
+            source = "*"
+        entries.append({"action": action,
+                        "mode": mode,
+                        "source": source,
+                        "target": fields[2],
+                        "port": fields[3],
+                        "password": fields[4] if len(fields) > 4 else None})
+    return entries
+
+
+class AddressIndex(object):
+    """Index of address intervals. The address space is split in elementary
+    segments at the boundaries of the intervals, and the intervals are
+    stored in a segment tree over them: each rule is held by the O(log N)
+    nodes whose segments it covers entirely, instead of by every segment it
+    covers. Looking up an address is a binary search over the segments
+    boundaries, followed by a walk up from its segment to the root.
+    """
+
+    def __init__(self):
+        self.intervals = []
+        self.boundaries = []
+        self.size = 0
+        self.nodes = {}
+
+    def add(self, first, last, rule):
+        self.intervals.append((first, last, rule))
+
+    def build(self):
+        """Builds the segment tree from the intervals added"""
+        points = set()
+        for first, last, __ in self.intervals:
+            points.add(first)
+            points.add(last + 1)
+        self.boundaries = sorted(points)
+        self.size = 1
+        while self.size < len(self.boundaries):
+            self.size *= 2
+        self.nodes = {}
+        for first, last, rule in self.intervals:
+            begin = bisect_right(self.boundaries, first) - 1 + self.size
+            end = bisect_right(self.boundaries, last + 1) - 1 + self.size
+            while begin < end:
+                if begin & 1:
+                    self.nodes.setdefault(begin, []).append(rule)
+                    begin += 1
+                if end & 1:
+                    end -= 1
+                    self.nodes.setdefault(end, []).append(rule)
+                begin >>= 1
+                end >>= 1
+        self.intervals = []
+
+    def lookup(self, value):
+        """Returns the sorted list of rules covering an address"""
+        segment = bisect_right(self.boundaries, value) - 1
+        if segment < 0:
+            return []
+        rules = []
+        node = segment + self.size
+        while node:
+            rules.extend(self.nodes.get(node, ()))
+            node >>= 1
+        rules.sort()
+        return rules
+
+
 class RouteTable(Loggeable):
     """A class for storing and handling the route table information.
+
+    Entries are compiled into an index of address intervals and hostnames,
+    instead of being expanded into each host/port pair they cover. When
+    several entries match a target, the one appearing last in the route
+    table takes precedence.
     """
 
     # Constants for actions
@@ -47,9 +155,24 @@ class RouteTable(Loggeable):
     MODE_NI = 0
     # TODO: Implement route_io mode
 
+    # Constants for host matching
+    HOST_ANY = 0
+    HOST_ADDRESSES = 1
+    HOST_NAME = 2
+    HOST_PATTERN = 3
+
     def __init__(self, route_table):
         self.route_table = self.build_table(route_table)
 
+    @classmethod
+    def from_saprouttab(cls, filename):
+        """Builds a route table from a saprouttab file. The first matching
+        line in a saprouttab has precedence, so entries are added in reverse
+        order."""
+        with open(filename, "r") as fd:
+            entries = parse_saprouttab(fd)
+        return cls(list(reversed(entries)))
+
     def parse_route_entry(self, entry):
         """Parses a route table entry.
         """
@@ -84,60 +207,212 @@ class RouteTable(Loggeable):
         return action, talk_mode, target, port, password
 
     def parse_target_ports(self, ports):
-        """Parses a list of ports"""
+        """Parses a port or range of ports and returns the first and last
+        port, along with the pattern to match if the ports contain
+        wildcards."""
+        if ports == "*":
+            return 0, 65535, None
+        if isinstance(ports, string_types):
+            # Translate SAP service names, with instance numbers or single
+            # digit wildcards
+            for service, base in (("sapdp", 32), ("sapgw", 33)):
+                number = ports[len(service):]
+                if ports.lower().startswith(service) and len(number) == 2 and \
+                   all(digit.isdigit() or digit == "$" for digit in number):
+                    ports = "%d%s" % (base, number)
+            # Match wildcards the same way as in host patterns, within the
+            # range of ports they can match
+            if "*" in ports or "$" in ports:
+                if not all(char.isdigit() or char in "*$" for char in ports):
+                    raise InvalidRouteTableEntry
+                pattern = re_compile(translate(ports.replace("$", "?")))
+                if "*" in ports:
+                    return 0, 65535, pattern
+                return int(ports.replace("$", "0")), int(ports.replace("$", "9")), pattern
         try:
             begin, end = ports.split("-")
         except (AttributeError, ValueError):
             begin, end = ports, ports
 
-        return range(int(begin), int(end) + 1)
+        try:
+            return int(begin), int(end), None
+        except ValueError:
+            raise InvalidRouteTableEntry
+
+    def parse_target_hosts(self, hosts):
+        """Parses a target host specification and returns how it should be
+        matched along with the address intervals (first address, last address
+        and version) or the hostname to match."""
+        hosts = str(hosts).strip()
+        if hosts == "*":
+            return self.HOST_ANY, None
 
-    def parse_target_hosts(self, hosts, port):
-        """Parses a list of hosts"""
         if netaddr:
+            address = hosts.split("/", 1)[0]
+            if netaddr.valid_ipv4(address, netaddr.INET_PTON) or \
+               netaddr.valid_ipv6(address, netaddr.INET_PTON):
+                network = netaddr.IPNetwork(hosts)
+                return self.HOST_ADDRESSES, [(network.first, network.last, network.version)]
+
+            if netaddr.valid_glob(hosts):
+                glob = netaddr.IPGlob(hosts)
+                return self.HOST_ADDRESSES, [(glob.first, glob.last, glob.version)]
+
             if netaddr.valid_nmap_range(hosts):
+                intervals = []
                 for ip in netaddr.iter_nmap_range(hosts):
-                    yield str(ip), port
-            else:
-                for ip in netaddr.iter_unique_ips(hosts):
-                    yield str(ip), port
-        else:
-            yield hosts, port
+                    if intervals and intervals[-1][1] + 1 == ip.value:
+                        intervals[-1][1] = ip.value
+                    else:
+                        intervals.append([ip.value, ip.value, ip.version])
+                return self.HOST_ADDRESSES, [tuple(interval) for interval in intervals]
+
+        if "*" in hosts or "$" in hosts:
+            return self.HOST_PATTERN, re_compile(translate(hosts.replace("$", "?")), IGNORECASE)
+
+        return self.HOST_NAME, hosts.lower()
+
+    def parse_source(self, entry):
+        """Parses the optional source host specification of an entry. Returns
+        None if the entry applies to any source."""
+        source = entry.get("source", "*") if isinstance(entry, dict) else "*"
+        if source in (None, "*"):
+            return None
+        return self.parse_target_hosts(source)
+
+    def match_source(self, source, host):
+        """Checks if a host matches a source host specification"""
+        if host is None:
+            return False
+        host_type, hosts = source
+        if host_type == self.HOST_ADDRESSES:
+            address = self.parse_address(host)
+            if address is None:
+                return False
+            value, version = address
+            return any(first <= value <= last and version == hosts_version
+                       for first, last, hosts_version in hosts)
+        elif host_type == self.HOST_PATTERN:
+            return hosts.match(str(host)) is not None
+        return hosts == str(host).lower()
+
+    def parse_address(self, host):
+        """Parses a target host as an address and returns the address value
+        and version, or None if it's not an address."""
+        if netaddr:
+            try:
+                address = netaddr.IPAddress(host, flags=netaddr.INET_PTON)
+                return address.value, address.version
+            except (netaddr.AddrFormatError, ValueError, TypeError):
+                pass
+        return None
 
     def build_table(self, route_table):
         """Builds an internal structure for performing lookups on the
         route table.
         """
-        self.table = {}
+        self.entries = []
+        self.addresses = {4: AddressIndex(), 6: AddressIndex()}
+        self.hostnames = {}
+        self.patterns = []
+        self.any = []
+
         if route_table is None:
             self.logger.debug("Empty route table, denying everything")
-            return self.table
+            return self.entries
 
         if netaddr is None:
-            self.logger.warning("netaddr library not available, not expanding network ranges")
+            self.logger.warning("netaddr library not available, not parsing network ranges")
 
         for entry in route_table:
             # Try to parse the entry
             try:
                 action, talk_mode, target, port, password = self.parse_route_entry(entry)
+                first_port, last_port, port_pattern = self.parse_target_ports(port)
+                host_type, hosts = self.parse_target_hosts(target)
+                source = self.parse_source(entry)
             except InvalidRouteTableEntry:
                 continue
 
-            # Expand ports and targets and store the data on the internal table
-            for port in self.parse_target_ports(port):
-                for (host, port) in self.parse_target_hosts(target, port):
-                    self.table[(host, port)] = (action, talk_mode, password)
+            # Later entries have precedence, so rules are sorted by their
+            # negated position in the table
+            rule = (-len(self.entries), first_port, last_port,
+                    (action, talk_mode, password), source, port_pattern)
+            self.entries.append((target, port, rule))
+
+            if host_type == self.HOST_ANY:
+                self.any.append(rule)
+                for index in self.addresses.values():
+                    index.add(0, 2 ** 128, rule)
+            elif host_type == self.HOST_ADDRESSES:
+                for first, last, version in hosts:
+                    self.addresses[version].add(first, last, rule)
+            elif host_type == self.HOST_PATTERN:
+                self.patterns.append((hosts, rule))
+            else:
+                self.hostnames.setdefault(hosts, []).append(rule)
+
+        # Compile the address index and merge the rules matching any host into
+        # the hostnames rules
+        for index in self.addresses.values():
+            index.build()
+        for hostname, rules in self.hostnames.items():
+            rules.extend(self.any)
+            rules.sort()
+        self.any.sort()
+
+        self.logger.debug("Using route table with %d entries", len(self.entries))
+        return self.entries
+
+    @property
+    def table(self):
+        """Returns the route table expanded into a dict with an entry for each
+        host/port pair. The expansion can be expensive for large ranges and is
+        only intended for inspecting the route table."""
+        table = {}
+        for target, port, (__, first_port, last_port, result, __, port_pattern) in self.entries:
+            if netaddr and self.parse_target_hosts(target)[0] == self.HOST_ADDRESSES:
+                if netaddr.valid_nmap_range(target):
+                    hosts = [str(ip) for ip in netaddr.iter_nmap_range(target)]
+                else:
+                    hosts = [str(ip) for ip in netaddr.iter_unique_ips(target)]
+            else:
+                hosts = [target]
+            for port in range(first_port, last_port + 1):
+                if port_pattern is not None and not port_pattern.match(str(port)):
+                    continue
+                for host in hosts:
+                    table[(host, port)] = result
+        return table
+
+    def lookup_rules(self, host):
+        """Returns the rules that match a target host sorted by precedence"""
+        address = self.parse_address(host)
+        if address is not None:
+            value, version = address
+            return self.addresses[version].lookup(value)
 
-        self.logger.debug("Using route table: %s" % self.table)
+        host = str(host).lower()
+        rules = self.hostnames.get(host, self.any)
+        if self.patterns:
+            matching = [rule for pattern, rule in self.patterns if pattern.match(host)]
+            if matching:
+                rules = sorted(rules + matching)
+        return rules
 
-    def lookup_target(self, host, port):
+    def lookup_target(self, host, port, source=None):
         """Performs a lookup of a target host/port and returns the action to
-        perform.
+        perform. Entries restricted to a source host only match if the
+        source host is provided.
         """
 
-        # If the entry is present, return the info stored there
-        if (host, port) in self.table:
-            return self.table[(host, port)]
+        # Return the info stored in the first rule matching the port and the
+        # source host
+        for __, first_port, last_port, result, rule_source, port_pattern in self.lookup_rules(host):
+            if first_port <= port <= last_port and \
+               (port_pattern is None or port_pattern.match(str(port))):
+                if rule_source is None or self.match_source(rule_source, source):
+                    return result
 
         # Denies the connections by default if no matches on the table
         return self.ROUTE_DENY, self.MODE_ANY, None
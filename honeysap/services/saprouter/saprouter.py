@@ -16,13 +16,18 @@
 #
 
 # Standard imports
+from os import stat
+from signal import SIGHUP
 from datetime import datetime
 # External imports
 from scapy.packet import Raw
 from scapy.utils import hexdump
 from scapy.supersocket import StreamSocket
 
+from gevent import spawn, signal
 from gevent.timeout import Timeout
+from gevent.lock import Semaphore
+from gevent.event import Event
 
 from pysap.SAPNI import SAPNIServerThreaded, SAPNIServerHandler, SAPNIClient
 from pysap.SAPRouter import (SAPRouter, SAPRouterError, SAPRouterInfoClient,
@@ -33,6 +38,7 @@ from pysap.SAPRouter import (SAPRouter, SAPRouterError, SAPRouterInfoClient,
 # Custom imports
 from honeysap.core.logger import Loggeable
 from honeysap.core.service import BaseTCPService
+from honeysap.core.threadpool import ThreadPool
 
 from .routetable import RouteTable
 
@@ -259,7 +265,8 @@ class SAPRouterServerHandler(Loggeable, SAPNIServerHandler):
         """
         route_string = pkt.route_string[pkt.route_rest_nodes]
         (action, talk_mode, password) = self.server.route_table.lookup_target(route_string.hostname,
-                                                                              int(route_string.port))
+                                                                              int(route_string.port),
+                                                                              self.client_address[0])
 
         if action == RouteTable.ROUTE_DENY:
             self.logger.debug("Route to %s:%s denied" % (route_string.hostname,
@@ -500,15 +507,97 @@ class SAPRouterServerThreaded(Loggeable, SAPNIServerThreaded):
 
 
 class SAPRouterService(BaseTCPService):
+    """SAP Router service. The route table can be provided as a list of
+    entries in the `route_table` option, or loaded from a saprouttab file
+    specified in the `route_table_file` option. When `route_table_reload` is
+    enabled, the saprouttab file is reloaded on SIGHUP or when its
+    modification time changes, without restarting the listener. Reloaded
+    tables are parsed and built on a separate thread, so route requests keep
+    being served with the current table in the meantime.
+    """
 
     server_cls = SAPRouterServerThreaded
     handler_cls = SAPRouterServerHandler
 
+    @property
+    def route_table_file(self):
+        return self.config.get("route_table_file", None)
+
+    @property
+    def route_table_reload(self):
+        return self.config.get("route_table_reload", False)
+
+    @property
+    def route_table_reload_interval(self):
+        return self.config.get("route_table_reload_interval", 5)
+
     def setup_server(self):
         super(SAPRouterService, self).setup_server()
-        self.server.route_table = RouteTable(self.config.get("route_table", None))
+        self.stopped = Event()
+        self.route_table_mtime = None
+        self.route_table_lock = Semaphore()
+        self.route_table_pool = ThreadPool(1)
+        if self.route_table_file:
+            self.route_table_mtime = stat(self.route_table_file).st_mtime
+            self.server.route_table = self.load_route_table()
+        else:
+            self.server.route_table = RouteTable(self.config.get("route_table", None))
         self.server.listener_port = self.listener_port
         self.server.listener_address = self.listener_address
         # Generates a random pid and records the time when the service started
         self.server.pid = self.server.config.get("pid", None)
         self.server.time_started = self.server.config.get("time_started", datetime.today())
+
+    def load_route_table(self):
+        """Loads the route table from the saprouttab file"""
+        route_table = RouteTable.from_saprouttab(self.route_table_file)
+        self.logger.info("Loaded route table from '%s' with %d entries",
+                         self.route_table_file, len(route_table.entries))
+        return route_table
+
+    def reload_route_table(self):
+        """Reloads the route table from the saprouttab file. The new table is
+        built on the route table thread and swapped once complete, so route
+        requests being handled use either the old or the new table. Reloads
+        triggered by SIGHUP and by the file watcher are serialized."""
+        with self.route_table_lock:
+            try:
+                mtime = stat(self.route_table_file).st_mtime
+            except OSError:
+                self.logger.exception("Failed to reload route table from '%s', keeping the current one",
+                                      self.route_table_file)
+                return
+            try:
+                self.server.route_table = self.route_table_pool.spawn(self.load_route_table).get()
+            except Exception:
+                self.logger.exception("Failed to reload route table from '%s', keeping the current one",
+                                      self.route_table_file)
+            # An invalid file isn't reloaded again until it's modified
+            self.route_table_mtime = mtime
+
+    def check_route_table(self):
+        """Reloads the route table if the saprouttab file was modified"""
+        try:
+            mtime = stat(self.route_table_file).st_mtime
+        except OSError:
+            return
+        if mtime != self.route_table_mtime:
+            self.reload_route_table()
+
+    def watch_route_table(self):
+        """Periodically checks the saprouttab file for modifications"""
+        while not self.stopped.wait(self.route_table_reload_interval):
+            self.check_route_table()
+
+    def run(self):
+        """Watch the saprouttab file for reloading it and run the server"""
+        if self.route_table_file and self.route_table_reload:
+            signal(SIGHUP, self.reload_route_table)
+            spawn(self.watch_route_table)
+        super(SAPRouterService, self).run()
+
+    def stop(self):
+        """Stops watching the saprouttab file and the server"""
+        self.stopped.set()
+        self.route_table_pool.kill()
+        super(SAPRouterService, self).stop()
@@ -0,0 +1,194 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+from collections import OrderedDict
+# External imports
+# Custom imports
+from honeysap.core.event import Event
+from honeysap.core.stage import BaseStage
+
+
+class Window(object):
+    """Counters of the events of a given type in a session during a time
+    window."""
+
+    __slots__ = ("start", "session", "count", "request_bytes", "response_bytes",
+                 "first_seen", "last_seen", "return_codes")
+
+    def __init__(self, start, session):
+        self.start = start
+        self.session = session
+        self.count = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.first_seen = None
+        self.last_seen = None
+        self.return_codes = None
+
+    def add(self, event):
+        self.count += 1
+        if event.request:
+            self.request_bytes += len(event.request)
+        if event.response:
+            self.response_bytes += len(event.response)
+        if self.first_seen is None:
+            self.first_seen = event.time
+        self.last_seen = event.time
+        if isinstance(event.data, dict) and "return_code" in event.data:
+            if self.return_codes is None:
+                self.return_codes = set()
+            self.return_codes.add(event.data["return_code"])
+
+
+class AggregationStage(BaseStage):
+    """ Event aggregation stage class
+
+    Rolls up the events of each type in a session into counters per time
+    window. Each event type can be passed on as is ("raw"), aggregated
+    ("aggregate") or both ("both"), except for "Session closed" events that
+    are always passed on. Windows are passed on as "Aggregated
+    events" events when the window ends, when the session is closed or when
+    the maximum number of open windows is reached.
+    """
+
+    MODE_RAW = "raw"
+    MODE_AGGREGATE = "aggregate"
+    MODE_BOTH = "both"
+
+    aggregated_event = "Aggregated events"
+    session_closed_event = "Session closed"
+
+    #: Length of the windows in seconds
+    @property
+    def window(self):
+        return self.config.get("window", 60)
+
+    #: Mode for each event type
+    @property
+    def events(self):
+        return self.config.get("events", {})
+
+    #: Mode for the event types not configured
+    @property
+    def default_mode(self):
+        return self.config.get("default_mode", self.MODE_RAW)
+
+    #: Maximum number of windows open
+    @property
+    def max_windows(self):
+        return self.config.get("max_windows", 100000)
+
+    def setup(self):
+        self.modes = dict(self.events)
+        for mode in list(self.modes.values()) + [self.default_mode]:
+            if mode not in [self.MODE_RAW, self.MODE_AGGREGATE, self.MODE_BOTH]:
+                raise ValueError("Invalid aggregation mode '%s'" % mode)
+
+        # Windows are kept in the order they were opened, so the ones ended
+        # are found at the beginning
+        self.windows = OrderedDict()
+        self.session_windows = {}
+        self.aggregated = 0
+        self.emitted = 0
+
+    def process(self, event):
+        """Adds the event to its window and passes it on according to the
+        mode of the event type."""
+        if event.session is None or event.event == self.aggregated_event:
+            return [event]
+
+        # Session closed events are always passed on, after the session's
+        # windows
+        if event.event == self.session_closed_event:
+            return self.close_session(event.session.uuid) + [event]
+
+        events = []
+        mode = self.modes.get(event.event, self.default_mode)
+        if mode != self.MODE_RAW:
+            events.extend(self.aggregate(event))
+        if mode != self.MODE_AGGREGATE:
+            events.append(event)
+        return events
+
+    def aggregate(self, event):
+        """Adds an event to its window, returns the windows that were closed
+        to open it."""
+        events = []
+        key = (event.session.uuid, event.event)
+        start = event.time - event.time % self.window
+        window = self.windows.get(key)
+        if window is not None and window.start != start:
+            events.append(self.close_window(key))
+            window = None
+        if window is None:
+            window = Window(start, event.session)
+            self.windows[key] = window
+            self.session_windows.setdefault(key[0], set()).add(key[1])
+            while len(self.windows) > self.max_windows:
+                events.append(self.close_window(next(iter(self.windows))))
+        window.add(event)
+        self.aggregated += 1
+        return events
+
+    def close_window(self, key):
+        """Closes a window and returns its event."""
+        window = self.windows.pop(key)
+        uuid, name = key
+        names = self.session_windows[uuid]
+        names.discard(name)
+        if not names:
+            del self.session_windows[uuid]
+
+        data = {"event": name,
+                "window_start": window.start,
+                "window_end": window.start + self.window,
+                "count": window.count,
+                "request_bytes": window.request_bytes,
+                "response_bytes": window.response_bytes,
+                "first_seen": window.first_seen,
+                "last_seen": window.last_seen}
+        if window.return_codes:
+            data["return_codes"] = sorted(window.return_codes)
+        self.emitted += 1
+        return Event(self.aggregated_event, data=data, session=window.session,
+                     time=window.first_seen)
+
+    def close_session(self, uuid):
+        """Closes the windows of a session."""
+        return [self.close_window((uuid, name))
+                for name in sorted(self.session_windows.get(uuid, ()))]
+
+    def flush(self, now):
+        """Closes the windows that ended."""
+        events = []
+        while self.windows:
+            key = next(iter(self.windows))
+            if self.windows[key].start + self.window > now:
+                break
+            events.append(self.close_window(key))
+        return events
+
+    def stop(self):
+        """Closes all the windows."""
+        return [self.close_window(key) for key in list(self.windows)]
+
+    def stats(self):
+        """Returns the counters of the stage"""
+        return {"aggregated": self.aggregated,
+                "emitted": self.emitted,
+                "windows": len(self.windows)}
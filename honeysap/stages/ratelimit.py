@@ -0,0 +1,169 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+from time import time
+from collections import OrderedDict
+# External imports
+# Custom imports
+from honeysap.core.event import Event
+from honeysap.core.stage import BaseStage
+
+
+class TokenBucket(object):
+    """Token bucket and counters for a rate limited source and event."""
+
+    __slots__ = ("tokens", "updated", "seen", "suppressed", "sampled", "session")
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.seen = 0
+        self.suppressed = 0
+        self.sampled = 0
+        self.session = None
+
+
+class RateLimitStage(BaseStage):
+    """ Rate limiting stage class
+
+    Limits the events of each source IP address and event type with a token
+    bucket. Once a bucket runs out of tokens, only one of every `sample_rate`
+    events is passed on and the rest are suppressed. The number of events
+    suppressed for each source and event type is reported periodically in a
+    "Suppressed events" event. Buckets are kept for up to `max_sources`
+    source and event pairs, evicting the least recently used ones.
+    """
+
+    summary_event = "Suppressed events"
+
+    #: Number of events per second allowed for each source and event
+    @property
+    def rate(self):
+        return self.config.get("rate", 10)
+
+    #: Number of events allowed in a burst
+    @property
+    def burst(self):
+        return self.config.get("burst", 100)
+
+    #: Pass on one of every N events over the limit, 0 to suppress all
+    @property
+    def sample_rate(self):
+        return self.config.get("sample_rate", 100)
+
+    #: Seconds between reports of suppressed events
+    @property
+    def summary_interval(self):
+        return self.config.get("summary_interval", 60)
+
+    #: Maximum number of source and event pairs tracked
+    @property
+    def max_sources(self):
+        return self.config.get("max_sources", 10000)
+
+    #: Names of the events to limit, all the events if not set
+    @property
+    def events(self):
+        return self.config.get("events", None)
+
+    def setup(self):
+        self.buckets = OrderedDict()
+        self.summarized = None
+        self.limited_events = set(self.events) if self.events else None
+        self.passed = 0
+        self.suppressed = 0
+        self.evicted = 0
+
+    def process(self, event, now=None):
+        """Passes on the event if the bucket of its source and event type has
+        tokens left or the event is sampled."""
+        if event.session is None or event.event == self.summary_event or \
+           (self.limited_events is not None and event.event not in self.limited_events):
+            return [event]
+
+        now = time() if now is None else now
+        if self.summarized is None:
+            self.summarized = now
+        key = (event.session.source_ip, event.event)
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            bucket = TokenBucket(self.burst, now)
+
+        # Keep the buckets sorted by last use and evict the least recently
+        # used ones, reporting the events they suppressed
+        self.buckets[key] = bucket
+        events = []
+        while len(self.buckets) > self.max_sources:
+            evicted_key, evicted = self.buckets.popitem(last=False)
+            self.evicted += 1
+            if evicted.suppressed:
+                events.append(self.summary(evicted_key, evicted, now))
+
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+        bucket.updated = now
+        bucket.session = event.session
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            self.passed += 1
+            events.append(event)
+        else:
+            bucket.seen += 1
+            if self.sample_rate and bucket.seen % self.sample_rate == 0:
+                bucket.sampled += 1
+                self.passed += 1
+                events.append(event)
+            else:
+                bucket.suppressed += 1
+                self.suppressed += 1
+        return events
+
+    def summary(self, key, bucket, now):
+        """Builds the event reporting the events suppressed for a source and
+        event type, and resets the bucket's counters."""
+        source_ip, name = key
+        event = Event(self.summary_event,
+                      data={"source_ip": source_ip,
+                            "event": name,
+                            "suppressed": bucket.suppressed,
+                            "sampled": bucket.sampled,
+                            "interval": now - (self.summarized or now)},
+                      session=bucket.session,
+                      time=now)
+        bucket.suppressed = bucket.sampled = 0
+        return event
+
+    def flush(self, now):
+        """Reports the suppressed events once per summary interval."""
+        if self.summarized is None or now - self.summarized < self.summary_interval:
+            return []
+        return self.stop(now)
+
+    def stop(self, now=None):
+        """Reports the suppressed events not reported yet."""
+        now = time() if now is None else now
+        events = [self.summary(key, bucket, now)
+                  for key, bucket in self.buckets.items() if bucket.suppressed]
+        self.summarized = now
+        return events
+
+    def stats(self):
+        """Returns the counters of the stage"""
+        return {"passed": self.passed,
+                "suppressed": self.suppressed,
+                "tracked": len(self.buckets),
+                "evicted": self.evicted}
@@ -18,11 +18,13 @@
 # Standard imports
 import json
 import unittest
+from base64 import b64encode
+from datetime import datetime
 # External imports
 from gevent.queue import Queue
 # Custom imports
 from honeysap.core.event import Event
-from honeysap.core.session import Session
+from honeysap.core.session import Session, load_event
 
 
 class EventTest(unittest.TestCase):
@@ -53,6 +55,61 @@ class EventTest(unittest.TestCase):
         self.assertEqual(event_json["target_ip"], session.target_ip)
         self.assertEqual(event_json["target_port"], session.target_port)
 
+    def test_event_timestamp(self):
+        """Test the attack event timestamp"""
+
+        event = Event(self.test_string)
+        self.assertEqual(datetime.fromtimestamp(event.time), event.timestamp)
+
+        timestamp = datetime(2015, 3, 18, 10, 30, 15, 123456)
+        event.timestamp = timestamp
+        self.assertEqual(timestamp, event.timestamp)
+
+    def test_event_repr_cache(self):
+        """Test the caching of the attack event representation"""
+
+        session = Session(Queue(), "test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        event = Event(self.test_string, data=self.test_string, request=self.test_string)
+        session.add_event(event)
+
+        # The representation is built only once
+        event_repr = repr(event)
+        self.assertIs(event_repr, repr(event))
+
+        # And rebuilt after a field changes
+        event.data = {"key": "value"}
+        event.response = self.test_string
+        event_json = json.loads(repr(event))
+        self.assertEqual(event_json["data"], {"key": "value"})
+        self.assertEqual(event_json["request"], b64encode(self.test_string))
+        self.assertEqual(event_json["response"], b64encode(self.test_string))
+        self.assertEqual(event_json["session"], str(session.uuid))
+
+        # Or when attached to another session
+        another_session = Session(Queue(), "another", "127.0.0.2", 3200, "127.0.0.1", 3201)
+        another_session.add_event(event)
+        event_json = json.loads(repr(event))
+        self.assertEqual(event_json["session"], str(another_session.uuid))
+        self.assertEqual(event_json["service"], another_session.service)
+        self.assertEqual(event_json["source_ip"], another_session.source_ip)
+
+    def test_event_load(self):
+        """Test building an attack event from its representation"""
+
+        session = Session(Queue(), "test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        event = Event(self.test_string, data={"key": "value"}, request="\x00\x01")
+        session.add_event(event)
+
+        new_event = load_event(repr(event))
+        self.assertEqual(event.event, new_event.event)
+        self.assertEqual(event.data, new_event.data)
+        self.assertEqual(event.request, new_event.request)
+        self.assertIsNone(new_event.response)
+        self.assertEqual(event.timestamp, new_event.timestamp)
+        self.assertEqual(session.uuid, new_event.session.uuid)
+        self.assertEqual(session.key, new_event.session.key)
+        self.assertEqual(repr(event), repr(new_event))
+
 
 def test_suite():
     loader = unittest.TestLoader()
@@ -0,0 +1,102 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import unittest
+# External imports
+from gevent import spawn
+# Custom imports
+from honeysap.core.eventqueue import EventQueue
+
+
+class EventQueueTest(unittest.TestCase):
+
+    def test_event_queue_unbounded(self):
+        """Test the event queue without a maximum size"""
+        queue = EventQueue()
+        for i in range(100):
+            queue.put(i)
+        self.assertEqual(100, queue.qsize())
+        self.assertEqual(0, queue.dropped)
+
+    def test_event_queue_block(self):
+        """Test the block overflow policy"""
+        queue = EventQueue(2, EventQueue.OVERFLOW_BLOCK, timeout=0.1)
+        queue.put(1)
+        queue.put(2)
+        # The item is dropped after the timeout
+        queue.put(3)
+        self.assertEqual(1, queue.dropped)
+        self.assertEqual([1, 2], [queue.get(), queue.get()])
+
+        # The producer is unblocked when a consumer gets an item
+        queue = EventQueue(1, EventQueue.OVERFLOW_BLOCK)
+        queue.put(1)
+        spawn(queue.get)
+        queue.put(2)
+        self.assertEqual(0, queue.dropped)
+        self.assertEqual(2, queue.get())
+
+    def test_event_queue_drop_oldest(self):
+        """Test the drop oldest overflow policy"""
+        dropped = []
+        queue = EventQueue(2, EventQueue.OVERFLOW_DROP_OLDEST,
+                           drop_callback=dropped.append)
+        for i in range(5):
+            queue.put(i)
+        self.assertEqual(3, queue.dropped)
+        self.assertEqual([0, 1, 2], dropped)
+        self.assertEqual([3, 4], [queue.get(), queue.get()])
+
+    def test_event_queue_drop_newest(self):
+        """Test the drop newest overflow policy"""
+        dropped = []
+        queue = EventQueue(2, EventQueue.OVERFLOW_DROP_NEWEST,
+                           drop_callback=dropped.append)
+        for i in range(5):
+            queue.put(i)
+        self.assertEqual(3, queue.dropped)
+        self.assertEqual([2, 3, 4], dropped)
+        self.assertEqual([0, 1], [queue.get(), queue.get()])
+
+    def test_event_queue_sample(self):
+        """Test the sample overflow policy"""
+        dropped = []
+        queue = EventQueue(2, EventQueue.OVERFLOW_SAMPLE,
+                           drop_callback=dropped.append, sample_rate=3)
+        for i in range(8):
+            queue.put(i)
+        # Items 4 and 7 are sampled replacing the oldest ones in the queue
+        self.assertEqual([2, 3, 0, 5, 6, 1], dropped)
+        self.assertEqual(6, queue.dropped)
+        self.assertEqual([4, 7], [queue.get(), queue.get()])
+
+    def test_event_queue_invalid(self):
+        """Test an invalid overflow policy"""
+        with self.assertRaises(ValueError):
+            EventQueue(2, "invalid")
+
+
+def test_suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(EventQueueTest))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(test_suite())
@@ -17,6 +17,9 @@
 
 # Standard imports
 import unittest
+from time import time
+from shutil import rmtree
+from tempfile import mkdtemp
 # External imports
 from gevent.hub import sleep
 from gevent.queue import Queue
@@ -38,6 +41,42 @@ class DummyFeed(BaseFeed):
         pass
 
 
+class SlowFeed(BaseFeed):
+
+    events = Queue()
+
+    def log(self, event):
+        sleep(0.5)
+        self.events.put(event)
+
+    def consume(self, queue):
+        pass
+
+
+class BufferingFeed(BaseFeed):
+
+    def setup(self):
+        self.buffer = []
+
+    def log(self, event):
+        self.buffer.append(event)
+
+    def unflushed(self):
+        return len(self.buffer)
+
+    def consume(self, queue):
+        pass
+
+
+class FailingFeed(BaseFeed):
+
+    def log(self, event):
+        raise Exception("Feed down")
+
+    def consume(self, queue):
+        pass
+
+
 class FeedManagerTest(unittest.TestCase):
 
     def test_feed_manager(self):
@@ -65,6 +104,265 @@ class FeedManagerTest(unittest.TestCase):
         new_event = DummyFeed.events.get()
         self.assertIs(event, new_event)
 
+    def test_feed_manager_slow_feed(self):
+        """Test that a slow feed doesn't delay the other feeds"""
+
+        config = Configuration()
+        session_manager = SessionManager(config)
+        feed_manager = FeedManager(config, session_manager)
+        feed_manager.add_feed(SlowFeed(Configuration({"queue_size": 2,
+                                                      "queue_overflow": "drop_newest"})))
+        feed_manager.add_feed(DummyFeed(config))
+        feed_manager.run()
+
+        session = session_manager.get_session("test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        events = [Event("Test event %d" % i) for i in range(5)]
+        for event in events:
+            session.add_event(event)
+
+        # The fast feed processed all the events while the slow one is still
+        # processing the first one
+        sleep(0.1)
+        for event in events:
+            self.assertIs(event, DummyFeed.events.get_nowait())
+        self.assertEqual(0, SlowFeed.events.qsize())
+
+        # The slow feed dropped the events that didn't fit in its queue
+        stats = feed_manager.stats()
+        self.assertEqual(5, stats["DummyFeed"]["processed"])
+        self.assertEqual(3, stats["SlowFeed"]["dropped"])
+        self.assertEqual(1, stats["SlowFeed"]["queued"])
+
+        # The queued events are delivered when stopping
+        feed_manager.stop()
+        self.assertEqual(2, feed_manager.stats()["SlowFeed"]["processed"])
+        self.assertEqual(events[:2], [SlowFeed.events.get_nowait() for __ in range(2)])
+
+    def test_feed_manager_stop(self):
+        """Test stopping the feed manager with events still queued"""
+
+        config = Configuration()
+        session_manager = SessionManager(config)
+        feed_manager = FeedManager(config, session_manager)
+        feed_manager.add_feed(SlowFeed(Configuration({"queue_drain_timeout": 0.6})))
+        feed_manager.add_feed(DummyFeed(config))
+        feed_manager.run()
+
+        # Events not yet processed by the feed manager are delivered, and
+        # the slow feed discards the ones left after the drain timeout
+        session = session_manager.get_session("test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        events = [Event("Test event %d" % i) for i in range(5)]
+        for event in events:
+            session.add_event(event)
+        start = time()
+        feed_manager.stop()
+        self.assertLess(time() - start, 0.9)
+
+        self.assertEqual(events, [DummyFeed.events.get_nowait() for __ in range(5)])
+        self.assertEqual(1, feed_manager.stats()["SlowFeed"]["processed"])
+        self.assertEqual(events[:1], [SlowFeed.events.get_nowait()])
+
+    def test_feed_manager_aliases(self):
+        """Test feed manager naming feeds with the same alias"""
+
+        config = Configuration()
+        session_manager = SessionManager(config)
+        feed_manager = FeedManager(config, session_manager)
+        feed_manager.add_feed(DummyFeed(config))
+        feed_manager.add_feed(DummyFeed(config))
+        feed_manager.run()
+
+        session = session_manager.get_session("test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        session.add_event(Event("Test event"))
+        sleep(0.1)
+        feed_manager.stop()
+
+        stats = feed_manager.stats()
+        self.assertEqual(1, stats["DummyFeed"]["processed"])
+        self.assertEqual(1, stats["DummyFeed_2"]["processed"])
+        while not DummyFeed.events.empty():
+            DummyFeed.events.get()
+
+    def test_feed_manager_routes(self):
+        """Test feed manager routing events to feeds"""
+
+        config = Configuration()
+        session_manager = SessionManager(config)
+        feed_manager = FeedManager(config, session_manager)
+        feed_manager.add_feed(DummyFeed(Configuration({"routes": [{"event": "Route*"}]})))
+        feed_manager.add_feed(SlowFeed(Configuration({"routes": [{"service": "other"}]})))
+        feed_manager.run()
+
+        session = session_manager.get_session("test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        session.add_event(Event("Received packet"))
+        event = Event("Route request allowed")
+        session.add_event(event)
+        sleep(0.1)
+        feed_manager.stop()
+
+        self.assertIs(event, DummyFeed.events.get_nowait())
+        self.assertTrue(DummyFeed.events.empty())
+        self.assertEqual(0, feed_manager.stats()["SlowFeed"]["processed"])
+
+    def test_feed_manager_payload_store(self):
+        """Test feed manager delivering payloads only the first time"""
+
+        config = Configuration({"payload_store": True,
+                                "payload_store_min_size": 4})
+        session_manager = SessionManager(config)
+        feed_manager = FeedManager(config, session_manager)
+        feed_manager.add_feed(DummyFeed(Configuration()))
+        feed_manager.run()
+
+        session = session_manager.get_session("test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        for i in range(3):
+            session.add_event(Event("Test event", request=b"payload"))
+        sleep(0.1)
+        feed_manager.stop()
+
+        events = [DummyFeed.events.get_nowait() for __ in range(4)]
+        self.assertEqual(["Payload", "Test event", "Test event", "Test event"],
+                         [event.event for event in events])
+        self.assertEqual(b"payload", events[0].request)
+        for event in events[1:]:
+            self.assertIsNone(event.request)
+            self.assertEqual(events[0].data, event.payloads["request"])
+        self.assertEqual(2, feed_manager.stats()["payload_store"]["payloads_deduplicated"])
+
+    def test_feed_manager_payload_store_routes(self):
+        """Test feed manager routing payloads along with their events"""
+
+        directory = mkdtemp("feedtest")
+        self.addCleanup(rmtree, directory)
+        for options in [{}, {"spool_directory": directory}]:
+            config = Configuration(dict(options, payload_store=True,
+                                        payload_store_min_size=4))
+            session_manager = SessionManager(config)
+            feed_manager = FeedManager(config, session_manager)
+            feed_manager.add_feed(DummyFeed(Configuration({"routes": [{"event": "Route*"}]})))
+            feed_manager.run()
+
+            session = session_manager.get_session("test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+            session.add_event(Event("Received packet", request=b"packet"))
+            session.add_event(Event("Route request", request=b"route"))
+            sleep(0.1)
+            feed_manager.stop()
+
+            events = [DummyFeed.events.get_nowait() for __ in range(2)]
+            self.assertTrue(DummyFeed.events.empty())
+            self.assertEqual(["Payload", "Route request"], [event.event for event in events])
+            self.assertEqual(b"route", events[0].request)
+
+    def test_feed_manager_payload_store_feeds(self):
+        """Test feed manager delivering payloads to each feed referencing them"""
+
+        directory = mkdtemp("feedtest")
+        self.addCleanup(rmtree, directory)
+        for options in [{}, {"spool_directory": directory}]:
+            config = Configuration(dict(options, payload_store=True,
+                                        payload_store_min_size=4))
+            session_manager = SessionManager(config)
+            feed_manager = FeedManager(config, session_manager)
+            first = BufferingFeed(Configuration({"alias": "First",
+                                                 "routes": [{"event": "First"}]}))
+            second = BufferingFeed(Configuration({"alias": "Second",
+                                                  "routes": [{"event": "Second"}]}))
+            feed_manager.add_feed(first)
+            feed_manager.add_feed(second)
+            feed_manager.run()
+
+            session = session_manager.get_session("test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+            session.add_event(Event("First", request=b"payload"))
+            session.add_event(Event("Second", request=b"payload"))
+            session.add_event(Event("Second", request=b"payload"))
+            sleep(0.1)
+            feed_manager.stop()
+
+            self.assertEqual(["Payload", "First"], [event.event for event in first.buffer])
+            self.assertEqual(["Payload", "Second", "Second"], [event.event for event in second.buffer])
+            for feed in (first, second):
+                self.assertEqual(b"payload", feed.buffer[0].request)
+                self.assertEqual(feed.buffer[0].data, feed.buffer[1].payloads["request"])
+
+    def test_feed_manager_spool(self):
+        """Test feed manager delivering events through the spool"""
+
+        directory = mkdtemp("feedtest")
+        self.addCleanup(rmtree, directory)
+        config = Configuration({"spool_directory": directory,
+                                "spool_commit_interval": 0.1})
+        session_manager = SessionManager(config)
+        feed_manager = FeedManager(config, session_manager)
+        feed_manager.add_feed(DummyFeed(Configuration()))
+        feed_manager.add_feed(FailingFeed(Configuration({"alias": "Failing"})))
+        feed_manager.run()
+
+        session = session_manager.get_session("test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        events = [Event("Test event %d" % i, request=b"\x00" * i) for i in range(1, 6)]
+        for event in events:
+            session.add_event(event)
+        sleep(0.2)
+
+        # Events are rebuilt from the spool
+        for event in events:
+            new_event = DummyFeed.events.get_nowait()
+            self.assertEqual(repr(event), repr(new_event))
+            self.assertEqual(event.request, new_event.request)
+            self.assertEqual(session.uuid, new_event.session.uuid)
+        stats = feed_manager.stats()
+        self.assertEqual(0, stats["DummyFeed"]["queued"])
+        self.assertEqual(5, stats["Failing"]["failed"])
+        feed_manager.stop()
+
+        # A feed added after restarting replays the events not yet
+        # acknowledged, while the others continue from their cursor
+        config = Configuration({"spool_directory": directory})
+        session_manager = SessionManager(config)
+        feed_manager = FeedManager(config, session_manager)
+        feed_manager.add_feed(DummyFeed(Configuration()))
+        feed_manager.add_feed(DummyFeed(Configuration({"alias": "NewFeed"})))
+        feed_manager.run()
+        sleep(0.1)
+        self.assertEqual(5, DummyFeed.events.qsize())
+        self.assertEqual(5, feed_manager.stats()["NewFeed"]["processed"])
+        self.assertEqual(0, feed_manager.stats()["DummyFeed"]["processed"])
+        feed_manager.stop()
+        while not DummyFeed.events.empty():
+            DummyFeed.events.get()
+
+    def test_feed_manager_spool_unflushed(self):
+        """Test feed manager acknowledging spooled events once flushed"""
+
+        directory = mkdtemp("feedtest")
+        self.addCleanup(rmtree, directory)
+        config = Configuration({"spool_directory": directory})
+        session_manager = SessionManager(config)
+        feed_manager = FeedManager(config, session_manager)
+        feed = BufferingFeed(Configuration())
+        feed_manager.add_feed(feed)
+        feed_manager.run()
+        worker = feed_manager.workers[0]
+
+        session = session_manager.get_session("test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        for i in range(3):
+            session.add_event(Event("Test event %d" % i))
+        sleep(0.2)
+
+        # Events kept by the feed are not acknowledged
+        self.assertEqual(3, len(feed.buffer))
+        queued = feed_manager.stats()["BufferingFeed"]["queued"]
+        self.assertLess(0, queued)
+
+        # Only the events flushed by the feed are acknowledged
+        feed.buffer.pop(0)
+        worker.ack()
+        self.assertLess(0, feed_manager.stats()["BufferingFeed"]["queued"])
+        self.assertGreater(queued, feed_manager.stats()["BufferingFeed"]["queued"])
+        del feed.buffer[:]
+        worker.ack()
+        self.assertEqual(0, feed_manager.stats()["BufferingFeed"]["queued"])
+        feed_manager.stop()
+
 
 def test_suite():
     loader = unittest.TestLoader()
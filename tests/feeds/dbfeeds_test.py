@@ -16,12 +16,16 @@
 #
 
 # Standard imports
+import time
 import sqlite3
 import unittest
 from os import remove
 from os.path import exists
 from tempfile import mkstemp
 # External imports
+from gevent import spawn
+from gevent.hub import sleep
+from sqlalchemy.event import listen
 from gevent.queue import Queue
 # Custom imports
 from honeysap.core.event import Event
@@ -58,6 +62,290 @@ class DBFeedsTest(unittest.TestCase):
         self.assertEqual(results[0][2], str(event.timestamp))
         self.assertEqual(results[0][3], repr(event))
 
+    def count_events(self):
+        conn = sqlite3.connect(self.test_filename)
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM events')
+        count = cursor.fetchone()[0]
+        conn.close()
+        return count
+
+    def test_dbfeeds_batch(self):
+        """Tests batched event storage on a database"""
+
+        self.test_filename = mkstemp(".sqlite", "dbfeedstest")[1]
+
+        configuration = Configuration({"feed": "DBFeed",
+                                       "db_engine": "sqlite:///%s" % self.test_filename,
+                                       "db_batch_size": 3,
+                                       "db_batch_latency": 0.2})
+        feed = DBFeed(configuration)
+        session = Session(Queue(), "test", "127.0.0.1", 3200,
+                          "127.0.0.1", 3201)
+
+        def log_event():
+            event = Event("Test event")
+            event.session = session
+            feed.log(event)
+
+        # Events are kept in the buffer until the batch size is reached
+        log_event()
+        log_event()
+        self.assertEqual(self.count_events(), 0)
+        log_event()
+        feed.wait()
+        self.assertEqual(self.count_events(), 3)
+        self.assertEqual(feed.stats()["rows_flushed"], 3)
+        self.assertEqual(feed.stats()["flushes"], 1)
+
+        # Events are flushed after the time window
+        log_event()
+        self.assertEqual(self.count_events(), 3)
+        sleep(0.5)
+        self.assertEqual(self.count_events(), 4)
+
+        # Pending events are flushed when the feed is stopped
+        log_event()
+        feed.stop()
+        self.assertEqual(self.count_events(), 5)
+        self.assertEqual(feed.stats()["rows_flushed"], 5)
+        self.assertEqual(feed.stats()["rows_buffered"], 0)
+
+    def test_dbfeeds_batch_bytes(self):
+        """Tests batched event storage flushing on the buffered size"""
+
+        self.test_filename = mkstemp(".sqlite", "dbfeedstest")[1]
+
+        configuration = Configuration({"feed": "DBFeed",
+                                       "db_engine": "sqlite:///%s" % self.test_filename,
+                                       "db_batch_size": 100,
+                                       "db_batch_max_bytes": 1024})
+        feed = DBFeed(configuration)
+        event = Event("Test event", request="A" * 1024)
+        event.session = Session(Queue(), "test", "127.0.0.1", 3200,
+                                "127.0.0.1", 3201)
+        feed.log(event)
+        feed.wait()
+        self.assertEqual(self.count_events(), 1)
+        feed.stop()
+
+    def test_dbfeeds_slow_database(self):
+        """Tests that a slow database doesn't block the services and that
+        events are written to the fallback file while it's slow"""
+
+        self.test_filename = mkstemp(".sqlite", "dbfeedstest")[1]
+        fallback_filename = mkstemp(".log", "dbfeedstest")[1]
+        self.addCleanup(remove, fallback_filename)
+
+        configuration = Configuration({"feed": "DBFeed",
+                                       "db_engine": "sqlite:///%s" % self.test_filename,
+                                       "db_timeout": 0.1,
+                                       "db_breaker_failures": 1,
+                                       "db_breaker_reset": 10,
+                                       "db_fallback_filename": fallback_filename})
+        feed = DBFeed(configuration)
+
+        # Slow down every statement on the database
+        listen(feed.engine, "before_cursor_execute", lambda *args: time.sleep(0.3))
+
+        # Measure how late a greenlet standing for a service is woken up
+        # while the events are logged
+        delays = []
+
+        def service():
+            for __ in range(50):
+                start = time.time()
+                sleep(0.01)
+                delays.append(time.time() - start - 0.01)
+        greenlet = spawn(service)
+
+        session = Session(Queue(), "test", "127.0.0.1", 3200,
+                          "127.0.0.1", 3201)
+        events = []
+        for i in range(5):
+            event = Event("Test event %d" % i)
+            event.session = session
+            feed.log(event)
+            events.append(event)
+            sleep(0.15 if i == 0 else 0.05)
+        greenlet.join()
+        self.assertLess(max(delays), 0.1)
+
+        # The first insert timed out and opened the breaker, so the
+        # following events were written to the fallback file
+        stats = feed.stats()
+        self.assertEqual(1, stats["timeouts"])
+        self.assertEqual(4, stats["rows_shed"])
+        self.assertTrue(stats["breaker_open"])
+        with open(fallback_filename) as fd:
+            self.assertEqual([repr(event) for event in events[1:]],
+                             fd.read().splitlines())
+
+        # The slow insert completes anyway
+        feed.wait()
+        feed.stop()
+        self.assertEqual(self.count_events(), 1)
+
+    def test_dbfeeds_failing_database(self):
+        """Tests that failed inserts are counted, open the breaker and are
+        written to the fallback file"""
+
+        self.test_filename = mkstemp(".sqlite", "dbfeedstest")[1]
+        fallback_filename = mkstemp(".log", "dbfeedstest")[1]
+        self.addCleanup(remove, fallback_filename)
+
+        configuration = Configuration({"feed": "DBFeed",
+                                       "db_engine": "sqlite:///%s" % self.test_filename,
+                                       "db_breaker_failures": 1,
+                                       "db_breaker_reset": 10,
+                                       "db_fallback_filename": fallback_filename})
+        feed = DBFeed(configuration)
+
+        # Drop the table so the inserts fail
+        conn = sqlite3.connect(self.test_filename)
+        conn.execute("DROP TABLE events")
+        conn.close()
+
+        session = Session(Queue(), "test", "127.0.0.1", 3200,
+                          "127.0.0.1", 3201)
+        events = []
+        for i in range(3):
+            event = Event("Test event %d" % i)
+            event.session = session
+            feed.log(event)
+            events.append(event)
+            feed.wait()
+
+        # The first insert failed and opened the breaker, so the following
+        # events were shed without trying the database
+        stats = feed.stats()
+        self.assertEqual(0, stats["rows_flushed"])
+        self.assertEqual(1, stats["rows_failed"])
+        self.assertEqual(3, stats["rows_shed"])
+        self.assertTrue(stats["breaker_open"])
+        feed.stop()
+        with open(fallback_filename) as fd:
+            self.assertEqual([repr(event) for event in events],
+                             fd.read().splitlines())
+
+    def test_dbfeeds_breaker_trial(self):
+        """Tests that a failed batch that timed out is counted once and that
+        a single trial batch is let through once the breaker resets"""
+
+        self.test_filename = mkstemp(".sqlite", "dbfeedstest")[1]
+        fallback_filename = mkstemp(".log", "dbfeedstest")[1]
+        self.addCleanup(remove, fallback_filename)
+
+        configuration = Configuration({"feed": "DBFeed",
+                                       "db_engine": "sqlite:///%s" % self.test_filename,
+                                       "db_threads": 2,
+                                       "db_timeout": 0.1,
+                                       "db_breaker_failures": 2,
+                                       "db_breaker_reset": 0.2,
+                                       "db_fallback_filename": fallback_filename})
+        feed = DBFeed(configuration)
+
+        # Slow down and fail every statement on the database
+        def failing(*args):
+            time.sleep(0.2)
+            raise sqlite3.OperationalError("Database down")
+        listen(feed.engine, "before_cursor_execute", failing)
+
+        session = Session(Queue(), "test", "127.0.0.1", 3200,
+                          "127.0.0.1", 3201)
+
+        def log_events(count):
+            for i in range(count):
+                event = Event("Test event %d" % i)
+                event.session = session
+                feed.log(event)
+            feed.wait()
+
+        # The batch timed out and failed, but counts as a single failure
+        log_events(1)
+        stats = feed.stats()
+        self.assertEqual(1, stats["timeouts"])
+        self.assertEqual(0, stats["rows_failed"])
+        self.assertFalse(stats["breaker_open"])
+
+        # The second failure opens the breaker
+        log_events(1)
+        self.assertTrue(feed.stats()["breaker_open"])
+
+        # Once the breaker resets only a trial batch reaches the database,
+        # and the breaker opens again when it fails
+        sleep(0.3)
+        self.assertFalse(feed.stats()["breaker_open"])
+        log_events(4)
+        stats = feed.stats()
+        self.assertEqual(3, stats["timeouts"])
+        self.assertEqual(6, stats["rows_shed"])
+        self.assertTrue(stats["breaker_open"])
+        feed.stop()
+
+    def test_dbfeeds_queue_size(self):
+        """Tests that bursts larger than the queue wait for the inserts on a
+        healthy database instead of being shed"""
+
+        self.test_filename = mkstemp(".sqlite", "dbfeedstest")[1]
+        fallback_filename = mkstemp(".log", "dbfeedstest")[1]
+        self.addCleanup(remove, fallback_filename)
+
+        configuration = Configuration({"feed": "DBFeed",
+                                       "db_engine": "sqlite:///%s" % self.test_filename,
+                                       "db_queue_size": 5,
+                                       "db_fallback_filename": fallback_filename})
+        feed = DBFeed(configuration)
+        session = Session(Queue(), "test", "127.0.0.1", 3200,
+                          "127.0.0.1", 3201)
+        for i in range(50):
+            event = Event("Test event %d" % i)
+            event.session = session
+            feed.log(event)
+            self.assertLessEqual(feed.stats()["rows_queued"], 5)
+        feed.stop()
+
+        stats = feed.stats()
+        self.assertEqual(50, stats["rows_flushed"])
+        self.assertEqual(0, stats["rows_shed"])
+        self.assertEqual(self.count_events(), 50)
+
+    def test_dbfeeds_memory(self):
+        """Tests event storage on an in-memory database"""
+
+        self.test_filename = ""
+        configuration = Configuration({"feed": "DBFeed",
+                                       "db_engine": "sqlite://",
+                                       "db_threads": 4})
+        feed = DBFeed(configuration)
+        session = Session(Queue(), "test", "127.0.0.1", 3200,
+                          "127.0.0.1", 3201)
+        for i in range(5):
+            event = Event("Test event %d" % i)
+            event.session = session
+            feed.log(event)
+        feed.wait()
+
+        stats = feed.stats()
+        self.assertEqual(5, stats["rows_flushed"])
+        self.assertEqual(0, stats["rows_failed"])
+        with feed.engine.connect() as connection:
+            self.assertEqual(5, connection.execute("SELECT COUNT(*) FROM events").scalar())
+        feed.stop()
+
+    def test_dbfeeds_fallback_filename(self):
+        """Tests the default location of the fallback file"""
+
+        self.test_filename = ""
+        configuration = Configuration({"feed": "DBFeed",
+                                       "alias": "events",
+                                       "db_engine": "sqlite://",
+                                       "spool_directory": "/var/spool/honeysap"})
+        feed = DBFeed(configuration)
+        self.assertEqual("/var/spool/honeysap/honeysap-events-fallback.log",
+                         feed.db_fallback_filename)
+        feed.stop()
+
     def tearDown(self):
         if exists(self.test_filename):
             remove(self.test_filename)
@@ -16,9 +16,14 @@
 #
 
 # Standard imports
+import json
 import unittest
 # External imports
+from gevent import socket, sleep
 from gevent.queue import Queue
+from gevent.server import StreamServer
+from hpfeeds.protocol import (OP_AUTH, OP_PUBLISH, Unpacker, hashsecret,
+                              msginfo, msgerror, readauth, readpublish)
 # Custom imports
 from honeysap.core.event import Event
 from honeysap.feeds.hpfeed import HPFeed
@@ -26,6 +31,67 @@ from honeysap.core.session import Session
 from honeysap.core.config import Configuration
 
 
+class StandInBroker(object):
+    """Minimal in-process HPFeeds broker that authenticates publishers and
+    collects the messages published."""
+
+    rand = b"\x01\x02\x03\x04"
+
+    def __init__(self, ident, secret, port=0):
+        self.ident = ident
+        self.secret = secret
+        self.port = port
+        self.messages = Queue()
+        self.connections = []
+        self.server = None
+
+    def start(self):
+        self.server = StreamServer(("127.0.0.1", self.port), self.handle)
+        self.server.start()
+        self.port = self.server.server_port
+
+    def stop(self):
+        self.server.stop()
+        self.drop_connections()
+
+    def drop_connections(self):
+        for sock in self.connections:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def handle(self, sock, address):
+        self.connections.append(sock)
+        unpacker = Unpacker()
+        sock.sendall(msginfo("standin", self.rand))
+        authenticated = False
+        while True:
+            try:
+                data = sock.recv(4096)
+            except socket.error:
+                break
+            if not data:
+                break
+            unpacker.feed(data)
+            for opcode, data in unpacker:
+                if opcode == OP_AUTH:
+                    ident, secret = readauth(data)
+                    authenticated = ident == self.ident and \
+                        secret == hashsecret(self.rand, self.secret)
+                    if not authenticated:
+                        sock.sendall(msgerror("Authentication failed"))
+                elif opcode == OP_PUBLISH and authenticated:
+                    self.messages.put(readpublish(data))
+        sock.close()
+
+    def wait_for(self, count, timeout=2.0):
+        waited = 0.0
+        while self.messages.qsize() < count and waited < timeout:
+            sleep(0.01)
+            waited += 0.01
+
+
 class HPFeedsTest(unittest.TestCase):
 
     # Test account on HPFriends service for checking connectivity
@@ -54,6 +120,136 @@ class HPFeedsTest(unittest.TestCase):
         #feed.log(event)
         #feed.stop()
 
+    def setUp(self):
+        self.broker = StandInBroker("honeysap", "secret")
+        self.session = Session(Queue(), "test", "127.0.0.1", 3200,
+                               "127.0.0.1", 3201)
+
+    def feed(self, **options):
+        config = {"feed": "HPFeed",
+                  "feed_host": "127.0.0.1",
+                  "feed_port": self.broker.port,
+                  "feed_ident": "honeysap",
+                  "feed_secret": "secret",
+                  "feed_reconnect_delay": 0.05,
+                  "channels": ["events"]}
+        config.update(options)
+        return HPFeed(Configuration(config))
+
+    def log_events(self, feed, count, start=0):
+        events = [Event("Test event %d" % i) for i in range(start, start + count)]
+        for event in events:
+            event.session = self.session
+            feed.log(event)
+        return events
+
+    def test_hpfeeds_publish(self):
+        """Tests publishing events to a stand-in broker"""
+        self.broker.start()
+        self.addCleanup(self.broker.stop)
+        feed = self.feed()
+        events = self.log_events(feed, 5)
+        self.broker.wait_for(5)
+
+        for event in events:
+            ident, channel, payload = self.broker.messages.get_nowait()
+            self.assertEqual("honeysap", ident)
+            self.assertEqual("events", channel)
+            self.assertEqual(repr(event), payload)
+        stats = feed.stats()
+        self.assertEqual(5, stats["published"])
+        self.assertEqual(0, stats["outbox"])
+        feed.stop()
+
+    def test_hpfeeds_coalesce(self):
+        """Tests coalescing several events in one message"""
+        self.broker.start()
+        self.addCleanup(self.broker.stop)
+        feed = self.feed(feed_batch_format="json")
+        events = self.log_events(feed, 10)
+        self.broker.wait_for(1)
+
+        __, __, payload = self.broker.messages.get_nowait()
+        self.assertEqual([json.loads(repr(event)) for event in events],
+                         json.loads(payload))
+        self.assertEqual(1, feed.stats()["messages"])
+
+        # Messages are split when they reach the maximum size, and split back
+        # in events when consumed
+        feed.stop()
+        feed = self.feed(feed_batch_format="lines",
+                         feed_batch_max_size=len(repr(events[0])) * 3 + 4)
+        events = self.log_events(feed, 10)
+        self.broker.wait_for(4)
+        messages = [self.broker.messages.get_nowait()[2] for __ in range(4)]
+        self.assertEqual([repr(event) for event in events],
+                         sum([feed.split_message(message) for message in messages], []))
+        self.assertEqual(10, feed.stats()["published"])
+        feed.stop()
+
+    def test_hpfeeds_reconnect(self):
+        """Tests keeping the events in the outbox while the broker is not
+        reachable"""
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        self.broker.port = sock.getsockname()[1]
+        sock.close()
+
+        feed = self.feed(feed_outbox_size=8)
+        self.log_events(feed, 10)
+        sleep(0.2)
+        stats = feed.stats()
+        self.assertEqual(8, stats["outbox"])
+        self.assertEqual(2, stats["outbox_dropped"])
+
+        # The oldest events were dropped and the rest published once the
+        # broker is started
+        self.broker.start()
+        self.addCleanup(self.broker.stop)
+        self.broker.wait_for(8, timeout=5.0)
+        self.assertEqual("Test event 2", Event.from_fields(json.loads(self.broker.messages.get_nowait()[2])).event)
+
+        # The connection is reestablished if the broker drops it
+        self.broker.drop_connections()
+        sleep(0.1)
+        self.log_events(feed, 1, start=10)
+        self.broker.wait_for(8, timeout=5.0)
+        self.assertEqual(8, self.broker.messages.qsize())
+        self.assertEqual(1, feed.stats()["reconnects"])
+        feed.stop()
+
+    def test_hpfeeds_outbox_bound(self):
+        """Tests the outbox bound when a batch fails to be sent and the
+        events discarded when stopping"""
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        self.broker.port = sock.getsockname()[1]
+        sock.close()
+
+        feed = self.feed(feed_outbox_size=2, feed_stop_timeout=0.1)
+        test = self
+
+        class FailingSocket(object):
+            def sendall(self, data):
+                # Events logged while sending fill the outbox
+                test.log_events(feed, 2, start=1)
+                raise socket.error("Connection reset")
+
+            def close(self):
+                pass
+
+        feed.sock = FailingSocket()
+        self.log_events(feed, 1)
+        sleep(0.05)
+        stats = feed.stats()
+        self.assertEqual(2, stats["outbox"])
+        self.assertEqual(1, stats["outbox_dropped"])
+
+        feed.stop()
+        stats = feed.stats()
+        self.assertEqual(0, stats["outbox"])
+        self.assertEqual(2, stats["outbox_discarded"])
+
 
 def test_suite():
     loader = unittest.TestLoader()
@@ -16,10 +16,13 @@
 #
 
 # Standard imports
+import gzip
 import unittest
-from os import path, remove
-from tempfile import mkstemp
+from shutil import rmtree
+from os import path, remove, listdir
+from tempfile import mkstemp, mkdtemp
 # External imports
+from gevent import sleep
 from gevent.queue import Queue
 # Custom imports
 from honeysap.core.event import Event
@@ -49,6 +52,66 @@ class LogFeedsTest(unittest.TestCase):
         feed.stop()
 
         self.assertIs(path.exists(self.test_filename), True)
+        with open(self.test_filename) as fd:
+            self.assertEqual([repr(event)], fd.read().splitlines())
+
+    def log_events(self, feed, count):
+        session = Session(Queue(), "test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        events = []
+        for i in range(count):
+            event = Event("Test event %d" % i)
+            event.session = session
+            feed.log(event)
+            events.append(repr(event))
+        return events
+
+    def test_logfeeds_legacy(self):
+        """Tests logging events in the format of the log records"""
+
+        self.test_filename = mkstemp(".log", "logfeedstest")[1]
+        feed = LogFeed(Configuration({"feed": "LogFeed",
+                                      "log_filename": self.test_filename,
+                                      "log_format": "legacy"}))
+        events = self.log_events(feed, 2)
+        feed.stop()
+
+        with open(self.test_filename) as fd:
+            lines = fd.read().splitlines()
+        self.assertEqual(4, len(lines))
+        for line, message in zip(lines, ["INFO     - Starting log feed"] +
+                                 ["EVENT    - %s" % event for event in events] +
+                                 ["INFO     - Stopping log feed"]):
+            self.assertRegexpMatches(line, r"^honeysap\.events\.logfeed - "
+                                           r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3} - ")
+            self.assertTrue(line.endswith(message))
+
+    def test_logfeeds_buffer(self):
+        """Tests buffering and rotating the log file"""
+
+        directory = mkdtemp("logfeedstest")
+        self.addCleanup(rmtree, directory)
+        self.test_filename = path.join(directory, "honeysap.log")
+        feed = LogFeed(Configuration({"feed": "LogFeed",
+                                      "log_filename": self.test_filename,
+                                      "log_compression": "gzip",
+                                      "log_flush_interval": 0.1,
+                                      "log_rotate_size": 1}))
+
+        # Events are buffered until the flush interval
+        events = self.log_events(feed, 3)
+        self.assertEqual(0, feed.stats()["bytes_written"])
+        sleep(0.3)
+        self.assertEqual(3, feed.stats()["lines_written"])
+
+        # The file is rotated on the next write and compressed
+        events += self.log_events(feed, 1)
+        feed.stop()
+        self.assertLessEqual(1, feed.stats()["rotations"])
+        lines = []
+        for filename in sorted(listdir(directory)):
+            with gzip.open(path.join(directory, filename)) as fd:
+                lines.extend(fd.read().splitlines())
+        self.assertEqual(sorted(events), sorted(lines))
 
     def tearDown(self):
         if path.exists(self.test_filename):
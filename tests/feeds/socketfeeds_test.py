@@ -0,0 +1,112 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import unittest
+from shutil import rmtree
+from os.path import join
+from tempfile import mkdtemp
+# External imports
+from gevent import spawn, sleep
+from gevent.queue import Queue
+# Custom imports
+from honeysap.core.event import Event
+from honeysap.core.session import Session, load_event
+from honeysap.core.config import Configuration
+from honeysap.feeds.socketfeed import SocketFeed
+
+
+class SocketFeedsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp("socketfeedstest")
+        self.addCleanup(rmtree, self.directory)
+        self.configuration = Configuration({"feed": "SocketFeed",
+                                            "feed_address": "unix:" + join(self.directory, "feed.sock"),
+                                            "feed_reconnect_delay": 0.05})
+        self.session = Session(Queue(), "test", "127.0.0.1", 3200,
+                               "127.0.0.1", 3201)
+
+    def consume(self):
+        """Starts an eater side feed consuming events on a queue."""
+        queue = Queue()
+        eater = SocketFeed(self.configuration)
+        spawn(eater.consume, queue)
+        sleep(0.01)
+        return eater, queue
+
+    def wait_for(self, queue, count, timeout=2.0):
+        waited = 0.0
+        while queue.qsize() < count and waited < timeout:
+            sleep(0.01)
+            waited += 0.01
+
+    def test_socketfeeds(self):
+        """Tests sending events from a sensor to an eater"""
+        eater, queue = self.consume()
+        feed = SocketFeed(self.configuration)
+        events = [Event("Test event %d" % i) for i in range(10)]
+        for event in events:
+            event.session = self.session
+            feed.log(event)
+        self.wait_for(queue, 10)
+
+        for event in events:
+            self.assertEqual(repr(event), repr(load_event(queue.get_nowait())))
+        stats = feed.stats()
+        self.assertEqual(10, stats["acked"])
+        self.assertEqual(0, stats["inflight"])
+        feed.stop()
+        eater.stop()
+
+    def test_socketfeeds_reconnect(self):
+        """Tests keeping the events while the eater is not reachable"""
+        feed = SocketFeed(self.configuration)
+        for i in range(5):
+            event = Event("Test event %d" % i)
+            event.session = self.session
+            feed.log(event)
+        sleep(0.1)
+        self.assertEqual(5, feed.stats()["backlog"])
+
+        # Events are delivered once the eater is started, and again after
+        # it's restarted
+        eater, queue = self.consume()
+        self.wait_for(queue, 5)
+        self.assertEqual(5, queue.qsize())
+        eater.stop()
+
+        eater, queue = self.consume()
+        event = Event("Test event 5")
+        event.session = self.session
+        feed.log(event)
+        self.wait_for(queue, 1)
+        self.assertEqual("Test event 5", load_event(queue.get_nowait()).event)
+        self.assertEqual(6, feed.stats()["acked"])
+        feed.stop()
+        eater.stop()
+
+
+def test_suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(SocketFeedsTest))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(test_suite())
@@ -0,0 +1,149 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import sqlite3
+import unittest
+from shutil import rmtree
+from os import listdir, makedirs
+from os.path import join, exists
+from tempfile import mkdtemp
+from datetime import date, datetime, timedelta
+# External imports
+from gevent import sleep
+from gevent.queue import Queue
+# Custom imports
+from honeysap.core.event import Event
+from honeysap.core.session import Session
+from honeysap.core.config import Configuration
+from honeysap.feeds.sqlitefeed import SQLiteFeed
+
+
+class SQLiteFeedsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp("sqlitefeedstest")
+        self.addCleanup(rmtree, self.directory)
+        self.session = Session(Queue(), "test", "127.0.0.1", 3200,
+                               "127.0.0.1", 3201)
+
+    def feed(self, **options):
+        config = {"feed": "SQLiteFeed",
+                  "sqlite_directory": self.directory}
+        config.update(options)
+        return SQLiteFeed(Configuration(config))
+
+    def log_event(self, feed, name, day=None):
+        event = Event(name)
+        if day is not None:
+            event.timestamp = datetime.combine(day, datetime.now().time())
+        event.session = self.session
+        feed.log(event)
+        return event
+
+    def events(self, day):
+        connection = sqlite3.connect(join(self.directory, "events-%s.sqlite" % day))
+        try:
+            return connection.execute("SELECT session, timestamp, service, source_ip, event "
+                                      "FROM events ORDER BY id").fetchall()
+        finally:
+            connection.close()
+
+    def test_sqlitefeeds(self):
+        """Tests storing events on a database per day"""
+        feed = self.feed(sqlite_batch_size=3)
+        today = date.today()
+        yesterday = today - timedelta(days=1)
+        events = [self.log_event(feed, "Test event"),
+                  self.log_event(feed, "Late event", yesterday)]
+
+        # Events are buffered until the batch size is reached
+        self.assertEqual(2, feed.stats()["rows_buffered"])
+        events.append(self.log_event(feed, "Test event"))
+        feed.flush(wait=True)
+        self.assertEqual(3, feed.stats()["rows_written"])
+        self.assertEqual([(self.session.uuid, str(events[1].timestamp), "test",
+                           "127.0.0.1", repr(events[1]))], self.events(yesterday))
+        self.assertEqual([repr(events[0]), repr(events[2])],
+                         [row[4] for row in self.events(today)])
+
+        # Databases are in WAL mode and the WAL is checkpointed when stopping
+        connection = sqlite3.connect(join(self.directory, "events-%s.sqlite" % today))
+        self.assertEqual("wal", connection.execute("PRAGMA journal_mode").fetchone()[0])
+        connection.close()
+        feed.stop()
+        self.assertFalse(exists(join(self.directory, "events-%s.sqlite-wal" % today)))
+
+    def test_sqlitefeeds_latency(self):
+        """Tests flushing the events after the batch latency"""
+        feed = self.feed(sqlite_batch_latency=0.1)
+        self.log_event(feed, "Test event")
+        sleep(0.3)
+        self.assertEqual(1, len(self.events(date.today())))
+        feed.stop()
+
+    def test_sqlitefeeds_failure(self):
+        """Tests that failed inserts are counted and don't stop the
+        flushing"""
+        feed = self.feed(sqlite_batch_latency=0.1)
+
+        # Remove the directory so the database can't be opened
+        rmtree(self.directory)
+        self.log_event(feed, "Test event")
+        sleep(0.3)
+        stats = feed.stats()
+        self.assertEqual(1, stats["rows_failed"])
+        self.assertEqual(0, stats["rows_written"])
+
+        makedirs(self.directory)
+        self.log_event(feed, "Test event")
+        sleep(0.3)
+        self.assertEqual(1, feed.stats()["rows_written"])
+        self.assertEqual(1, len(self.events(date.today())))
+        feed.stop()
+
+    def test_sqlitefeeds_retention(self):
+        """Tests checkpointing and removing the expired days"""
+        feed = self.feed(sqlite_retention_days=2, sqlite_checkpoint_interval=0.1)
+        today = date.today()
+        for days in range(4):
+            self.log_event(feed, "Test event", today - timedelta(days=days))
+        feed.flush(wait=True)
+        self.assertEqual(4, feed.stats()["partitions"])
+
+        # The databases of the expired days are removed, and the ones
+        # before yesterday closed
+        sleep(0.25)
+        stats = feed.stats()
+        self.assertLessEqual(1, stats["checkpoints"])
+        self.assertEqual(2, stats["partitions_removed"])
+        self.assertEqual(2, stats["partitions"])
+        self.assertEqual(sorted("events-%s.sqlite" % (today - timedelta(days=days)) for days in range(2)),
+                         sorted(filename for filename in listdir(self.directory)
+                                if filename.endswith(".sqlite")))
+        feed.stop()
+
+
+def test_suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(SQLiteFeedsTest))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(test_suite())
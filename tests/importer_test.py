@@ -0,0 +1,138 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import gzip
+import sqlite3
+import unittest
+from shutil import rmtree, copyfileobj
+from os.path import join
+from tempfile import mkdtemp
+# External imports
+from gevent.queue import Queue
+# Custom imports
+from honeysap.core.event import Event
+from honeysap.core.session import Session
+from honeysap.feeds.logfeed import LogFeed
+from honeysap.core.config import Configuration
+from honeysap.core.importer import LogImporter, parse_line
+
+
+class LogImporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp("importertest")
+        self.addCleanup(rmtree, self.directory)
+        self.log_filename = join(self.directory, "honeysap.log")
+        self.db_filename = join(self.directory, "events.sqlite")
+        self.checkpoint = join(self.directory, "checkpoint")
+
+        # Log some events with the LogFeed
+        feed = LogFeed(Configuration({"log_filename": self.log_filename}))
+        session = Session(Queue(), "test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        self.events = []
+        for i in range(20):
+            event = Event("Test event %d" % i, request=b"\x00" * i)
+            event.session = session
+            feed.log(event)
+            self.events.append(repr(event))
+        feed.stop()
+
+    def importer(self, **kwargs):
+        return LogImporter("sqlite:///%s" % self.db_filename,
+                           checkpoint_directory=self.checkpoint, **kwargs)
+
+    def imported(self):
+        conn = sqlite3.connect(self.db_filename)
+        rows = conn.execute("SELECT event FROM events ORDER BY id").fetchall()
+        conn.close()
+        return sorted(row[0] for row in rows)
+
+    def test_parse_line(self):
+        """Test parsing the events of LogFeed lines"""
+        with open(self.log_filename, "rb") as fd:
+            lines = fd.readlines()
+        session, timestamp, event = parse_line(lines[0])
+        self.assertEqual(self.events[0], event)
+        self.assertIn('"session": "%s"' % session, event)
+        self.assertIn('"timestamp": "%s"' % timestamp, event)
+
+        # Lines in the legacy format, skipping the ones not of events
+        line = b"honeysap.events.logfeed - 2026-10-17 20:42:26,345 - EVENT    - " + lines[0]
+        self.assertEqual((session, timestamp, event), parse_line(line))
+        self.assertIsNone(parse_line(b"honeysap.events.logfeed - 2026-10-17 20:42:26,345 - INFO     - Starting log feed\n"))
+
+    def test_importer(self):
+        """Test importing plain and compressed files in parallel"""
+        compressed = self.log_filename + ".1.gz"
+        with open(self.log_filename, "rb") as source:
+            with gzip.open(compressed, "wb") as target:
+                copyfileobj(source, target)
+
+        importer = self.importer(workers=3, chunk_size=3, split_size=500)
+        self.assertTrue(len(importer.units([self.log_filename])) > 3)
+        self.assertEqual(0, importer.run([self.log_filename, compressed]))
+        self.assertEqual(sorted(self.events * 2), self.imported())
+
+        # Importing again is resumed from the checkpoints
+        self.assertEqual(0, importer.run([self.log_filename, compressed]))
+        self.assertEqual(40, len(self.imported()))
+
+    def test_importer_resume(self):
+        """Test resuming an interrupted import"""
+        importer = self.importer(workers=1)
+        unit = importer.units([self.log_filename])[0]
+        for line, offset in unit.lines():
+            if parse_line(line) and parse_line(line)[2] == self.events[9]:
+                break
+        unit.offset = offset
+        unit.checkpoint()
+
+        self.assertEqual(0, importer.run([self.log_filename]))
+        self.assertEqual(sorted(self.events[10:]), self.imported())
+
+
+    def test_importer_growing_log(self):
+        """Test importing again a log that grew since the last import"""
+        importer = self.importer(workers=2, chunk_size=3, split_size=500)
+        self.assertEqual(0, importer.run([self.log_filename]))
+
+        # Log more events, with the last line still being written
+        feed = LogFeed(Configuration({"log_filename": self.log_filename}))
+        session = Session(Queue(), "test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        for i in range(20, 30):
+            event = Event("Test event %d" % i)
+            event.session = session
+            feed.log(event)
+            self.events.append(repr(event))
+        feed.stop()
+        with open(self.log_filename, "ab") as fd:
+            fd.write(b'{"event": "Partial')
+
+        self.assertEqual(0, importer.run([self.log_filename]))
+        self.assertEqual(sorted(self.events), self.imported())
+
+
+def test_suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(LogImporterTest))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(test_suite())
@@ -0,0 +1,163 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import unittest
+from shutil import rmtree
+from os.path import join
+from tempfile import mkdtemp
+# External imports
+from gevent import sleep
+# Custom imports
+from honeysap.core.ipc import (FrameReader, IPCError, IPCServer, IPCClient,
+                               pack_frames, parse_address)
+
+
+class FrameReaderTest(unittest.TestCase):
+
+    def test_frame_reader(self):
+        """Test splitting a stream into frames"""
+        data = pack_frames([b"first", b"", b"third frame"])
+        reader = FrameReader()
+        frames = []
+        for i in range(0, len(data), 3):
+            frames.extend(reader.feed(data[i:i + 3]))
+        self.assertEqual([b"first", b"", b"third frame"], frames)
+        self.assertEqual(0, reader.pending)
+
+    def test_frame_reader_large_frame(self):
+        """Test joining a large frame only once it's complete"""
+        payload = b"x" * 1048576
+        data = pack_frames([payload, b"next"])
+        reader = FrameReader()
+        chunks = [data[i:i + 4096] for i in range(0, len(data), 4096)]
+        for chunk in chunks[:-1]:
+            self.assertEqual([], reader.feed(chunk))
+        self.assertEqual(len(chunks) - 1, len(reader.chunks))
+        self.assertEqual([payload, b"next"], reader.feed(chunks[-1]))
+        self.assertEqual([], reader.chunks)
+
+    def test_frame_reader_max_size(self):
+        """Test rejecting frames larger than the maximum size"""
+        reader = FrameReader(max_size=4)
+        self.assertRaises(IPCError, reader.feed, pack_frames([b"12345"]))
+
+    def test_parse_address(self):
+        """Test parsing IPC addresses"""
+        self.assertEqual("/tmp/test.sock", parse_address("unix:/tmp/test.sock")[1])
+        self.assertEqual("/tmp/test.sock", parse_address("/tmp/test.sock")[1])
+        self.assertEqual(("127.0.0.1", 3299), parse_address("127.0.0.1:3299")[1])
+        self.assertRaises(IPCError, parse_address, "localhost:port")
+
+
+class IPCTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp("ipctest")
+        self.addCleanup(rmtree, self.directory)
+        self.address = join(self.directory, "events.sock")
+        self.received = []
+
+    def wait_for(self, count, timeout=2.0):
+        waited = 0.0
+        while len(self.received) < count and waited < timeout:
+            sleep(0.01)
+            waited += 0.01
+
+    def test_ipc(self):
+        """Test sending frames from a client to a server"""
+        server = IPCServer(self.address, self.received.append)
+        server.start()
+        client = IPCClient(self.address)
+        client.run()
+
+        frames = [b"frame %d" % i for i in range(100)]
+        for frame in frames:
+            client.send(frame)
+        self.wait_for(100)
+        client.stop()
+        server.stop()
+
+        self.assertEqual(frames, self.received)
+        self.assertEqual(100, client.stats()["sent"])
+
+    def test_ipc_reconnect(self):
+        """Test client keeping the frames until the server is available"""
+        client = IPCClient(self.address, max_backlog=5, reconnect_delay=0.05)
+        client.run()
+        for i in range(8):
+            client.send(b"frame %d" % i)
+        sleep(0.1)
+        self.assertEqual(5, client.stats()["backlog"])
+        self.assertEqual(3, client.stats()["dropped"])
+
+        # The oldest frames were dropped
+        server = IPCServer(self.address, self.received.append)
+        server.start()
+        self.wait_for(5)
+        self.assertEqual([b"frame %d" % i for i in range(3, 8)], self.received)
+
+        # Frames sent after the server restarts are delivered
+        server.stop()
+        server = IPCServer(self.address, self.received.append)
+        server.start()
+        client.send(b"frame 8")
+        client.send(b"frame 9")
+        self.wait_for(7)
+        client.stop()
+        server.stop()
+        self.assertEqual([b"frame 8", b"frame 9"], self.received[5:])
+
+    def test_ipc_acks(self):
+        """Test client sending again the frames not acknowledged"""
+        # A server not acknowledging frames receives them, but they're kept
+        # in flight by the client
+        server = IPCServer(self.address, self.received.append)
+        server.start()
+        client = IPCClient(self.address, reconnect_delay=0.05, acks=True,
+                           max_inflight=3)
+        client.run()
+        for i in range(5):
+            client.send(b"frame %d" % i)
+        self.wait_for(3)
+        sleep(0.05)
+        self.assertEqual(3, len(self.received))
+        self.assertEqual(3, client.stats()["inflight"])
+        self.assertEqual(2, client.stats()["backlog"])
+        server.stop()
+
+        # Frames in flight are sent again to the next server
+        server = IPCServer(self.address, self.received.append, acks=True)
+        server.start()
+        self.wait_for(8)
+        client.stop()
+        server.stop()
+        self.assertEqual([b"frame %d" % i for i in range(5)], self.received[3:])
+        self.assertEqual(5, client.stats()["acked"])
+        self.assertEqual(0, client.stats()["inflight"])
+
+
+def test_suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(FrameReaderTest))
+    suite.addTest(loader.loadTestsFromTestCase(IPCTest))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(test_suite())
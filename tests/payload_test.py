@@ -0,0 +1,127 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import json
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+# External imports
+from gevent.queue import Queue
+# Custom imports
+from honeysap.core.event import Event
+from honeysap.core.session import Session, load_event
+from honeysap.core.payload import PayloadStore, hash_algorithm
+
+
+class PayloadStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp("payloadtest")
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_payload_store(self):
+        """Test adding and retrieving payloads"""
+        store = PayloadStore(cache_size=1)
+
+        digest, new = store.add(b"payload")
+        self.assertTrue(digest.startswith(hash_algorithm + ":"))
+        self.assertTrue(new)
+        self.assertEqual((digest, False), store.add(b"payload"))
+        self.assertEqual(b"payload", store.get(digest))
+        self.assertNotEqual(digest, store.add(b"another payload")[0])
+
+        # Without a directory only the cached payloads are kept, but the
+        # digests are still remembered
+        self.assertIsNone(store.get(digest))
+        self.assertEqual((digest, False), store.add(b"payload"))
+        self.assertEqual({"payloads_stored": 2,
+                          "payloads_deduplicated": 2,
+                          "bytes_saved": 14}, store.stats())
+
+    def test_payload_store_index_size(self):
+        """Test the index keeps only the most recently seen digests"""
+        store = PayloadStore(self.directory, cache_size=1, index_size=2)
+        digest = store.add(b"payload")[0]
+        store.add(b"another payload")
+        store.add(b"payload")
+        store.add(b"yet another payload")
+        self.assertEqual(2, len(store.index))
+        self.assertEqual((digest, False), store.add(b"payload"))
+
+        # Payloads not seen recently are stored again
+        self.assertTrue(store.add(b"another payload")[1])
+        self.assertEqual(b"another payload", store.get(store.digest(b"another payload")))
+        store.close()
+
+    def test_payload_store_packs(self):
+        """Test payloads are stored in packs and loaded when reopened"""
+        store = PayloadStore(self.directory, cache_size=1, pack_size=100)
+        digests = [store.add(b"%d" % i * 60)[0] for i in range(5)]
+        for i, digest in enumerate(digests):
+            self.assertEqual(b"%d" % i * 60, store.get(digest))
+        store.close()
+
+        # Simulate a crash while writing a payload
+        with open(store.pack_path(store.pack_number), "ab") as fd:
+            fd.write(store.header.pack(b"digest", 100) + b"partial")
+
+        store = PayloadStore(self.directory, cache_size=1, pack_size=100)
+        self.assertEqual(5, len(store.index))
+        self.assertEqual((digests[0], False), store.add(b"0" * 60))
+        self.assertEqual(b"4" * 60, store.get(digests[4]))
+        digest = store.add(b"payload")[0]
+        self.assertEqual(b"payload", store.get(digest))
+        store.close()
+
+    def test_payload_store_process(self):
+        """Test replacing the payloads of events with their digests"""
+        store = PayloadStore()
+        session = Session(Queue(), "test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+
+        event = Event("Test event", request=b"A" * 100, response=b"B", session=session)
+        events = store.process(event, min_size=10)
+        self.assertEqual(["Payload", "Test event"], [e.event for e in events])
+        digest = store.digest(b"A" * 100)
+        self.assertEqual(b"A" * 100, events[0].request)
+        self.assertEqual({"digest": digest, "length": 100}, events[0].data)
+        self.assertIsNone(event.request)
+        self.assertEqual(b"B", event.response)
+
+        # The payloads are in the representation of the event
+        event_json = json.loads(repr(event))
+        self.assertEqual({"request": {"digest": digest, "length": 100}},
+                         event_json["payloads"])
+        self.assertEqual(event.payloads, load_event(repr(event)).payloads)
+
+        # The payload is emitted only the first time it's seen
+        event = Event("Test event", request=b"A" * 100, session=session)
+        self.assertEqual([event], store.process(event, min_size=10))
+        self.assertIsNone(event.request)
+
+
+def test_suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(PayloadStoreTest))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(test_suite())
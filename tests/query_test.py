@@ -0,0 +1,160 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import unittest
+from os import remove
+from tempfile import mkstemp
+from datetime import datetime, timedelta
+# External imports
+from gevent.queue import Queue
+from sqlalchemy import create_engine, select, func
+# Custom imports
+from honeysap.core.event import Event
+from honeysap.core.session import Session
+from honeysap.core.config import Configuration
+from honeysap.core.query import EventQuery, parse_time
+from honeysap.feeds.dbfeed import DBFeed, DBSession, DBPayload, DBSessionEvent, insert_ignore
+
+
+class EventQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.test_filename = mkstemp(".sqlite", "querytest")[1]
+        self.addCleanup(remove, self.test_filename)
+        self.db_engine = "sqlite:///%s" % self.test_filename
+        self.feed = DBFeed(Configuration({"feed": "DBFeed",
+                                          "db_engine": self.db_engine,
+                                          "db_schema": "normalized",
+                                          "db_batch_size": 100}))
+        self.start = datetime(2026, 10, 17, 12, 0, 0)
+        self.router = Session(Queue(), "saprouter", "10.0.0.1", 40000,
+                              "127.0.0.1", 3299)
+        self.dispatcher = Session(Queue(), "dispatcher", "10.0.0.2", 40001,
+                                  "127.0.0.1", 3200)
+
+    def log_event(self, session, seconds, name, **kwargs):
+        event = Event(name, time=(self.start + timedelta(seconds=seconds) -
+                                  datetime(1970, 1, 1)).total_seconds(), **kwargs)
+        event.session = session
+        self.feed.log(event)
+
+    def log_events(self):
+        self.log_event(self.router, 0, "Route request allowed",
+                       data={"target": "10.1.1.1", "port": 3200}, request=b"route")
+        self.log_event(self.router, 1, "Route request allowed",
+                       data={"target": "10.1.1.1", "port": 3200}, request=b"route")
+        self.log_event(self.dispatcher, 2, "Login request sent the client",
+                       data={"inputs": {"user": "SAP*"}})
+        self.feed.flush()
+        self.feed.wait()
+        # A later batch updates the last event of the session
+        self.log_event(self.router, 10, "Route request allowed",
+                       data={"target_host": "10.1.1.2", "target_port": 3300})
+        self.feed.stop()
+
+    def test_normalized_schema(self):
+        """Tests storing events in the normalized schema"""
+        self.log_events()
+
+        engine = create_engine(self.db_engine)
+        with engine.connect() as connection:
+            sessions = list(connection.execute(select([DBSession.__table__])))
+            self.assertEqual(2, len(sessions))
+            router = [session for session in sessions if session.service == "saprouter"][0]
+            self.assertEqual(self.start, router.first_seen)
+            self.assertEqual(self.start + timedelta(seconds=10), router.last_seen)
+
+            # The request payload is stored once
+            payloads = list(connection.execute(select([DBPayload.__table__])))
+            self.assertEqual(1, len(payloads))
+            self.assertEqual(b"route", payloads[0].data)
+            self.assertEqual(4, connection.execute(select([func.count()]).
+                                                   select_from(DBSessionEvent.__table__)).scalar())
+
+    def test_queries(self):
+        """Tests looking up events with the query API"""
+        self.log_events()
+        query = EventQuery(self.db_engine)
+
+        events = query.events_by_source("10.0.0.1")
+        self.assertEqual(3, len(events))
+        self.assertEqual(self.router.uuid, events[0]["session"])
+        self.assertEqual({"target": "10.1.1.1", "port": 3200}, events[0]["data"])
+        self.assertEqual(events[0]["request_digest"], events[1]["request_digest"])
+        self.assertEqual(1, len(query.events_by_source("10.0.0.1", since=parse_time("2026-10-17 12:00:05"))))
+        self.assertEqual(2, len(query.events_by_source("10.0.0.1", limit=2)))
+
+        events = query.events_by_service("dispatcher", "Login request sent the client")
+        self.assertEqual(1, len(events))
+        self.assertEqual(0, len(query.events_by_service("dispatcher", "Other")))
+
+        session = query.session(self.router.uuid)
+        self.assertEqual("saprouter", session["service"])
+        self.assertEqual(3, len(session["events"]))
+        self.assertIsNone(query.session("unknown"))
+
+        sessions = query.sessions_by_source("10.0.0.2")
+        self.assertEqual([self.dispatcher.uuid], [session["uuid"] for session in sessions])
+
+        self.assertEqual([{"target": "10.1.1.1:3200", "count": 2, "sources": 1},
+                          {"target": "10.1.1.2:3300", "count": 1, "sources": 1}],
+                         query.top_targets())
+        self.assertEqual([{"service": "saprouter", "event": "Route request allowed", "count": 3}],
+                         query.event_counts("saprouter"))
+
+    def test_concurrent_inserts(self):
+        """Tests inserting sessions and payloads already stored"""
+        feed = DBFeed(Configuration({"feed": "DBFeed",
+                                     "db_engine": self.db_engine,
+                                     "db_schema": "normalized",
+                                     "db_threads": 4}))
+        self.assertEqual(1, feed.pool.maxsize)
+        forwarder = Session(Queue(), "saprouter", "10.0.0.1", 40002,
+                            "127.0.0.1", 3299)
+        event = Event("Connected to target", data={"target_host": "10.1.1.3", "target_port": 3200},
+                      request=b"route")
+        event.session = forwarder
+        feed.log(event)
+        feed.stop()
+
+        engine = create_engine(self.db_engine)
+        with engine.connect() as connection:
+            payload = dict(connection.execute(select([DBPayload.__table__])).first())
+            connection.execute(insert_ignore(connection, DBPayload.__table__), [payload])
+            self.assertEqual(1, connection.execute(select([func.count()]).
+                                                   select_from(DBPayload.__table__)).scalar())
+            # Only route requests have a target
+            self.assertIsNone(connection.execute(select([DBSessionEvent.__table__.c.target])).scalar())
+
+    def test_parse_time(self):
+        """Tests parsing the times of the queries"""
+        self.assertEqual(datetime(2026, 10, 17), parse_time("2026-10-17"))
+        self.assertEqual(datetime(2026, 10, 17, 1, 2, 3), parse_time("2026-10-17 01:02:03"))
+        self.assertIsNone(parse_time(None))
+        self.assertRaises(ValueError, parse_time, "17/10/2026")
+
+
+def test_suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(EventQueryTest))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(test_suite())
@@ -0,0 +1,89 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import unittest
+# External imports
+from gevent.queue import Queue
+# Custom imports
+from honeysap.core.event import Event
+from honeysap.core.session import Session
+from honeysap.core.routing import EventRouter, InvalidRoute
+
+
+class EventRouterTest(unittest.TestCase):
+
+    def event(self, name, service="saprouter", source_ip="10.0.0.1", data=None):
+        session = Session(Queue(), service, source_ip, 3200, "127.0.0.1", 3299)
+        return Event(name, data=data, session=session)
+
+    def test_router(self):
+        """Test routing events by service and event name"""
+        router = EventRouter()
+        router.add("all")
+        router.add("saprouter", [{"service": "saprouter"}])
+        router.add("routes", [{"event": "Route request*"},
+                              {"service": "dispatcher", "event": "Login request sent the client"}])
+        router.add("none", [])
+
+        self.assertEqual(["all", "saprouter"], router.route(self.event("Received packet")))
+        self.assertEqual(["all", "saprouter", "routes"],
+                         router.route(self.event("Route request allowed")))
+        self.assertEqual(["all", "routes"],
+                         router.route(self.event("Login request sent the client", "dispatcher")))
+        self.assertEqual(["all"],
+                         router.route(self.event("Login request sent the client", "forwarder")))
+
+        # Targets are resolved once per service and event name
+        self.assertEqual(4, len(router.table))
+        router.table[("saprouter", "Received packet")] = [("cached", None)]
+        self.assertEqual(["cached"], router.route(self.event("Received packet")))
+
+    def test_router_source_data(self):
+        """Test routing events by source network and data fields"""
+        router = EventRouter()
+        router.add("internal", [{"source": ["10.0.0.0/8", "fd00::/8"]}])
+        router.add("inputs", [{"event": "Login*", "data": "inputs"}])
+
+        self.assertEqual(["internal"], router.route(self.event("Received packet")))
+        self.assertEqual(["internal"], router.route(self.event("Received packet", source_ip="fd00::1")))
+        self.assertEqual([], router.route(self.event("Received packet", source_ip="192.168.1.1")))
+        self.assertEqual([], router.route(self.event("Received packet", source_ip="fe80::1")))
+        self.assertEqual(["inputs"], router.route(self.event("Login request", source_ip="192.168.1.1",
+                                                             data={"inputs": []})))
+        self.assertEqual([], router.route(self.event("Login request", source_ip="192.168.1.1")))
+
+        # Events without a session don't match source networks
+        self.assertEqual([], router.route(Event("Received packet")))
+
+    def test_router_invalid(self):
+        """Test invalid route rules"""
+        router = EventRouter()
+        self.assertRaises(InvalidRoute, router.add, "target", [{"source": "10.0.0.0/33"}])
+        self.assertRaises(InvalidRoute, router.add, "target", [{"source": "invalid"}])
+        self.assertRaises(InvalidRoute, router.add, "target", [{"events": "typo"}])
+
+
+def test_suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(EventRouterTest))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(test_suite())
@@ -19,10 +19,23 @@
 import unittest
 # External imports
 # Custom imports
+from honeysap.core import service
+from honeysap.core.config import Configuration
+from honeysap.services.saprouter.saprouter import SAPRouterService
 
 
 class ServiceTest(unittest.TestCase):
-    pass
+
+    def test_service_reuse_port_unavailable(self):
+        """Test sharing the listener socket without SO_REUSEPORT"""
+
+        so_reuseport = service.SO_REUSEPORT
+        service.SO_REUSEPORT = None
+        self.addCleanup(setattr, service, "SO_REUSEPORT", so_reuseport)
+        config = Configuration({"listener_address": "127.0.0.1",
+                                "listener_port": 0,
+                                "reuse_port": True})
+        self.assertRaises(ValueError, SAPRouterService, config, None, None, None)
 
 
 class ServiceManagerTest(unittest.TestCase):
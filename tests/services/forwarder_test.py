@@ -0,0 +1,188 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import unittest
+# External imports
+from gevent import spawn, socket
+from gevent.hub import sleep
+from gevent.server import StreamServer
+# Custom imports
+from honeysap.core.config import Configuration
+from honeysap.core.session import SessionManager
+from honeysap.services.forwarder import ForwarderService
+
+
+def echo(sock, address):
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            break
+        sock.sendall(data)
+    sock.close()
+
+
+class ForwarderServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.target = StreamServer(("127.0.0.1", 0), echo)
+        self.target.start()
+        self.session_manager = SessionManager(Configuration())
+
+    def tearDown(self):
+        self.target.stop()
+
+    def start_service(self, **options):
+        config = {"listener_address": "127.0.0.1",
+                  "listener_port": 0,
+                  "target_address": "127.0.0.1",
+                  "target_port": self.target.server_port,
+                  "buffer_size": 1024}
+        config.update(options)
+        service = ForwarderService(Configuration(config), None,
+                                   self.session_manager, None)
+        greenlet = spawn(service.run)
+        self.addCleanup(greenlet.kill)
+        self.addCleanup(service.stop)
+        return service
+
+    def connect(self, service):
+        return socket.create_connection(service.listener.ins.getsockname())
+
+    def echo(self, client, payload):
+        client.sendall(payload)
+        received = b""
+        while len(received) < len(payload):
+            received += client.recv(4096)
+        return received
+
+    def get_events(self):
+        events = []
+        while not self.session_manager.event_queue.empty():
+            events.append(self.session_manager.event_queue.get())
+        return events
+
+    def forward(self, payload, **options):
+        """Forwards a payload through the forwarder service and returns the
+        events registered."""
+        service = self.start_service(**options)
+        client = self.connect(service)
+        self.assertEqual(payload, self.echo(client, payload))
+        client.close()
+        sleep(0.1)
+        return self.get_events()
+
+    def test_forwarder_capture_full(self):
+        """Test forwarding with full payload capture"""
+        payload = b"A" * 5000
+        events = self.forward(payload)
+
+        self.assertEqual("Connected to target", events[0].event)
+        packets = [event for event in events if event.event == "Forwarding packet"]
+        self.assertEqual(payload, b"".join(event.request for event in packets
+                                           if event.request))
+        self.assertEqual(payload, b"".join(event.response for event in packets
+                                           if event.response))
+        self.assertEqual("Forwarding finished", events[-1].event)
+        self.assertEqual(5000, events[-1].data["request_bytes"])
+        self.assertEqual(5000, events[-1].data["response_bytes"])
+
+    def test_forwarder_capture_head(self):
+        """Test forwarding capturing only the first bytes"""
+        payload = b"A" * 5000
+        events = self.forward(payload, capture="head", capture_bytes=1500)
+
+        packets = [event for event in events if event.event == "Forwarding packet"]
+        self.assertEqual(1500, sum(len(event.request) for event in packets
+                                   if event.request))
+        self.assertEqual(1500, sum(len(event.response) for event in packets
+                                   if event.response))
+        self.assertEqual(5000, events[-1].data["request_bytes"])
+
+    def test_forwarder_capture_counters(self):
+        """Test forwarding capturing only the byte counters"""
+        events = self.forward(b"A" * 5000, capture="counters")
+
+        self.assertEqual(["Connected to target", "Forwarding finished"],
+                         [event.event for event in events])
+        self.assertEqual(5000, events[-1].data["request_bytes"])
+        self.assertEqual(5000, events[-1].data["response_bytes"])
+
+    def test_forwarder_concurrent(self):
+        """Test forwarding concurrent connections on separate sessions"""
+        service = self.start_service()
+
+        # The first client is idle while the second one is served
+        first = self.connect(service)
+        second = self.connect(service)
+        self.assertEqual(b"second", self.echo(second, b"second"))
+        self.assertEqual(b"first", self.echo(first, b"first"))
+        ports = set([first.getsockname()[1], second.getsockname()[1]])
+        first.close()
+        second.close()
+        sleep(0.1)
+
+        sessions = set(event.session for event in self.get_events())
+        self.assertEqual(ports, set(session.source_port for session in sessions))
+
+    def test_forwarder_max_connections(self):
+        """Test the maximum number of concurrent connections"""
+        service = self.start_service(max_connections=1)
+
+        first = self.connect(service)
+        self.assertEqual(b"first", self.echo(first, b"first"))
+
+        # The second client isn't served until the first one disconnects
+        second = self.connect(service)
+        second.sendall(b"second")
+        second.settimeout(0.2)
+        self.assertRaises(socket.timeout, second.recv, 4096)
+        first.close()
+        second.settimeout(1)
+        self.assertEqual(b"second", second.recv(4096))
+        second.close()
+
+    def test_forwarder_idle_timeout(self):
+        """Test closing idle connections"""
+        service = self.start_service(idle_timeout=0.2)
+
+        client = self.connect(service)
+        self.assertEqual(b"data", self.echo(client, b"data"))
+        client.settimeout(1)
+        self.assertEqual(b"", client.recv(4096))
+        client.close()
+
+        events = self.get_events()
+        self.assertEqual("Forwarding finished", events[-1].event)
+        self.assertEqual("idle", events[-1].data["reason"])
+
+    def test_forwarder_invalid_capture(self):
+        """Test invalid capture modes"""
+        with self.assertRaises(ValueError):
+            ForwarderService(Configuration({"capture": "invalid", "virtual": True}),
+                             None, self.session_manager, None)
+
+
+def test_suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(ForwarderServiceTest))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(test_suite())
@@ -17,17 +17,100 @@
 
 # Standard imports
 import unittest
+from os import remove, utime, stat
+from tempfile import mkstemp
 # External imports
 from six.moves import range
+from gevent import spawn, sleep, joinall
 # Custom imports
-from honeysap.services.saprouter.routetable import RouteTable
+from honeysap.core.config import Configuration
+from honeysap.services.saprouter.saprouter import SAPRouterService
+from honeysap.services.saprouter.routetable import (RouteTable, InvalidRouteTableEntry,
+                                                    AddressIndex, parse_saprouttab, netaddr)
 
 
-# TODO: Add tests on netaddr network range parsing
+saprouttab = """
+# Deny access to the database server
+D   *            10.0.0.5      *
+P   10.0.1.*     10.0.0.*      32$$
+S   *            sapserver     sapdp00   secret
+KT  "p:CN=Client" 10.0.0.2     3299
+P   *            *.corp.local  22
+"""
 
 
 class SAPRouterTest(unittest.TestCase):
-    pass
+
+    def setUp(self):
+        self.test_filename = mkstemp(".saprouttab", "saproutertest")[1]
+        with open(self.test_filename, "w") as fd:
+            fd.write(saprouttab)
+
+    def tearDown(self):
+        remove(self.test_filename)
+
+    def test_route_table_file(self):
+        """Test loading and reloading the route table from a saprouttab file"""
+
+        service = SAPRouterService(Configuration({"virtual": True,
+                                                  "listener_port": 3299,
+                                                  "route_table_file": self.test_filename}),
+                                   None, None, None)
+        route_table = service.server.route_table
+        self.assertEqual(5, len(route_table.entries))
+        self.assertEqual(RouteTable.ROUTE_ALLOW,
+                         route_table.lookup_target("sapserver", 3200)[0])
+
+        # The table isn't reloaded if the file wasn't modified
+        service.check_route_table()
+        self.assertIs(route_table, service.server.route_table)
+
+        # An invalid file keeps the current table
+        with open(self.test_filename, "w") as fd:
+            fd.write("X * * *\n")
+        utime(self.test_filename, (0, 0))
+        service.check_route_table()
+        self.assertIs(route_table, service.server.route_table)
+
+        # The new table is swapped after the file is modified
+        with open(self.test_filename, "w") as fd:
+            fd.write("D * sapserver *\n")
+        utime(self.test_filename, (1, 1))
+        service.check_route_table()
+        self.assertIsNot(route_table, service.server.route_table)
+        self.assertEqual(RouteTable.ROUTE_DENY,
+                         service.server.route_table.lookup_target("sapserver", 3200)[0])
+
+        service.route_table_pool.kill()
+
+    def test_route_table_reload_concurrency(self):
+        """Test serving other greenlets while reloading a large route table"""
+
+        service = SAPRouterService(Configuration({"virtual": True,
+                                                  "listener_port": 3299,
+                                                  "route_table_file": self.test_filename}),
+                                   None, None, None)
+        with open(self.test_filename, "w") as fd:
+            for i in range(20000):
+                fd.write("P * 10.%d.%d.0/24 32$$\n" % (i // 256, i % 256))
+
+        ticks = []
+
+        def ticker():
+            while True:
+                ticks.append(1)
+                sleep(0.001)
+
+        ticking = spawn(ticker)
+        # Reloads triggered at the same time are serialized
+        reloads = [spawn(service.reload_route_table) for __ in range(2)]
+        joinall(reloads)
+        ticking.kill()
+        service.route_table_pool.kill()
+
+        self.assertEqual(20000, len(service.server.route_table.entries))
+        self.assertEqual(stat(self.test_filename).st_mtime, service.route_table_mtime)
+        self.assertGreater(len(ticks), 10)
 
 
 class RouteTableTest(unittest.TestCase):
@@ -155,6 +238,168 @@ class RouteTableTest(unittest.TestCase):
         self.assertEqual(RouteTable.MODE_NI, mode)
         self.assertEqual("password", password)
 
+    def test_lookup_target_port_wildcards(self):
+        """Test look up of ports with wildcards in the table"""
+
+        routetable = RouteTable(["allow,ni,10.0.0.1,3$0$,",
+                                 "allow,ni,10.0.0.2,sapgw$$,",
+                                 "allow,ni,10.0.0.3,32*,"])
+        for host, port, action in [("10.0.0.1", 3000, RouteTable.ROUTE_ALLOW),
+                                   ("10.0.0.1", 3909, RouteTable.ROUTE_ALLOW),
+                                   ("10.0.0.1", 3010, RouteTable.ROUTE_DENY),
+                                   ("10.0.0.1", 3299, RouteTable.ROUTE_DENY),
+                                   ("10.0.0.2", 3301, RouteTable.ROUTE_ALLOW),
+                                   ("10.0.0.2", 3200, RouteTable.ROUTE_DENY),
+                                   ("10.0.0.3", 32, RouteTable.ROUTE_ALLOW),
+                                   ("10.0.0.3", 3299, RouteTable.ROUTE_ALLOW),
+                                   ("10.0.0.3", 3300, RouteTable.ROUTE_DENY)]:
+            self.assertEqual(action, routetable.lookup_target(host, port)[0])
+        self.assertEqual(100, len([key for key in routetable.table if key[0] == "10.0.0.1"]))
+
+    def test_lookup_target_hostnames(self):
+        """Test look up of hostnames and wildcards in the table"""
+
+        table = ["allow,ni,*,3200-3209,",
+                 "deny,any,sapserver,3201,",
+                 "allow,raw,*.corp.local,*,password",
+                 "deny,any,db.corp.local,22,"]
+        routetable = RouteTable(table)
+
+        self.assertEqual((RouteTable.ROUTE_ALLOW, RouteTable.MODE_NI, None),
+                         routetable.lookup_target("10.0.0.1", 3200))
+        self.assertEqual((RouteTable.ROUTE_ALLOW, RouteTable.MODE_NI, None),
+                         routetable.lookup_target("sapserver", 3200))
+        self.assertEqual((RouteTable.ROUTE_DENY, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("SAPServer", 3201))
+        self.assertEqual((RouteTable.ROUTE_DENY, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("otherserver", 3210))
+        self.assertEqual((RouteTable.ROUTE_ALLOW, RouteTable.MODE_RAW, "password"),
+                         routetable.lookup_target("app.corp.local", 3201))
+        self.assertEqual((RouteTable.ROUTE_ALLOW, RouteTable.MODE_RAW, "password"),
+                         routetable.lookup_target("db.corp.local", 23))
+        self.assertEqual((RouteTable.ROUTE_DENY, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("db.corp.local", 22))
+
+    @unittest.skipIf(netaddr is None, "netaddr library not available")
+    def test_lookup_target_networks(self):
+        """Test look up of network ranges in the table"""
+
+        table = ["allow,ni,10.0.0.0/16,3200-3299,",
+                 "deny,any,10.0.1.*,3201,",
+                 "allow,raw,10.0.2.1-10,3299,password",
+                 {"action": "allow", "mode": "any", "target": "10.1.1,3.1",
+                  "port": 3300, "password": None},
+                 "allow,any,fe80::/64,3200,"]
+        routetable = RouteTable(table)
+
+        self.assertEqual((RouteTable.ROUTE_ALLOW, RouteTable.MODE_NI, None),
+                         routetable.lookup_target("10.0.0.1", 3200))
+        self.assertEqual((RouteTable.ROUTE_ALLOW, RouteTable.MODE_NI, None),
+                         routetable.lookup_target("10.0.255.255", 3299))
+        self.assertEqual((RouteTable.ROUTE_DENY, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("10.1.0.1", 3200))
+        self.assertEqual((RouteTable.ROUTE_DENY, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("10.0.0.1", 3300))
+        self.assertEqual((RouteTable.ROUTE_DENY, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("10.0.1.20", 3201))
+        self.assertEqual((RouteTable.ROUTE_ALLOW, RouteTable.MODE_NI, None),
+                         routetable.lookup_target("10.0.1.20", 3202))
+        self.assertEqual((RouteTable.ROUTE_ALLOW, RouteTable.MODE_RAW, "password"),
+                         routetable.lookup_target("10.0.2.10", 3299))
+        self.assertEqual((RouteTable.ROUTE_ALLOW, RouteTable.MODE_NI, None),
+                         routetable.lookup_target("10.0.2.11", 3299))
+        self.assertEqual((RouteTable.ROUTE_ALLOW, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("10.1.3.1", 3300))
+        self.assertEqual((RouteTable.ROUTE_DENY, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("10.1.2.1", 3300))
+        self.assertEqual((RouteTable.ROUTE_ALLOW, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("fe80::1", 3200))
+        self.assertEqual((RouteTable.ROUTE_DENY, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("fe81::1", 3200))
+        # Address lookups don't match hostnames
+        self.assertEqual((RouteTable.ROUTE_DENY, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("sapserver", 3200))
+
+    @unittest.skipIf(netaddr is None, "netaddr library not available")
+    def test_build_table_large(self):
+        """Test building a table with large network ranges"""
+
+        table = ["allow,any,10.0.0.0/8,3200-3299,",
+                 "deny,any,0.0.0.0/0,*,"]
+        routetable = RouteTable(table)
+
+        self.assertEqual(2, len(routetable.entries))
+        self.assertEqual((RouteTable.ROUTE_DENY, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("10.0.0.1", 3200))
+
+    def test_address_index(self):
+        """Test looking up overlapping intervals in the address index"""
+
+        index = AddressIndex()
+        intervals = [(i, 2000 - i, i) for i in range(1000)]
+        for first, last, rule in intervals:
+            index.add(first, last, rule)
+        index.build()
+
+        for value in (0, 1, 500, 999, 1000, 1500, 2000, 2001):
+            self.assertEqual([rule for first, last, rule in intervals if first <= value <= last],
+                             index.lookup(value))
+        # Each interval is stored in a logarithmic number of nodes
+        self.assertLess(sum(len(rules) for rules in index.nodes.values()), 1000 * 24)
+
+    def test_parse_saprouttab(self):
+        """Test parsing of saprouttab files"""
+
+        entries = parse_saprouttab(saprouttab.splitlines())
+        self.assertEqual(5, len(entries))
+        self.assertEqual({"action": "deny", "mode": "any", "source": "*",
+                          "target": "10.0.0.5", "port": "*", "password": None},
+                         entries[0])
+        self.assertEqual({"action": "allow", "mode": "ni", "source": "*",
+                          "target": "sapserver", "port": "sapdp00", "password": "secret"},
+                         entries[2])
+        # SNC entries apply to any source
+        self.assertEqual("*", entries[3]["source"])
+
+        # Quoted SNC names with spaces
+        entries = parse_saprouttab(['KP "p:CN=Client, OU=Test, O=Corp" 10.0.0.2 3299 # SNC client'])
+        self.assertEqual({"action": "allow", "mode": "any", "source": "*",
+                          "target": "10.0.0.2", "port": "3299", "password": None},
+                         entries[0])
+
+        with self.assertRaises(InvalidRouteTableEntry):
+            parse_saprouttab(["X * * *"])
+        with self.assertRaises(InvalidRouteTableEntry):
+            parse_saprouttab(["P * *"])
+        with self.assertRaises(InvalidRouteTableEntry):
+            parse_saprouttab(['KP "p:CN=Client * 3299'])
+
+    @unittest.skipIf(netaddr is None, "netaddr library not available")
+    def test_lookup_target_saprouttab(self):
+        """Test look up of targets using first match saprouttab semantics"""
+
+        routetable = RouteTable(list(reversed(parse_saprouttab(saprouttab.splitlines()))))
+
+        # The first matching line has precedence
+        self.assertEqual((RouteTable.ROUTE_DENY, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("10.0.0.5", 3200, "10.0.1.1"))
+        # Source restricted entries
+        self.assertEqual((RouteTable.ROUTE_ALLOW, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("10.0.0.6", 3299, "10.0.1.1"))
+        self.assertEqual((RouteTable.ROUTE_DENY, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("10.0.0.6", 3299, "10.0.2.1"))
+        self.assertEqual((RouteTable.ROUTE_DENY, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("10.0.0.6", 3299))
+        self.assertEqual((RouteTable.ROUTE_DENY, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("10.0.0.6", 3300, "10.0.1.1"))
+        # Service names
+        self.assertEqual((RouteTable.ROUTE_ALLOW, RouteTable.MODE_NI, "secret"),
+                         routetable.lookup_target("sapserver", 3200, "10.0.2.1"))
+        self.assertEqual((RouteTable.ROUTE_ALLOW, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("10.0.0.2", 3299, "10.0.2.1"))
+        self.assertEqual((RouteTable.ROUTE_ALLOW, RouteTable.MODE_ANY, None),
+                         routetable.lookup_target("ssh.corp.local", 22, "10.0.2.1"))
+
 
 def test_suite():
     loader = unittest.TestLoader()
@@ -16,13 +16,15 @@
 #
 
 # Standard imports
+import logging
 import unittest
+from time import time
 # External imports
 from gevent.queue import Queue
 # Custom imports
 from honeysap.core.event import Event
 from honeysap.core.config import Configuration
-from honeysap.core.session import Session, SessionManager
+from honeysap.core.session import Session, SessionManager, TimerWheel
 
 
 class SessionTest(unittest.TestCase):
@@ -49,6 +51,32 @@ class SessionTest(unittest.TestCase):
         self.assertIsInstance(new_event, Event)
         self.assertEqual(new_event.event, event_str)
 
+    def test_session_logger(self):
+        """Test that sessions log through a shared logger"""
+        loggers = len(logging.Logger.manager.loggerDict)
+
+        session = Session(Queue(), "test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        another_session = Session(Queue(), "test", "127.0.0.1", 3201, "127.0.0.1", 3201)
+        session.add_event("Some event")
+        another_session.add_event("Some event")
+
+        self.assertIs(session.logger.logger, another_session.logger.logger)
+        self.assertIs(session, session.logger.extra)
+        self.assertIs(session.logger, session.logger)
+        self.assertEqual(loggers, len(logging.Logger.manager.loggerDict))
+
+        # Messages are prefixed with the session
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        session.logger.logger.addHandler(handler)
+        self.addCleanup(session.logger.logger.removeHandler, handler)
+        session.logger.logger.setLevel(logging.DEBUG)
+        self.addCleanup(session.logger.logger.setLevel, logging.NOTSET)
+        session.logger.info("Some message %d", 1)
+        self.assertEqual("%s - Some message 1" % session, records[0].getMessage())
+        self.assertIs(session, records[0].session)
+
 
 class SessionManagerTest(unittest.TestCase):
 
@@ -78,12 +106,135 @@ class SessionManagerTest(unittest.TestCase):
         another_session = session_manager.get_session("service", "127.0.0.1", 3201, "127.0.0.1", 3201)
         self.assertIsNot(session, another_session)
 
+    def test_session_manager_event_queue(self):
+        """Test the session manager bounded event queue"""
+
+        session_manager = SessionManager(Configuration({"event_queue_size": 2,
+                                                        "event_queue_overflow": "drop_newest"}))
+        session = session_manager.get_session("test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        another_session = session_manager.get_session("another", "127.0.0.1", 3200, "127.0.0.1", 3201)
+
+        session.add_event("Some event")
+        session.add_event("Some event")
+        session.add_event("Some event")
+        session.add_event("Other event")
+        another_session.add_event("Some event")
+
+        # Check that the events were dropped and accounted per service and
+        # event type
+        self.assertEqual(2, session_manager.event_queue.qsize())
+        stats = session_manager.stats()
+        self.assertEqual(2, stats["queued"])
+        self.assertEqual(3, stats["dropped"])
+        self.assertEqual({"test/Some event": 1,
+                          "test/Other event": 1,
+                          "another/Some event": 1}, stats["dropped_events"])
+
+    def test_session_manager_timeout(self):
+        """Test expiration of idle sessions"""
+
+        session_manager = SessionManager(Configuration({"session_timeout": 10}))
+        closed = []
+        session_manager.add_close_callback(lambda session, reason: closed.append((session, reason)))
+
+        session = session_manager.get_session("test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        another_session = session_manager.get_session("test", "127.0.0.1", 3201, "127.0.0.1", 3201)
+        session.add_event("Some event", request="AAAA", response="BB")
+
+        # Sessions are not expired before the timeout
+        now = time()
+        session_manager.expire_sessions(now + 5)
+        self.assertEqual(2, len(session_manager.sessions))
+
+        # Keep one of the sessions active
+        session.last_seen = now + 8
+        session_manager.expire_sessions(now + 12)
+        self.assertEqual([(another_session, "timeout")], closed)
+        self.assertEqual([session.key], list(session_manager.sessions))
+
+        session_manager.expire_sessions(now + 20)
+        self.assertEqual((session, "timeout"), closed[1])
+        self.assertEqual(0, len(session_manager.sessions))
+
+        # Check the session closed event
+        self.assertEqual("Some event", session_manager.event_queue.get().event)
+        self.assertEqual("Session closed", session_manager.event_queue.get().event)
+        event = session_manager.event_queue.get()
+        self.assertIs(session, event.session)
+        self.assertEqual("Session closed", event.event)
+        self.assertEqual("timeout", event.data["reason"])
+        self.assertEqual(1, event.data["events"])
+        self.assertEqual(4, event.data["request_bytes"])
+        self.assertEqual(2, event.data["response_bytes"])
+        self.assertAlmostEqual(8, event.data["duration"], delta=1)
+
+        # A new session is created for the same addresses
+        self.assertIsNot(session, session_manager.get_session("test", "127.0.0.1", 3200, "127.0.0.1", 3201))
+
+    def test_session_manager_max(self):
+        """Test eviction of the least recently used sessions"""
+
+        session_manager = SessionManager(Configuration({"session_max": 2}))
+        closed = []
+        session_manager.add_close_callback(lambda session, reason: closed.append((session, reason)))
+
+        first = session_manager.get_session("test", "127.0.0.1", 1, "127.0.0.1", 3201)
+        second = session_manager.get_session("test", "127.0.0.1", 2, "127.0.0.1", 3201)
+        # Use the first session again so the second is the least recently used
+        self.assertIs(first, session_manager.get_session("test", "127.0.0.1", 1, "127.0.0.1", 3201))
+        third = session_manager.get_session("test", "127.0.0.1", 3, "127.0.0.1", 3201)
+
+        self.assertEqual([(second, "evicted")], closed)
+        self.assertEqual([first.key, third.key], list(session_manager.sessions))
+
+    def test_session_manager_max_timeout(self):
+        """Test evicted sessions are not kept for their expiration"""
+
+        session_manager = SessionManager(Configuration({"session_max": 2,
+                                                        "session_timeout": 10}))
+        for port in range(10):
+            session_manager.get_session("test", "127.0.0.1", port, "127.0.0.1", 3201)
+        self.assertEqual(2, len(session_manager.sessions))
+        self.assertEqual(2, len(session_manager.wheel))
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def test_timer_wheel(self):
+        """Test the timer wheel"""
+
+        wheel = TimerWheel(resolution=1, slots=8, now=0)
+        wheel.schedule("a", 3)
+        wheel.schedule("b", 5)
+        # Items scheduled beyond a revolution of the wheel
+        wheel.schedule("c", 12)
+        wheel.schedule("d", 30)
+
+        self.assertEqual([], wheel.advance(2))
+        self.assertEqual(["a"], wheel.advance(4))
+        self.assertEqual(["b"], wheel.advance(11))
+        self.assertEqual(["c"], wheel.advance(12))
+        # Advancing more than a revolution
+        self.assertEqual(["d"], wheel.advance(100))
+        self.assertEqual([], wheel.advance(200))
+        self.assertEqual(0, len(wheel))
+
+        # Cancelled and rescheduled items
+        wheel.schedule("e", 203)
+        wheel.schedule("f", 203)
+        wheel.schedule("f", 205)
+        wheel.cancel("e")
+        self.assertEqual(1, len(wheel))
+        self.assertEqual([], wheel.advance(204))
+        self.assertEqual(["f"], wheel.advance(205))
+
 
 def test_suite():
     loader = unittest.TestLoader()
     suite = unittest.TestSuite()
     suite.addTest(loader.loadTestsFromTestCase(SessionTest))
     suite.addTest(loader.loadTestsFromTestCase(SessionManagerTest))
+    suite.addTest(loader.loadTestsFromTestCase(TimerWheelTest))
     return suite
 
 
@@ -0,0 +1,158 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import json
+import random
+import unittest
+from shutil import rmtree
+from os.path import join
+from tempfile import mkdtemp
+# External imports
+# Custom imports
+from honeysap.core.sketches import (CountMinSketch, HeavyHitters, HyperLogLog,
+                                    TDigest, EventSketches)
+
+
+class SketchesTest(unittest.TestCase):
+
+    def test_count_min_sketch(self):
+        """Test Count-Min sketch estimates"""
+        sketch = CountMinSketch(width=512, depth=4)
+        for i in range(1000):
+            sketch.add("key %d" % i)
+        for i in range(100):
+            sketch.add("frequent", 2)
+        self.assertTrue(200 <= sketch.estimate("frequent") <= 210)
+        self.assertEqual(1200, sketch.total)
+
+    def test_heavy_hitters(self):
+        """Test heavy hitters tracking the most frequent keys"""
+        hitters = HeavyHitters(size=5, width=512)
+        stream = ["10.0.0.%d" % i for i in range(1, 6) for __ in range(100 * i)]
+        stream += ["192.168.%d.%d" % (i // 256, i % 256) for i in range(2000)]
+        random.Random(1).shuffle(stream)
+        for key in stream:
+            hitters.add(key)
+        self.assertEqual(["10.0.0.5", "10.0.0.4", "10.0.0.3", "10.0.0.2", "10.0.0.1"],
+                         [key for key, __ in hitters.top()])
+
+        # Merging keeps the top keys of both
+        other = HeavyHitters(size=5, width=512)
+        for __ in range(1000):
+            other.add("10.0.0.9")
+        hitters.merge(other)
+        key, count = hitters.top(1)[0]
+        self.assertEqual("10.0.0.9", key)
+        self.assertTrue(1000 <= count <= 1010)
+
+    def test_hyperloglog(self):
+        """Test HyperLogLog distinct count estimates"""
+        hll = HyperLogLog(precision=12)
+        self.assertEqual(0, hll.count())
+        for i in range(50000):
+            hll.add("10.%d.%d.%d" % (i // 65536, (i // 256) % 256, i % 256))
+            hll.add("10.0.0.1")
+        self.assertTrue(abs(hll.count() - 50000) < 50000 * 0.05)
+
+        # Merging counts the union
+        other = HyperLogLog(precision=12)
+        for i in range(100):
+            other.add("172.16.0.%d" % i)
+        hll.merge(other)
+        self.assertTrue(abs(hll.count() - 50100) < 50100 * 0.05)
+
+    def test_tdigest(self):
+        """Test t-digest quantile estimates"""
+        digest = TDigest(compression=100)
+        values = list(range(10000))
+        random.Random(1).shuffle(values)
+        for value in values:
+            digest.add(value)
+        self.assertTrue(abs(digest.quantile(0.5) - 5000) < 100)
+        self.assertTrue(abs(digest.quantile(0.99) - 9900) < 20)
+        self.assertEqual(0, digest.min)
+        self.assertEqual(9999, digest.max)
+        self.assertTrue(len(digest.means) <= 100)
+
+        other = TDigest(compression=100)
+        for value in range(10000, 20000):
+            other.add(value)
+        digest.merge(other)
+        self.assertTrue(abs(digest.quantile(0.5) - 10000) < 200)
+
+
+class EventSketchesTest(unittest.TestCase):
+
+    def event(self, source, name="Received packet", data="", service="saprouter"):
+        return {"session": "uuid", "service": service, "source_ip": source,
+                "source_port": 1234, "target_ip": "127.0.0.1",
+                "target_port": 3299, "event": name, "data": data}
+
+    def test_event_sketches(self):
+        """Test sketches of events in rolling windows"""
+        sketches = EventSketches(window=60, windows=2, top=3, width=256)
+        for i in range(10):
+            sketches.add(self.event("10.0.0.1"), now=0)
+        sketches.add(self.event("10.0.0.2", "Route request allowed, invalid password",
+                                {"target_host": "10.1.0.1", "target_port": "3200",
+                                 "password": "secret"}), now=10)
+        sketches.add(self.event("10.0.0.2", "Information request invalid password",
+                                "secret"), now=20)
+        # Only route requests count as route targets
+        sketches.add(self.event("10.0.0.3", "Connected to target",
+                                {"target_host": "10.1.0.2", "target_port": 3200},
+                                service="forwarder"), now=30)
+        sketches.add(self.event("10.0.0.3", "Session closed", {"duration": 4.0}), now=70)
+
+        snapshot = sketches.snapshot(now=80)
+        self.assertEqual(60, snapshot["current"]["start"])
+        self.assertEqual(1, snapshot["current"]["events"])
+        self.assertEqual(14, snapshot["total"]["events"])
+        self.assertEqual(3, snapshot["total"]["distinct_sources"])
+        self.assertEqual(("10.0.0.1", 10), snapshot["total"]["top_sources"][0])
+        self.assertEqual([("10.1.0.1:3200", 1)], snapshot["total"]["top_targets"])
+        self.assertEqual(("secret", 2), snapshot["total"]["top_passwords"][0])
+        self.assertEqual(4.0, snapshot["total"]["session_durations"]["saprouter"]["p50"])
+
+        # Windows older than the ones kept are dropped
+        snapshot = sketches.snapshot(now=200)
+        self.assertEqual(0, snapshot["total"]["events"])
+
+    def test_event_sketches_snapshot(self):
+        """Test writing snapshots as JSON"""
+        directory = mkdtemp("sketchestest")
+        self.addCleanup(rmtree, directory)
+        filename = join(directory, "sketches.json")
+        sketches = EventSketches()
+        sketches.add(self.event("10.0.0.1"))
+        sketches.write_snapshot(filename)
+        with open(filename) as fd:
+            snapshot = json.load(fd)
+        self.assertEqual(1, snapshot["total"]["distinct_sources"])
+
+
+def test_suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(SketchesTest))
+    suite.addTest(loader.loadTestsFromTestCase(EventSketchesTest))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(test_suite())
@@ -0,0 +1,137 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import os
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+# External imports
+# Custom imports
+from honeysap.core.spool import Spool, SpoolError
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp("spooltest")
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_spool(self):
+        """Test appending and reading records"""
+        spool = Spool(self.directory)
+        reader = spool.reader("feed")
+
+        offsets = [spool.append(b"record %d" % i) for i in range(3)]
+        self.assertEqual(0, offsets[0])
+
+        # Records are visible once flushed
+        self.assertEqual([], reader.read())
+        spool.flush()
+        records = reader.read()
+        self.assertEqual([b"record 0", b"record 1", b"record 2"],
+                         [record for record, __ in records])
+        self.assertEqual(offsets[1:], [offset for __, offset in records[:-1]])
+        self.assertEqual(spool.offset, records[-1][1])
+        self.assertEqual([], reader.read())
+
+        # Unacknowledged records are read again after rewinding
+        reader.ack(records[0][1])
+        reader.rewind()
+        self.assertEqual([b"record 1", b"record 2"],
+                         [record for record, __ in reader.read()])
+        spool.close()
+
+    def test_spool_cursors(self):
+        """Test readers continue from their persisted cursor"""
+        spool = Spool(self.directory)
+        first, second = spool.reader("first"), spool.reader("second")
+        for i in range(3):
+            spool.append(b"record %d" % i)
+        spool.flush()
+        first.ack(first.read(2)[-1][1])
+        second.ack(second.read(1)[-1][1])
+        spool.close()
+
+        spool = Spool(self.directory)
+        self.assertEqual([b"record 2"], [record for record, __ in spool.reader("first").read()])
+        self.assertEqual([b"record 1", b"record 2"],
+                         [record for record, __ in spool.reader("second").read()])
+        spool.append(b"record 3")
+        spool.flush()
+        self.assertEqual([b"record 3"], [record for record, __ in spool.reader("first").read()])
+        spool.close()
+
+    def test_spool_segments(self):
+        """Test segments are rolled and removed once read by all readers"""
+        spool = Spool(self.directory, segment_size=100)
+        first, second = spool.reader("first"), spool.reader("second")
+        for i in range(10):
+            spool.append(b"A" * 40)
+        spool.flush()
+        self.assertEqual(4, len(spool.segments))
+
+        records = first.read()
+        self.assertEqual(10, len(records))
+        first.ack(records[-1][1])
+        spool.commit()
+        self.assertEqual(4, len(spool.segments))
+
+        second.ack(second.read(5)[-1][1])
+        spool.commit()
+        self.assertEqual(3, len(spool.segments))
+        self.assertEqual(3, len([filename for filename in os.listdir(self.directory)
+                                 if filename.endswith(".seg")]))
+        self.assertEqual(5, len(second.read()))
+        spool.close()
+
+    def test_spool_recover(self):
+        """Test partially written records are discarded on recovery"""
+        spool = Spool(self.directory)
+        spool.append(b"record 0")
+        spool.append(b"record 1")
+        spool.close()
+        valid = spool.offset
+
+        # Simulate a crash while writing a record
+        with open(spool.segment_path(0), "ab") as fd:
+            fd.write(b"\x00\x00\x00\x10\x00\x00")
+
+        spool = Spool(self.directory)
+        self.assertEqual(valid, spool.offset)
+        spool.append(b"record 2")
+        spool.flush()
+        self.assertEqual([b"record 0", b"record 1", b"record 2"],
+                         [record for record, __ in spool.reader("feed").read()])
+        spool.close()
+
+    def test_spool_invalid_fsync(self):
+        """Test invalid fsync policies"""
+        self.assertRaises(SpoolError, Spool, self.directory, fsync="invalid")
+
+
+def test_suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(SpoolTest))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(test_suite())
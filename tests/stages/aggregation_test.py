@@ -0,0 +1,111 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import unittest
+# External imports
+from gevent.queue import Queue
+# Custom imports
+from honeysap.core.event import Event
+from honeysap.core.session import Session
+from honeysap.core.config import Configuration
+from honeysap.stages.aggregation import AggregationStage
+
+
+class AggregationStageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.session = Session(Queue(), "test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+
+    def event(self, name, time, **kwargs):
+        return Event(name, session=self.session, time=time, **kwargs)
+
+    def test_aggregation(self):
+        """Test aggregating events per session and window"""
+        stage = AggregationStage(Configuration({"window": 60,
+                                                "events": {"Received packet": "aggregate",
+                                                           "Returned error": "both"}}))
+
+        # Aggregated events are held back, raw ones are passed on
+        self.assertEqual([], stage.process(self.event("Received packet", 1200, request="A" * 10)))
+        self.assertEqual([], stage.process(self.event("Received packet", 1210, request="A" * 5)))
+        error = self.event("Returned error", 1215, data={"return_code": -94}, response="B")
+        self.assertEqual([error], stage.process(error))
+        stage.process(self.event("Returned error", 1216, data={"return_code": -13}))
+        stage.process(self.event("Returned error", 1217, data={"return_code": -94}))
+        other = self.event("Route request allowed", 1220)
+        self.assertEqual([other], stage.process(other))
+        self.assertEqual({"aggregated": 5, "emitted": 0, "windows": 2}, stage.stats())
+
+        # Windows are passed on once ended
+        self.assertEqual([], stage.flush(1259))
+        events = stage.flush(1260)
+        self.assertEqual(["Aggregated events"] * 2, [event.event for event in events])
+        self.assertEqual({"event": "Received packet",
+                          "window_start": 1200, "window_end": 1260,
+                          "count": 2, "request_bytes": 15, "response_bytes": 0,
+                          "first_seen": 1200, "last_seen": 1210}, events[0].data)
+        self.assertEqual(1200, events[0].time)
+        self.assertIs(self.session, events[0].session)
+        self.assertEqual([-94, -13], events[1].data["return_codes"])
+        self.assertEqual(3, events[1].data["count"])
+        self.assertEqual(1, events[1].data["response_bytes"])
+
+    def test_aggregation_windows(self):
+        """Test windows are closed when a new one starts or the session ends"""
+        stage = AggregationStage(Configuration({"window": 60,
+                                                "default_mode": "aggregate"}))
+
+        stage.process(self.event("Received packet", 1000))
+        events = stage.process(self.event("Received packet", 1030))
+        self.assertEqual(1, len(events))
+        self.assertEqual(1, events[0].data["count"])
+
+        stage.process(self.event("Returned error", 1031))
+        closed = self.event("Session closed", 1032)
+        events = stage.process(closed)
+        self.assertEqual(["Aggregated events", "Aggregated events"], [event.event for event in events[:2]])
+        self.assertEqual(["Received packet", "Returned error"], [event.data["event"] for event in events[:2]])
+        self.assertIs(closed, events[2])
+        self.assertEqual({}, stage.session_windows)
+        self.assertEqual(0, len(stage.windows))
+
+    def test_aggregation_bounded(self):
+        """Test the number of windows is bounded"""
+        stage = AggregationStage(Configuration({"default_mode": "aggregate",
+                                                "max_windows": 2}))
+        stage.process(self.event("First", 1000))
+        stage.process(self.event("Second", 1000))
+        events = stage.process(self.event("Third", 1000))
+        self.assertEqual(["First"], [event.data["event"] for event in events])
+        self.assertEqual(["Second", "Third"], [event.data["event"] for event in stage.stop()])
+
+    def test_aggregation_invalid_mode(self):
+        """Test invalid aggregation modes"""
+        with self.assertRaises(ValueError):
+            AggregationStage(Configuration({"events": {"Received packet": "invalid"}}))
+
+
+def test_suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(AggregationStageTest))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(test_suite())
@@ -0,0 +1,129 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import unittest
+# External imports
+from gevent.hub import sleep
+from gevent.queue import Queue
+# Custom imports
+from honeysap.core.event import Event
+from honeysap.core.session import Session
+from honeysap.core.config import Configuration
+from honeysap.core.session import SessionManager
+from honeysap.core.feed import FeedManager
+from honeysap.core.stage import load_stages
+from honeysap.stages.ratelimit import RateLimitStage
+
+
+class RateLimitStageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sessions = {}
+
+    def event(self, source_ip, name="Received packet"):
+        if source_ip not in self.sessions:
+            self.sessions[source_ip] = Session(Queue(), "test", source_ip, 3200,
+                                               "127.0.0.1", 3201)
+        return Event(name, session=self.sessions[source_ip])
+
+    def process(self, stage, events, now):
+        return [processed for event in events
+                for processed in stage.process(event, now)]
+
+    def test_ratelimit(self):
+        """Test limiting and sampling the events of a source"""
+        stage = RateLimitStage(Configuration({"rate": 1, "burst": 5,
+                                              "sample_rate": 10,
+                                              "summary_interval": 60}))
+
+        # The burst is passed on, then one of every 10 events is sampled
+        events = [self.event("10.0.0.1") for __ in range(105)]
+        passed = self.process(stage, events, 1000)
+        self.assertEqual(events[:5] + events[14:105:10], passed)
+
+        # Other sources and events have their own buckets
+        self.assertEqual(1, len(self.process(stage, [self.event("10.0.0.2")], 1000)))
+        self.assertEqual(1, len(self.process(stage, [self.event("10.0.0.1", "Returned error")], 1000)))
+
+        # Tokens are refilled over time
+        self.assertEqual(2, len(self.process(stage, [self.event("10.0.0.1") for __ in range(3)], 1002)))
+
+        # Suppressed events are reported once per interval
+        self.assertEqual([], stage.flush(1030))
+        summaries = stage.flush(1060)
+        self.assertEqual(1, len(summaries))
+        self.assertEqual("Suppressed events", summaries[0].event)
+        self.assertEqual({"source_ip": "10.0.0.1", "event": "Received packet",
+                          "suppressed": 91, "sampled": 10, "interval": 60},
+                         summaries[0].data)
+        self.assertIs(self.sessions["10.0.0.1"], summaries[0].session)
+        self.assertEqual([], stage.flush(1120))
+
+    def test_ratelimit_bounded(self):
+        """Test the number of sources tracked is bounded"""
+        stage = RateLimitStage(Configuration({"burst": 1, "sample_rate": 0,
+                                              "max_sources": 2}))
+
+        self.process(stage, [self.event("10.0.0.1") for __ in range(3)], 1000)
+        self.process(stage, [self.event("10.0.0.2")], 1000)
+
+        # Evicting a source reports its suppressed events
+        events = self.process(stage, [self.event("10.0.0.3")], 1000)
+        self.assertEqual(["Suppressed events", "Received packet"], [event.event for event in events])
+        self.assertEqual(2, events[0].data["suppressed"])
+        self.assertEqual({"passed": 3, "suppressed": 2, "tracked": 2, "evicted": 1},
+                         stage.stats())
+
+    def test_ratelimit_events(self):
+        """Test limiting only the configured events"""
+        stage = RateLimitStage(Configuration({"burst": 1, "sample_rate": 0,
+                                              "events": ["Received packet"]}))
+        events = [self.event("10.0.0.1", "Session closed") for __ in range(3)]
+        self.assertEqual(events, self.process(stage, events, 1000))
+
+    def test_ratelimit_feed_manager(self):
+        """Test the stage loaded in the feed manager pipeline"""
+        config = Configuration({"stages": [{"stage": "RateLimitStage", "enabled": True,
+                                            "burst": 2, "sample_rate": 0},
+                                           {"stage": "RateLimitStage", "enabled": False}],
+                                "stages_flush_interval": 0.1})
+        stages = load_stages(config)
+        self.assertEqual(1, len(stages))
+
+        session_manager = SessionManager(config)
+        feed_manager = FeedManager(config, session_manager)
+        feed_manager.load_stages()
+        feed_manager.run()
+        session = session_manager.get_session("test", "127.0.0.1", 3200, "127.0.0.1", 3201)
+        for __ in range(5):
+            session.add_event("Received packet")
+        sleep(0.1)
+        feed_manager.stop()
+        self.assertEqual({"passed": 2, "suppressed": 3, "tracked": 1, "evicted": 0},
+                         feed_manager.stats()["stages"]["RateLimitStage"])
+
+
+def test_suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(RateLimitStageTest))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(test_suite())
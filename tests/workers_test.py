@@ -0,0 +1,66 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import sys
+import unittest
+# External imports
+from gevent import spawn, sleep
+# Custom imports
+from honeysap.core.workers import WorkerSupervisor
+
+
+class WorkerSupervisorTest(unittest.TestCase):
+
+    def test_supervisor_restart(self):
+        """Test supervisor restarting workers that exited"""
+        command = [sys.executable, "-c",
+                   "import sys; sys.exit(sys.argv[2] == '0')"]
+        supervisor = WorkerSupervisor(command, 2, restart_delay=0.1,
+                                      poll_interval=0.05)
+        greenlet = spawn(supervisor.run)
+        sleep(1)
+
+        # Workers are restarted whatever their exit code
+        self.assertTrue(supervisor.stats()["restarts"] >= 2)
+        supervisor.stop()
+        greenlet.join(1)
+        self.assertTrue(greenlet.dead)
+
+    def test_supervisor_stop(self):
+        """Test supervisor terminating the workers when stopped"""
+        command = [sys.executable, "-c", "import time; time.sleep(30)"]
+        supervisor = WorkerSupervisor(command, 2, poll_interval=0.05)
+        spawn(supervisor.run)
+        sleep(0.2)
+        self.assertEqual(2, supervisor.stats()["workers"])
+        supervisor.stop()
+        self.assertEqual(0, supervisor.stats()["workers"])
+        self.assertEqual(0, supervisor.stats()["restarts"])
+        self.assertTrue(all(worker.returncode is not None
+                            for worker in supervisor.workers))
+
+
+def test_suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(WorkerSupervisorTest))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(test_suite())
@@ -0,0 +1,128 @@
+# HoneySAP - SAP low-interaction honeypot
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# Author:
+#   Martin Gallo (@martingalloar)
+#   Code contributed by SecureAuth to the OWASP CBAS project
+#
+
+# Standard imports
+import os
+import gzip
+import unittest
+from io import BytesIO
+from shutil import rmtree
+from os.path import join
+from tempfile import mkdtemp
+# External imports
+from gevent import sleep
+# Custom imports
+from honeysap.core.writer import RotatingWriter
+
+
+class RotatingWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp("writertest")
+        self.addCleanup(rmtree, self.directory)
+        self.filename = join(self.directory, "events.log")
+
+    def read(self, path):
+        with open(path, "rb") as fd:
+            return fd.read()
+
+    def test_writer_buffer(self):
+        """Test writing lines once the buffer is full or flushed"""
+        writer = RotatingWriter(self.filename, buffer_size=20, flush_interval=0)
+        writer.write(b"first line\n")
+        self.assertEqual(b"", self.read(self.filename))
+        writer.write(b"second line\n")
+        writer.wait()
+        self.assertEqual(b"first line\nsecond line\n", self.read(self.filename))
+        writer.write(b"third line\n")
+        writer.close()
+        self.assertEqual(b"first line\nsecond line\nthird line\n", self.read(self.filename))
+        self.assertEqual(3, writer.stats()["lines"])
+
+    def test_writer_flush_interval(self):
+        """Test writing the buffered lines periodically"""
+        fd = BytesIO()
+        writer = RotatingWriter(fd=fd, flush_interval=0.05, threaded=False)
+        writer.write(b"line\n")
+        self.assertEqual(b"", fd.getvalue())
+        sleep(0.1)
+        self.assertEqual(b"line\n", fd.getvalue())
+        writer.close()
+        self.assertFalse(fd.closed)
+
+    def test_writer_rotate_size(self):
+        """Test rotating files by size and keeping only the last ones"""
+        writer = RotatingWriter(self.filename, buffer_size=1, flush_interval=0,
+                                rotate_size=10, rotate_keep=2)
+        for i in range(5):
+            writer.write(b"line %d 123\n" % i)
+        writer.close()
+
+        rotated = sorted(name for name in os.listdir(self.directory) if name != "events.log")
+        self.assertEqual(2, len(rotated))
+        self.assertEqual(b"line 4 123\n", self.read(self.filename))
+        self.assertEqual(4, writer.stats()["rotations"])
+
+    def test_writer_rotate_interval(self):
+        """Test rotating files by time"""
+        writer = RotatingWriter(self.filename, buffer_size=1, flush_interval=0,
+                                rotate_interval=0.05)
+        writer.write(b"first\n")
+        sleep(0.1)
+        writer.write(b"second\n")
+        writer.close()
+        self.assertEqual(b"second\n", self.read(self.filename))
+        self.assertEqual(1, writer.stats()["rotations"])
+
+    def test_writer_gzip(self):
+        """Test writing compressed files, appending to existing ones"""
+        for i in range(2):
+            writer = RotatingWriter(self.filename, flush_interval=0,
+                                    compression=RotatingWriter.COMPRESSION_GZIP)
+            writer.write(b"line %d\n" % i)
+            writer.close()
+        with gzip.open(self.filename + ".gz", "rb") as fd:
+            self.assertEqual(b"line 0\nline 1\n", fd.read())
+
+    def test_writer_errors(self):
+        """Test accounting for the buffers that failed to be written"""
+        for threaded in (True, False):
+            writer = RotatingWriter(self.filename, flush_interval=0, threaded=threaded)
+            writer.file.close()
+            writer.write(b"line\n")
+            writer.flush(wait=True)
+            stats = writer.stats()
+            self.assertEqual(1, stats["errors"])
+            self.assertEqual(5, stats["dropped"])
+            self.assertEqual(0, stats["written"])
+            writer.close()
+
+    def test_writer_invalid_compression(self):
+        """Test rejecting unknown compression formats"""
+        self.assertRaises(ValueError, RotatingWriter, self.filename,
+                          compression="lzma")
+
+
+def test_suite():
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(RotatingWriterTest))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(test_suite())